@@ -25,15 +25,30 @@ enum IPythonDisplay {
   // "real" bytes type that is an array of bytes, rather than Python2's "fake"
   // bytes type that is just an alias of str.
   private static var hasRealBytesType: Bool = false
+
+  private static var ctypes: PythonObject = Python.None
 }
 
 extension IPythonDisplay {
-  private static func bytes(_ py: PythonObject) -> KernelCommunicator.BytesReference {
-    // TODO: Replace with a faster implementation that reads bytes directly
-    // from the python object's memory.
+  /// Copies the contents of `py`, a Python bytes-like object, into a
+  /// `BytesReference`.
+  static func bytes(_ py: PythonObject) -> KernelCommunicator.BytesReference {
     if hasRealBytesType {
-      let bytes = py.lazy.map { CChar(bitPattern: UInt8($0)!) }
-      return KernelCommunicator.BytesReference(bytes)
+      // Fast path: copy straight out of the object's memory. `bytearray` and
+      // `memoryview` are first copied into a `bytes` (a single memcpy inside
+      // Python) so that we can ask ctypes where its contents live.
+      let data = Bool(Python.isinstance(py, Python.bytes))! ? py : Python.bytes(py)
+      let count = Int(Python.len(data))!
+      if count == 0 {
+        return KernelCommunicator.BytesReference([])
+      }
+      let address = Int(ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value)!
+      let buffer = UnsafeBufferPointer(
+        start: UnsafePointer<CChar>(bitPattern: address), count: count)
+      // `data` is still alive here, so `buffer` is valid during the copy.
+      return withExtendedLifetime(data) {
+        KernelCommunicator.BytesReference(buffer)
+      }
     }
     let bytes = py.lazy.map { CChar(bitPattern: UInt8(Python.ord($0))!) }
     return KernelCommunicator.BytesReference(bytes)
@@ -45,11 +60,9 @@ extension IPythonDisplay {
   }
 
   private static func consumeDisplayMessages() -> [KernelCommunicator.JupyterDisplayMessage] {
-    let displayMessages = IPythonDisplay.socket.messages.map {
+    return IPythonDisplay.socket.take_messages().map {
       KernelCommunicator.JupyterDisplayMessage(parts: $0.map { bytes($0) })
     }
-    IPythonDisplay.socket.messages = []
-    return displayMessages
   }
 
   static func enable() {
@@ -59,17 +72,20 @@ extension IPythonDisplay {
     }
 
     hasRealBytesType = Bool(Python.isinstance(PythonObject("t").encode("utf8")[0], Python.int))!
+    ctypes = Python.import("ctypes")
 
     let swift_shell = Python.import("swift_shell")
     let socketAndShell = swift_shell.create_shell(
       username: JupyterKernel.communicator.jupyterSession.username,
       session_id: JupyterKernel.communicator.jupyterSession.id,
-      key: PythonObject(JupyterKernel.communicator.jupyterSession.key).encode("utf8"))
+      key: PythonObject(JupyterKernel.communicator.jupyterSession.key).encode("utf8"),
+      pending_flag_address: JupyterKernel.communicator.displayMessagesPendingAddress)
     IPythonDisplay.socket = socketAndShell[0]
     IPythonDisplay.shell = socketAndShell[1]
 
     JupyterKernel.communicator.handleParentMessage(updateParentMessage)
-    JupyterKernel.communicator.afterSuccessfulExecution(run: consumeDisplayMessages)
+    JupyterKernel.communicator.afterSuccessfulExecution(
+      onlyWhenPending: true, run: consumeDisplayMessages)
   }
 }
 
@@ -25,36 +25,155 @@ public struct KernelCommunicator {
 
   public let jupyterSession: JupyterSession
 
-  private var previousDisplayMessages: [JupyterDisplayMessage] = []
+  private var previousDisplayMessages = BytesReference([])
+
+  /// Memory that the kernel reads and writes directly, so that it can skip
+  /// the hooks below when they would not do anything, and so that it can
+  /// call them without compiling a Swift expression. It holds these `Int`s:
+  ///
+  ///     parentMessageHandlerCount
+  ///     unconditionalHandlerCount
+  ///     displayMessagesPending
+  ///     parentMessageBufferAddress
+  ///     parentMessageBufferCapacity
+  ///     parentMessageCount
+  ///     displayMessagesAddress
+  ///     displayMessagesCount
+  ///
+  /// `unconditionalHandlerCount` counts the after-successful-execution
+  /// handlers that must run after every cell. The others only run when
+  /// `displayMessagesPending` is nonzero.
+  ///
+  /// The kernel writes the parent message JSON into the parent message
+  /// buffer and its length into `parentMessageCount` before calling
+  /// `updateParentMessageFromState()`. And
+  /// `triggerAfterSuccessfulExecutionIntoState()` stores the location of the
+  /// display messages buffer in `displayMessagesAddress` and
+  /// `displayMessagesCount`.
+  private let state: UnsafeMutablePointer<Int>
+  private static let stateCount = 8
+
+  private let parentMessageBuffer: UnsafeMutablePointer<UInt8>
+  private static let parentMessageBufferCapacity = 64 * 1024
 
   init(jupyterSession: JupyterSession) {
     self.afterSuccessfulExecutionHandlers = []
     self.parentMessageHandlers = []
     self.jupyterSession = jupyterSession
+    self.parentMessageBuffer = UnsafeMutablePointer<UInt8>.allocate(
+        capacity: KernelCommunicator.parentMessageBufferCapacity)
+    self.state = UnsafeMutablePointer<Int>.allocate(
+        capacity: KernelCommunicator.stateCount)
+    self.state.initialize(repeating: 0, count: KernelCommunicator.stateCount)
+    self.state[3] = Int(bitPattern: parentMessageBuffer)
+    self.state[4] = KernelCommunicator.parentMessageBufferCapacity
+  }
+
+  /// The address of the memory described on `state`.
+  public var stateAddress: Int {
+    return Int(bitPattern: state)
+  }
+
+  /// The address of an `Int` that must be set to a nonzero value when there
+  /// are display messages for handlers registered with
+  /// `onlyWhenPending: true` to return.
+  public var displayMessagesPendingAddress: Int {
+    return Int(bitPattern: state + 2)
   }
 
   /// Register a handler to run after the kernel successfully executes a cell
   /// of user code. The handler may return messages. These messages will be
   /// sent to the Jupyter client.
+  ///
+  /// If `onlyWhenPending` is true, the handler only runs after cells during
+  /// which something set the `Int` at `displayMessagesPendingAddress`.
   public mutating func afterSuccessfulExecution(
+      onlyWhenPending: Bool = false,
       run handler: @escaping () -> [JupyterDisplayMessage]) {
     afterSuccessfulExecutionHandlers.append(handler)
+    if !onlyWhenPending {
+      state[1] += 1
+    }
   }
 
   /// Register a handler to run when the parent message changes.
   public mutating func handleParentMessage(_ handler: @escaping (ParentMessage) -> ()) {
     parentMessageHandlers.append(handler)
+    state[0] += 1
   }
 
   /// The kernel calls this after successfully executing a cell of user code.
-  /// Returns an array of messages, where each message is returned as an array
-  /// of parts, where each part is returned as an `UnsafeBufferPointer<CChar>`
-  /// to the memory containing the part's bytes.
-  public mutating func triggerAfterSuccessfulExecution() -> [[UnsafeBufferPointer<CChar>]] {
-    // Keep a reference to the messages, so that their `.unsafeBufferPointer`
-    // stays valid while the kernel is reading from them.
-    previousDisplayMessages = afterSuccessfulExecutionHandlers.flatMap { $0() }
-    return previousDisplayMessages.map { $0.parts.map { $0.unsafeBufferPointer } }
+  /// Returns an `UnsafeBufferPointer<CChar>` to a single buffer containing
+  /// all the messages, laid out as described on `pack(_:)`, so that the kernel
+  /// can fetch everything with one memory read.
+  ///
+  /// The buffer stays valid until the kernel calls `releaseDisplayMessages()`
+  /// or until the next call to `triggerAfterSuccessfulExecution()`.
+  public mutating func triggerAfterSuccessfulExecution() -> UnsafeBufferPointer<CChar> {
+    state[2] = 0
+
+    // Keep a reference to the buffer, so that its `.unsafeBufferPointer`
+    // stays valid while the kernel is reading from it.
+    previousDisplayMessages = KernelCommunicator.pack(
+        afterSuccessfulExecutionHandlers.flatMap { $0() })
+    return previousDisplayMessages.unsafeBufferPointer
+  }
+
+  /// Like `triggerAfterSuccessfulExecution()`, but stores the location of the
+  /// buffer in `state` instead of returning it, so that the kernel can call
+  /// it through a C function pointer.
+  public mutating func triggerAfterSuccessfulExecutionIntoState() {
+    let buffer = triggerAfterSuccessfulExecution()
+    state[6] = Int(bitPattern: buffer.baseAddress)
+    state[7] = buffer.count
+  }
+
+  /// The kernel calls this after it has read the buffer returned by
+  /// `triggerAfterSuccessfulExecution()`, so that the memory can be freed.
+  public mutating func releaseDisplayMessages() {
+    previousDisplayMessages = BytesReference([])
+    state[6] = 0
+    state[7] = 0
+  }
+
+  /// Packs `messages` into one contiguous buffer.
+  ///
+  /// The buffer starts with a header of native-endian `Int64`s:
+  ///
+  ///     messageCount
+  ///     for each message:
+  ///       partCount
+  ///       for each part:
+  ///         offset, count
+  ///
+  /// where `offset` is the position of the part's bytes relative to the start
+  /// of the buffer. The bytes of all the parts follow the header.
+  static func pack(_ messages: [JupyterDisplayMessage]) -> BytesReference {
+    let headerCount = 1 + messages.reduce(0) { $0 + 1 + 2 * $1.parts.count }
+    var header: [Int64] = []
+    header.reserveCapacity(headerCount)
+    header.append(Int64(messages.count))
+    var offset = headerCount * MemoryLayout<Int64>.size
+    for message in messages {
+      header.append(Int64(message.parts.count))
+      for part in message.parts {
+        header.append(Int64(offset))
+        header.append(Int64(part.count))
+        offset += part.count
+      }
+    }
+
+    var bytes = ContiguousArray<CChar>()
+    bytes.reserveCapacity(offset)
+    header.withUnsafeBytes {
+      bytes.append(contentsOf: $0.lazy.map { CChar(bitPattern: $0) })
+    }
+    for message in messages {
+      for part in message.parts {
+        bytes.append(contentsOf: part.unsafeBufferPointer)
+      }
+    }
+    return BytesReference(taking: bytes)
   }
 
   /// The kernel calls this when the parent message changes.
@@ -64,6 +183,14 @@ public struct KernelCommunicator {
     }
   }
 
+  /// Like `updateParentMessage(to:)`, but reads the parent message JSON that
+  /// the kernel wrote into the parent message buffer.
+  public mutating func updateParentMessageFromState() {
+    let json = String(decoding: UnsafeBufferPointer(
+        start: parentMessageBuffer, count: state[5]), as: UTF8.self)
+    updateParentMessage(to: ParentMessage(json: json))
+  }
+
   /// A single serialized display message for the Jupyter client.
   /// Corresponds to a ZeroMQ "multipart message".
   public struct JupyterDisplayMessage {
@@ -88,6 +215,15 @@ public struct KernelCommunicator {
       self.bytes.append(contentsOf: bytes)
     }
 
+    /// Takes ownership of `bytes` without copying it.
+    init(taking bytes: ContiguousArray<CChar>) {
+      self.bytes = bytes
+    }
+
+    public var count: Int {
+      return bytes.count
+    }
+
     public var unsafeBufferPointer: UnsafeBufferPointer<CChar> {
       // We have tried very hard to make the pointer stay valid outside the
       // closure:
@@ -23,6 +23,8 @@ import sys
 from jupyter_client.kernelspec import KernelSpecManager
 from IPython.utils.tempdir import TemporaryDirectory
 
+from swift_kernel import CellWatchdog
+
 kernel_code_name_allowed_chars = "-."
 
 
@@ -93,6 +95,20 @@ def make_kernel_env(args):
         kernel_env['PYTHON_VERSION'] = args.swift_python_version
     if args.swift_python_library is not None:
         kernel_env['PYTHON_LIBRARY'] = args.swift_python_library
+    if args.pool_size > 0:
+        kernel_env['SWIFT_KERNEL_POOL_SIZE'] = str(args.pool_size)
+        kernel_env['SWIFT_KERNEL_POOL_IDLE_TIMEOUT'] = str(
+            args.pool_idle_timeout)
+    if args.time_limit is not None:
+        kernel_env['SWIFT_KERNEL_TIME_LIMIT'] = args.time_limit
+    if args.cpu_limit is not None:
+        kernel_env['SWIFT_KERNEL_CPU_LIMIT'] = args.cpu_limit
+    if args.memory_limit is not None:
+        kernel_env['SWIFT_KERNEL_MEMORY_LIMIT'] = args.memory_limit
+    if args.metrics_port is not None:
+        kernel_env['SWIFT_KERNEL_METRICS_PORT'] = args.metrics_port
+    if args.metrics_address is not None:
+        kernel_env['SWIFT_KERNEL_METRICS_ADDRESS'] = args.metrics_address
 
     return kernel_env
 
@@ -109,6 +125,13 @@ def validate_kernel_env(kernel_env):
     if not os.path.isfile(kernel_env['REPL_SWIFT_PATH']):
         raise Exception('repl_swift binary not found at %s' %
                         kernel_env['REPL_SWIFT_PATH'])
+    # Parse limits the way the kernel does.
+    for budget, key in CellWatchdog.BUDGETS.items():
+        if key in kernel_env:
+            try:
+                CellWatchdog.parse_limit(budget, kernel_env[key])
+            except ValueError as e:
+                raise Exception('invalid %s: %s' % (key, e))
 
 
 def main():
@@ -188,6 +211,39 @@ def parse_args():
         help='direct Swift\'s Python interop library to use this Python ' +
              'library')
 
+    parser.add_argument(
+        '--pool-size',
+        help='keep this many pre-launched kernels ready, so that new ' +
+             'kernels start faster',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--pool-idle-timeout',
+        help='shut down the pool of pre-launched kernels after this many ' +
+             'seconds without a kernel starting',
+        type=int,
+        default=3600)
+    parser.add_argument(
+        '--time-limit',
+        help='interrupt cells that run longer than this, like 90s, 30m or ' +
+             '2h')
+    parser.add_argument(
+        '--cpu-limit',
+        help='interrupt cells that use more CPU time than this, like 30m ' +
+             '(Linux only)')
+    parser.add_argument(
+        '--metrics-port',
+        help='export Prometheus metrics on the first free port in this ' +
+             'range, like 9100-9199')
+    parser.add_argument(
+        '--metrics-address',
+        help='serve metrics on this address instead of 127.0.0.1, like ' +
+             '0.0.0.0 for all interfaces')
+    parser.add_argument(
+        '--memory-limit',
+        help='interrupt cells that take the Swift process\'s resident ' +
+             'memory over this size, like 4G or 512M (Linux only)')
+
     args = parser.parse_args()
     if args.sys_prefix:
         args.prefix = sys.prefix
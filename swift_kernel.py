@@ -14,18 +14,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+import collections
+import importlib
 import json
-import lldb
 import os
+import queue
 import re
+import select
 import signal
+import struct
 import subprocess
 import sys
 import tempfile
 import threading
+import time
 
 from ipykernel.kernelbase import Kernel
 from jupyter_client.jsonutil import squash_dates
+from tornado import ioloop
+from traitlets import Bool
+
+# Tests and benchmarks can run the kernel against a stand-in for LLDB. See
+# test/fake_lldb.py.
+LLDB_MODULE = os.environ.get('SWIFT_KERNEL_LLDB_MODULE', 'lldb')
+try:
+    lldb = importlib.import_module(LLDB_MODULE)
+except ImportError:
+    # register.py imports this module to validate settings, where LLDB is not
+    # on the path. SwiftKernel raises the ImportError.
+    lldb = None
 
 
 class ExecutionResult:
@@ -94,51 +112,1279 @@ class SIGINTHandler(threading.Thread):
        SIGINT."""
     def __init__(self, kernel):
         super(SIGINTHandler, self).__init__()
+        self.daemon = True
         self.kernel = kernel
 
+    def interrupt(self):
+        self.kernel.process.SendAsyncInterrupt()
+
     def run(self):
         try:
             while True:
                 signal.sigwait([signal.SIGINT])
-                self.kernel.process.SendAsyncInterrupt()
+                self.interrupt()
         except Exception as e:
             self.kernel.log.error('Exception in SIGINTHandler: %s' % str(e))
 
 
 class StdoutHandler(threading.Thread):
-    """Collects stdout from the Swift process and sends it to the client."""
+    """Collects stdout from the Swift process and sends it to the client.
+
+    There is one long-lived StdoutHandler per kernel. It sleeps on an
+    SBListener subscribed to the process's STDOUT/STDERR broadcast bits, so
+    output reaches the client as soon as the Swift process writes it, and an
+    idle kernel does not wake up at all. (If the listener cannot be attached,
+    it falls back to polling.)
+
+    Output is buffered briefly so that a tight print loop turns into a few
+    large `stream` messages instead of thousands of tiny ones. The buffer is
+    flushed when it grows past `FLUSH_SIZE`, when it has held data for
+    `FLUSH_INTERVAL` seconds, or when the process goes quiet.
+
+    Each cell calls `begin_cell()` before executing and `end_cell()` after, so
+    that output is tagged with the parent message of the cell that produced
+    it, and so that all of a cell's output is sent before its reply.
+    """
+
+    # Maximum number of characters to buffer before flushing.
+    FLUSH_SIZE = 64 * 1024
+
+    # Maximum number of seconds to hold buffered output before flushing.
+    FLUSH_INTERVAL = 0.05
+
+    # How long to block waiting for events, in seconds. This only bounds how
+    # long `stop()` takes to take effect; output wakes the thread right away.
+    EVENT_WAIT_SECONDS = 1
+
+    # Polling interval used when events are unavailable.
+    POLL_INTERVAL = 0.1
+
     def __init__(self, kernel):
         super(StdoutHandler, self).__init__()
+        self.daemon = True
         self.kernel = kernel
         self.stop_event = threading.Event()
         self.had_stdout = False
 
-    def _get_stdout(self):
-        while True:
-            BUFFER_SIZE = 1000
-            stdout_buffer = self.kernel.process.GetSTDOUT(BUFFER_SIZE)
-            if len(stdout_buffer) == 0:
-                break
-            yield stdout_buffer
-
-    def _get_and_send_stdout(self):
-        stdout = ''.join([buf for buf in self._get_stdout()])
-        if len(stdout) > 0:
+        # Bytes of output sent for the current cell.
+        self.sent_bytes = 0
+
+        # Bytes of output read from the process, including suppressed output.
+        self.received_bytes = 0
+
+        # Protects the process's stdout, the buffers, and `parent_header`.
+        self._lock = threading.Lock()
+        self._buffers = {'stdout': [], 'stderr': []}
+        self._buffered_size = 0
+        self._first_buffered_time = None
+        self.parent_header = {}
+        self.suppressed = False
+
+        self.listener = lldb.SBListener('swift_kernel.stdout')
+        self.listen_to_process()
+
+    def listen_to_process(self):
+        """Subscribes to output events from the kernel's current process."""
+        broadcaster = self.kernel.process.GetBroadcaster()
+        event_mask = lldb.SBProcess.eBroadcastBitSTDOUT | \
+                     lldb.SBProcess.eBroadcastBitSTDERR
+        self.use_events = self.listener.IsValid() and \
+                broadcaster.AddListener(self.listener, event_mask) == event_mask
+
+    def begin_cell(self, parent_header):
+        """Starts associating output with the cell `parent_header`."""
+        with self._lock:
+            self._drain()
+            self._flush()
+            self.parent_header = parent_header
+            self.had_stdout = False
+            self.sent_bytes = 0
+
+    def end_cell(self):
+        """Sends all output that the current cell produced."""
+        self.flush()
+
+    def flush(self):
+        """Sends all output that has arrived so far."""
+        with self._lock:
+            self._drain()
+            self._flush()
+
+    def set_suppressed(self, suppressed):
+        """While suppressed, output is read and thrown away."""
+        with self._lock:
+            self._drain()
+            self._flush()
+            self.suppressed = suppressed
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+    def _read(self, name):
+        BUFFER_SIZE = 1000
+        if name == 'stdout':
+            return self.kernel.process.GetSTDOUT(BUFFER_SIZE)
+        return self.kernel.process.GetSTDERR(BUFFER_SIZE)
+
+    def _drain(self):
+        for name in ('stdout', 'stderr'):
+            while True:
+                data = self._read(name)
+                if len(data) == 0:
+                    break
+                if self._first_buffered_time is None:
+                    self._first_buffered_time = time.time()
+                self._buffers[name].append(data)
+                self._buffered_size += len(data)
+                self.received_bytes += len(data)
+
+    def _flush(self):
+        for name in ('stdout', 'stderr'):
+            text = ''.join(self._buffers[name])
+            self._buffers[name] = []
+            if len(text) == 0 or self.suppressed:
+                continue
             self.had_stdout = True
-            self.kernel.send_response(self.kernel.iopub_socket, 'stream', {
-                'name': 'stdout',
-                'text': stdout
-            })
+            self.sent_bytes += len(text.encode('utf8'))
+            self.kernel.session.send(self.kernel.iopub_socket, 'stream', {
+                'name': name,
+                'text': text
+            }, parent=self.parent_header, ident=self.kernel._topic('stream'))
+        self._buffered_size = 0
+        self._first_buffered_time = None
+
+    def _should_flush(self, more_pending):
+        if self._buffered_size == 0:
+            return False
+        if not more_pending:
+            return True
+        return self._buffered_size >= self.FLUSH_SIZE or \
+                time.time() - self._first_buffered_time >= self.FLUSH_INTERVAL
+
+    def _wait_for_output(self):
+        """Blocks until there might be output. Returns False on timeout."""
+        if not self.use_events:
+            return not self.stop_event.wait(self.POLL_INTERVAL)
+        event = lldb.SBEvent()
+        return self.listener.WaitForEvent(self.EVENT_WAIT_SECONDS, event)
+
+    def _has_pending_event(self):
+        if not self.use_events:
+            return False
+        event = lldb.SBEvent()
+        return self.listener.PeekAtNextEvent(event)
 
     def run(self):
         try:
+            while not self.stop_event.is_set():
+                if not self._wait_for_output():
+                    continue
+                with self._lock:
+                    self._drain()
+                    if self._should_flush(self._has_pending_event()):
+                        self._flush()
+            self.end_cell()
+        except Exception as e:
+            self.kernel.log.error('Exception in StdoutHandler: %s' % str(e))
+
+
+class DisplayChannel(threading.Thread):
+    """Forwards display messages from the Swift process as soon as they are
+    sent, even while a cell is still executing.
+
+    The channel is a named pipe. The REPL process finds it through the
+    `SWIFT_KERNEL_DISPLAY_CHANNEL` environment variable, and
+    `swift_shell.CapturingSocket` writes each display message into it as
+    a frame: an Int64 part count, followed by an Int64 length and the bytes
+    of each part. The pipe's buffer is small, so a process that produces
+    messages faster than the kernel sends them simply waits.
+
+    After a cell executes, `flush()` sends the rest of the cell's messages,
+    so that they all arrive before the cell's reply. Stdout that arrived
+    before a message is sent before it, so output keeps its order.
+
+    When messages arrive faster than they are sent, the ones that the client
+    would never show are dropped, as CapturingSocket does when there is no
+    channel: output followed by a `clear_output`, and display updates
+    followed by another update of the same display.
+    """
+
+    # How long to block waiting for messages, in seconds. This only bounds
+    # how long `stop()` takes to take effect.
+    WAIT_SECONDS = 1
+
+    READ_SIZE = 64 * 1024
+
+    # Messages whose output a `clear_output` clears.
+    CLEARED_MSG_TYPES = set([
+        'clear_output', 'display_data', 'execute_result', 'stream'])
+
+    def __init__(self):
+        super(DisplayChannel, self).__init__()
+        self.daemon = True
+        self.kernel = None
+        self.stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._buffer = bytearray()
+        self.suppressed = False
+
+        self.directory = tempfile.mkdtemp(prefix='swift-kernel-')
+        self.path = os.path.join(self.directory, 'display')
+        os.mkfifo(self.path, 0o600)
+        self._read_fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+
+        # Keep a writer open ourselves, so that the pipe does not report EOF
+        # whenever there is no REPL process.
+        self._write_fd = os.open(self.path, os.O_WRONLY)
+
+    def attach(self, kernel):
+        """Starts sending messages to `kernel`'s client."""
+        self.kernel = kernel
+        self.start()
+
+    def flush(self):
+        """Sends all messages that have been written so far."""
+        with self._lock:
+            self._read_available()
+
+    def set_suppressed(self, suppressed):
+        """While suppressed, messages are read and thrown away."""
+        with self._lock:
+            self._read_available()
+            self.suppressed = suppressed
+
+    def discard(self):
+        """Throws away everything in the pipe, including partial messages
+        from a REPL process that has been killed."""
+        with self._lock:
+            while True:
+                try:
+                    if len(os.read(self._read_fd, self.READ_SIZE)) == 0:
+                        break
+                except BlockingIOError:
+                    break
+            self._buffer = bytearray()
+
+    def stop(self):
+        if self.is_alive():
+            self.stop_event.set()
+            self.join()
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+        os.unlink(self.path)
+        os.rmdir(self.directory)
+
+    def _read_available(self):
+        while True:
+            try:
+                data = os.read(self._read_fd, self.READ_SIZE)
+            except BlockingIOError:
+                break
+            if len(data) == 0:
+                break
+            self._buffer += data
+        self._send_messages()
+
+    def _next_message(self, view, position):
+        """Returns `(parts, end)` for the frame at `position`, or None if the
+        whole frame has not arrived yet."""
+        int64 = struct.Struct('=q')
+        if position + int64.size > len(view):
+            return None
+        part_count = int64.unpack_from(view, position)[0]
+        position += int64.size
+        parts = []
+        for _ in range(part_count):
+            if position + int64.size > len(view):
+                return None
+            count = int64.unpack_from(view, position)[0]
+            position += int64.size
+            if position + count > len(view):
+                return None
+            parts.append(bytes(view[position:position + count]))
+            position += count
+        return parts, position
+
+    def _send_messages(self):
+        messages = []
+        position = 0
+        with memoryview(self._buffer) as view:
             while True:
-                if self.stop_event.wait(0.1):
+                frame = self._next_message(view, position)
+                if frame is None:
                     break
-                self._get_and_send_stdout()
-            self._get_and_send_stdout()
+                messages.append(frame[0])
+                position = frame[1]
+        del self._buffer[:position]
+        if len(messages) == 0 or self.suppressed:
+            return
+        if len(messages) > 1:
+            messages = self._coalesce(messages)
+
+        self.kernel.stdout_handler.flush()
+        for message in messages:
+            self.kernel.iopub_socket.send_multipart(message)
+
+        # The execution thread may finish the cell's statistics at any time.
+        cell_stats = self.kernel.cell_stats
+        if cell_stats is not None:
+            cell_stats['display_messages'] += len(messages)
+            cell_stats['display_bytes'] += position
+
+    @classmethod
+    def _coalesce(cls, messages):
+        """Returns `messages` without the ones that later ones replace."""
+        kept = []
+        cleared = False
+        updated_display_ids = set()
+        for message in reversed(messages):
+            delimiter = message.index(b'<IDS|MSG>')
+            msg_type = json.loads(
+                    message[delimiter + 2].decode('utf8'))['msg_type']
+            if cleared and msg_type in cls.CLEARED_MSG_TYPES:
+                continue
+            if msg_type == 'clear_output':
+                cleared = True
+            elif msg_type == 'update_display_data':
+                content = json.loads(message[delimiter + 5].decode('utf8'))
+                display_id = content.get('transient', {}).get('display_id')
+                if display_id in updated_display_ids:
+                    continue
+                updated_display_ids.add(display_id)
+            kept.append(message)
+        kept.reverse()
+        return kept
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                readable, _, _ = select.select(
+                        [self._read_fd], [], [], self.WAIT_SECONDS)
+                if readable:
+                    with self._lock:
+                        self._read_available()
         except Exception as e:
-            self.kernel.log.error('Exception in StdoutHandler: %s' % str(e))
+            self.kernel.log.error('Exception in DisplayChannel: %s' % str(e))
+
+
+class CellWatchdog(threading.Thread):
+    """Measures the Swift process's resources around and during each cell,
+    and interrupts cells that exceed their budgets.
+
+    The budgets, in `kernel.limits`, are:
+
+    - 'time': seconds since the cell started, including compilation.
+    - 'cpu': seconds of CPU time that the Swift process used during the
+      cell.
+    - 'memory': bytes of resident memory. This limit is soft: a cell is
+      interrupted when the process's RSS is over the limit and has grown
+      since the cell started, so that cells can still run (and free memory)
+      after one has been interrupted.
+
+    A `%%limit` cell can change the current cell's budgets. Cells are
+    interrupted through the same path as SIGINT, and interrupted again every
+    `REINTERRUPT_SECONDS` in case the first interrupt arrived while the
+    process was not running (for example, during compilation).
+
+    Memory and CPU time are read from /proc/<pid>. Where there is no /proc,
+    they are not measured and their budgets are not enforced.
+    """
+
+    # Seconds between samples while a cell executes.
+    SAMPLE_INTERVAL = 0.1
+
+    REINTERRUPT_SECONDS = 1
+
+    # The budgets, and the environment variables that set their defaults.
+    BUDGETS = collections.OrderedDict([
+        ('time', 'SWIFT_KERNEL_TIME_LIMIT'),
+        ('cpu', 'SWIFT_KERNEL_CPU_LIMIT'),
+        ('memory', 'SWIFT_KERNEL_MEMORY_LIMIT'),
+    ])
+
+    SIZE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', re.I)
+    DURATION_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*(s|m|min|h)?\s*$', re.I)
+
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+    def __init__(self, kernel):
+        super(CellWatchdog, self).__init__()
+        self.daemon = True
+        self.kernel = kernel
+        self.stop_event = threading.Event()
+        self._cell_event = threading.Event()
+
+        # Protects the current cell's budgets and measurements below.
+        self._lock = threading.Lock()
+        self._cell_limits = {}
+        self._start_time = None
+        self._start = None
+        self._peak_rss = None
+        self._exceeded = None
+        self._last_interrupt_time = None
+
+    @classmethod
+    def parse_size(cls, text):
+        """Parses a size like "4G" or "512MiB" into bytes."""
+        match = cls.SIZE_RE.match(text)
+        if match is None:
+            raise ValueError('Invalid memory size: %s' % text)
+        scale = 1024 ** ' KMGT'.index(match.group(2).upper() or ' ')
+        return int(float(match.group(1)) * scale)
+
+    @classmethod
+    def parse_duration(cls, text):
+        """Parses a duration like "90", "90s", "30m" or "2h" into seconds."""
+        match = cls.DURATION_RE.match(text)
+        if match is None:
+            raise ValueError('Invalid duration: %s' % text)
+        scale = {'': 1, 's': 1, 'm': 60, 'min': 60, 'h': 3600}[
+                (match.group(2) or '').lower()]
+        return float(match.group(1)) * scale
+
+    @classmethod
+    def parse_limit(cls, budget, text):
+        """Parses the limit `text` for `budget`. "none" means no limit."""
+        if text.strip().lower() == 'none':
+            return None
+        if budget == 'memory':
+            return cls.parse_size(text)
+        return cls.parse_duration(text)
+
+    @classmethod
+    def limits_from_environment(cls, environment):
+        return collections.OrderedDict([
+            (budget, cls.parse_limit(budget, environment[variable])
+                     if environment.get(variable) else None)
+            for budget, variable in cls.BUDGETS.items()])
+
+    def sample(self):
+        """Returns the process's `rss` and `process_peak` RSS in bytes and its
+        `cpu` time in seconds, or None."""
+        pid = self.kernel.process.GetProcessID()
+        try:
+            with open('/proc/%d/status' % pid) as f:
+                status = f.read()
+            with open('/proc/%d/stat' % pid) as f:
+                stat = f.read()
+        except (IOError, OSError):
+            return None
+        values = dict(re.findall(r'^(VmRSS|VmHWM):\s*(\d+)', status,
+                                 re.MULTILINE))
+        # The fields after the command name, starting with the state.
+        fields = stat[stat.rfind(')') + 2:].split()
+        if len(values) < 2 or len(fields) < 13:
+            return None
+        return {
+            'rss': int(values['VmRSS']) * 1024,
+            'process_peak': int(values['VmHWM']) * 1024,
+            'cpu': (int(fields[11]) + int(fields[12])) / self.CLOCK_TICKS,
+        }
+
+    def begin_cell(self):
+        sample = self.sample()
+        with self._lock:
+            self._cell_limits = dict(self.kernel.limits)
+            self._start_time = time.time()
+            self._start = sample
+            self._peak_rss = None if sample is None else sample['rss']
+            self._exceeded = None
+            self._last_interrupt_time = None
+            self._cell_event.set()
+
+    def set_cell_limits(self, limits):
+        """Changes budgets of the current cell."""
+        with self._lock:
+            self._cell_limits.update(limits)
+
+    def end_cell(self):
+        """Returns the current cell's statistics."""
+        with self._lock:
+            self._cell_event.clear()
+        sample = self.sample()
+        with self._lock:
+            start = self._start
+            if sample is None or start is None:
+                rss = delta = cpu = None
+            else:
+                rss = sample['rss']
+                delta = rss - start['rss']
+                cpu = sample['cpu'] - start['cpu']
+                self._peak_rss = max(self._peak_rss, rss)
+            return {
+                'rss': rss,
+                'delta': delta,
+                'peak': self._peak_rss,
+                'process_peak': None if sample is None else
+                                sample['process_peak'],
+                'cpu': cpu,
+                'exceeded': self._exceeded,
+            }
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _exceeded_budget(self, now, sample):
+        """Returns `(budget, value)` for a budget that the current cell has
+        exceeded, or None."""
+        limits = self._cell_limits
+        if limits.get('time') is not None and \
+                now - self._start_time > limits['time']:
+            return 'time', now - self._start_time
+        if sample is None or self._start is None:
+            return None
+        cpu = sample['cpu'] - self._start['cpu']
+        if limits.get('cpu') is not None and cpu > limits['cpu']:
+            return 'cpu', cpu
+        rss = sample['rss']
+        if limits.get('memory') is not None and rss > limits['memory'] and \
+                rss > self._start['rss']:
+            return 'memory', rss
+        return None
+
+    def _check(self):
+        sample = self.sample()
+        now = time.time()
+        with self._lock:
+            # Do not interrupt a cell that has already finished.
+            if not self._cell_event.is_set():
+                return
+            if sample is not None and self._peak_rss is not None:
+                self._peak_rss = max(self._peak_rss, sample['rss'])
+            if self._exceeded is None:
+                exceeded = self._exceeded_budget(now, sample)
+                if exceeded is not None:
+                    budget, value = exceeded
+                    self._exceeded = {
+                        'budget': budget,
+                        'value': value,
+                        'limit': self._cell_limits[budget],
+                    }
+            if self._exceeded is not None and (
+                    self._last_interrupt_time is None or
+                    now - self._last_interrupt_time >=
+                    self.REINTERRUPT_SECONDS):
+                self._last_interrupt_time = now
+                self.kernel.sigint_handler.interrupt()
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                if self._cell_event.wait(1):
+                    self._check()
+                    self.stop_event.wait(self.SAMPLE_INTERVAL)
+        except Exception as e:
+            self.kernel.log.error('Exception in CellWatchdog: %s' % str(e))
+
+
+class KernelMetrics:
+    """Exports the kernel's statistics to Prometheus over HTTP.
+
+    Metrics are off unless `SWIFT_KERNEL_METRICS_PORT` is set, to a port or
+    to a range of ports like "9100-9199". The server listens on the first
+    free port in the range, so that several kernels on a machine can export
+    metrics, and `kernel_info` reports it as `metrics_port`. It listens on
+    `SWIFT_KERNEL_METRICS_ADDRESS`, which is the loopback interface unless
+    set otherwise.
+    """
+
+    DEFAULT_ADDRESS = '127.0.0.1'
+
+    # Histogram buckets, in seconds. Phases take anywhere from microseconds
+    # to hours.
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+               0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, float('inf'))
+
+    def __init__(self, kernel, ports, address=DEFAULT_ADDRESS):
+        import prometheus_client
+
+        self.kernel = kernel
+        self.registry = prometheus_client.CollectorRegistry()
+        prometheus_client.ProcessCollector(registry=self.registry)
+
+        def histogram(name, documentation, labels=()):
+            return prometheus_client.Histogram(
+                    name, documentation, labels, buckets=self.BUCKETS,
+                    registry=self.registry)
+
+        def counter(name, documentation, labels=()):
+            return prometheus_client.Counter(
+                    name, documentation, labels, registry=self.registry)
+
+        def gauge(name, documentation, labels=()):
+            return prometheus_client.Gauge(
+                    name, documentation, labels, registry=self.registry)
+
+        self.cell_seconds = histogram(
+                'swift_kernel_cell_seconds', 'Time to execute a cell')
+        self.cell_phase_seconds = histogram(
+                'swift_kernel_cell_phase_seconds',
+                'Time spent in each phase of executing a cell', ['phase'])
+        self.cells = counter(
+                'swift_kernel_cells',
+                'Cells executed, by outcome: ok, compile_error, '
+                'runtime_error, limit_exceeded or kernel_error', ['outcome'])
+        self.stdout_bytes = counter(
+                'swift_kernel_stdout_bytes', 'Bytes of stdout sent')
+        self.display_bytes = counter(
+                'swift_kernel_display_bytes', 'Bytes of display messages sent')
+        self.display_messages = counter(
+                'swift_kernel_display_messages', 'Display messages sent')
+        self.completion_seconds = histogram(
+                'swift_kernel_completion_seconds',
+                'Time to answer a completion request')
+        self.startup_seconds = gauge(
+                'swift_kernel_startup_seconds',
+                'Time spent in each phase of the last (re)start of the Swift '
+                'process', ['phase'])
+        self.restarts = counter(
+                'swift_kernel_restarts', 'Restarts of the Swift process')
+        self.inferior_rss_bytes = gauge(
+                'swift_kernel_inferior_rss_bytes',
+                'Resident memory of the Swift process')
+        self.inferior_rss_bytes.set_function(
+                lambda: self._inferior_sample('rss'))
+        self.inferior_cpu_seconds = gauge(
+                'swift_kernel_inferior_cpu_seconds',
+                'CPU time used by the Swift process')
+        self.inferior_cpu_seconds.set_function(
+                lambda: self._inferior_sample('cpu'))
+
+        self.port = self._start_server(prometheus_client, ports, address)
+        self.observe_startup(kernel.startup_timings)
+
+    @staticmethod
+    def parse_ports(text):
+        """Parses "9100" or "9100-9199" into a list of ports."""
+        first, _, last = text.strip().partition('-')
+        return list(range(int(first), int(last or first) + 1))
+
+    def _start_server(self, prometheus_client, ports, address):
+        for port in ports:
+            try:
+                prometheus_client.start_http_server(port, address,
+                                                    self.registry)
+                return port
+            except (IOError, OSError):
+                continue
+        raise Exception('No free port for metrics in %d-%d' % (
+                ports[0], ports[-1]))
+
+    def _inferior_sample(self, name):
+        sample = self.kernel.watchdog.sample()
+        return float('nan') if sample is None else sample[name]
+
+    def observe_startup(self, startup_timings, restart=False):
+        for phase, seconds in startup_timings.items():
+            self.startup_seconds.labels(phase).set(seconds)
+        if restart:
+            self.restarts.inc()
+
+    def observe_cell(self, stats):
+        """Records the finished statistics of a cell."""
+        self.cell_seconds.observe(stats['total'])
+        for phase, seconds in stats['phases'].items():
+            self.cell_phase_seconds.labels(phase).observe(seconds)
+        self.cells.labels(stats['outcome']).inc()
+        self.stdout_bytes.inc(stats['stdout_bytes'])
+        self.display_bytes.inc(stats['display_bytes'])
+        self.display_messages.inc(stats['display_messages'])
+
+
+class LoopStream:
+    """Wraps a shell stream so that threads other than the kernel's main
+    thread can send on it. (ZMQStreams may only be used from their IOLoop's
+    thread.)"""
+    def __init__(self, stream, loop):
+        self.stream = stream
+        self.loop = loop
+
+    def send_multipart(self, msg_parts, **kwargs):
+        self.loop.add_callback(
+                lambda: self.stream.send_multipart(msg_parts, **kwargs))
+
+
+class ExecutionThread(threading.Thread):
+    """Runs execute requests one at a time, in the order they arrive.
+
+    Executing a cell can take hours. Running it here keeps the kernel's main
+    thread free to answer other requests in the meantime.
+    """
+    def __init__(self, kernel):
+        super(ExecutionThread, self).__init__()
+        self.daemon = True
+        self.kernel = kernel
+        self.requests = queue.Queue()
+        self.loop = ioloop.IOLoop.instance()
+
+        # The msg_ids of the requests that are queued or executing.
+        self.pending = set()
+
+        # Whether a cell is executing right now.
+        self.executing = False
+
+    def submit(self, stream, ident, parent):
+        self.pending.add(parent['header']['msg_id'])
+        self.requests.put((LoopStream(stream, self.loop), ident, parent))
+
+    def abort_queued(self):
+        """Replies 'aborted' to all the requests that are still queued."""
+        while True:
+            try:
+                stream, ident, parent = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            self.kernel.session.send(stream, 'execute_reply',
+                                     {'status': 'aborted'}, parent,
+                                     metadata={'status': 'aborted'},
+                                     ident=ident)
+            self._finish(parent)
+
+    def _finish(self, parent):
+        self.pending.discard(parent['header']['msg_id'])
+        self.kernel._publish_status('idle', parent)
+
+    def run(self):
+        while True:
+            stream, ident, parent = self.requests.get()
+            self.kernel.set_parent(ident, parent)
+            self.executing = True
+            try:
+                self.kernel.execute_request_now(stream, ident, parent)
+            except Exception as e:
+                self.kernel.log.error(
+                        'Exception in ExecutionThread: %s' % str(e))
+            finally:
+                self.executing = False
+                self._finish(parent)
+
+
+class IncludeResolver:
+    """Finds and reads the files named by `%include` directives.
+
+    The first include path containing a file wins. Resolved paths are
+    remembered, and file contents are cached until the file's mtime or size
+    changes, so re-running a cell does not hit the filesystem again.
+
+    A file containing a line `%pragma once` is only included once per
+    session (or again after it changes on disk).
+    """
+
+    PRAGMA_ONCE_RE = re.compile(r'^\s*%pragma once\s*$', re.MULTILINE)
+
+    def __init__(self, include_paths):
+        self.include_paths = include_paths
+        self._resolved_paths = {}
+        self._cache = {}
+
+    def resolve(self, name):
+        """Returns the path of the file called `name`, or None."""
+        path = self._resolved_paths.get(name)
+        if path is not None and os.path.isfile(path):
+            return path
+        for include_path in self.include_paths:
+            path = os.path.join(include_path, name)
+            if os.path.isfile(path):
+                self._resolved_paths[name] = path
+                return path
+        return None
+
+    def read(self, path):
+        """Returns `(key, code, once)` for the file at `path`.
+
+        `key` identifies this version of the file and `once` is whether the
+        file has a `%pragma once` line."""
+        stat = os.stat(path)
+        key = (path, stat.st_mtime, stat.st_size)
+        cached = self._cache.get(path)
+        if cached is not None and cached[0] == key:
+            return cached
+
+        with open(path, 'r') as f:
+            code = f.read()
+        code, pragma_count = self.PRAGMA_ONCE_RE.subn('', code)
+        cached = (key, code, pragma_count > 0)
+        self._cache[path] = cached
+        return cached
+
+
+# Matches declarations, capturing the kind of declaration and the declared
+# name. Nested declarations match too, so callers must not assume that every
+# match is at the top level of a cell.
+DECLARATION_RE = re.compile(
+    r'^\s*(?:(?:public|private|fileprivate|internal|open|final|static|'
+    r'indirect|mutating|@\w+(?:\([^)]*\))?)\s+)*'
+    r'(let|var|func|struct|class|enum|protocol|typealias|extension)\s+'
+    r'([A-Za-z_]\w*)', re.MULTILINE)
+
+
+class SessionJournal:
+    """An append-only record of the cells that have executed successfully in
+    the current REPL process, so that they can be replayed into a new one."""
+
+    def __init__(self):
+        # A list of (execution_count, preprocessed code, include keys).
+        self.entries = []
+
+    def append(self, execution_count, code, include_keys):
+        self.entries.append((execution_count, code, include_keys))
+
+    def clear(self):
+        self.entries = []
+
+    def batches(self):
+        """Groups consecutive entries into batches that can be executed as
+        one expression.
+
+        The REPL lets a cell redeclare names that earlier cells declared, but
+        a single expression cannot declare a name twice. So a batch ends just
+        before an entry that declares a name that the batch already
+        declares."""
+        batches = []
+        batch = []
+        batch_declarations = set()
+        for entry in self.entries:
+            declarations = set([
+                name if kind != 'extension' else 'extension ' + name
+                for kind, name in DECLARATION_RE.findall(entry[1])])
+            if batch and not declarations.isdisjoint(batch_declarations):
+                batches.append(batch)
+                batch = []
+                batch_declarations = set()
+            batch.append(entry)
+            batch_declarations |= declarations
+        if batch:
+            batches.append(batch)
+        return batches
+
+
+class CompiledCellCache:
+    """Remembers compiled versions of cells that declare nothing, so that
+    running such a cell again does not invoke the Swift compiler.
+
+    When a cell that declares nothing runs successfully without a value, it
+    is remembered. If it runs again, the kernel compiles it into a global
+    `@convention(c)` closure, and from then on runs it by calling the
+    closure's function pointer in a C expression, which is much cheaper to
+    compile. (Cells that evaluate to a value are not cached, because the
+    closure would throw the value away.)
+
+    Entries are keyed by the preprocessed code and by `generation`, which
+    changes whenever a cell declares something, because a name that a
+    cached cell uses might then refer to the new declaration. A cell that
+    cannot be compiled into a closure, for example because it uses `try`
+    outside a `do`, is remembered too, and then always runs normally.
+    """
+
+    # Maximum number of cells to remember.
+    MAX_ENTRIES = 256
+
+    # Statements that change what later code means, besides the declarations
+    # that DECLARATION_RE matches. A top-level `guard let` binds names for the
+    # rest of the session.
+    DECLARES_RE = re.compile(
+        r'^\s*(?:@\w+\s+)*(?:(?:import|actor|precedencegroup|'
+        r'(?:prefix\s+|postfix\s+|infix\s+)?operator)\b|(?:let|var)\s*\(|'
+        r'guard\b[^{]*\b(?:let|var)\b)',
+        re.MULTILINE)
+
+    def __init__(self):
+        self.generation = 0
+
+        # Maps (code, generation) to None for cells that have run once, to
+        # the closure's address for compiled cells, and to False for cells
+        # that cannot be compiled.
+        self._entries = collections.OrderedDict()
+
+    @classmethod
+    def declares(cls, code):
+        """Returns whether `code` declares something at the top level.
+        Declarations inside braces are local, so they do not count."""
+        depth = 0
+        for line in code.split('\n'):
+            if depth == 0 and (DECLARATION_RE.match(line) is not None or
+                               cls.DECLARES_RE.match(line) is not None):
+                return True
+            code_only = SymbolIndex.IGNORED_RE.sub('', line)
+            depth = max(0, depth + code_only.count('{') -
+                           code_only.count('}'))
+        return False
+
+    def invalidate(self):
+        """Forgets all cells, because declarations have changed."""
+        self.generation += 1
+        self._entries.clear()
+
+    def lookup(self, code):
+        """Returns the closure address for `code`, None if it should run
+        normally, or True if it should be compiled now."""
+        key = (code, self.generation)
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        entry = self._entries[key]
+        if entry is None:
+            return True
+        return entry or None
+
+    def _set(self, code, entry):
+        self._entries[(code, self.generation)] = entry
+        while len(self._entries) > self.MAX_ENTRIES:
+            self._entries.popitem(last=False)
+
+    def ran(self, code):
+        """Records that `code` ran successfully without a value."""
+        if (code, self.generation) not in self._entries:
+            self._set(code, None)
+
+    def compiled(self, code, address):
+        """Records the closure address for `code`, or None if it could not
+        be compiled."""
+        self._set(code, address or False)
+
+
+class CodeCompleter:
+    """Completes code using `SBTarget.CompleteCode`.
+
+    CompleteCode is slow, so results are cached. Member completions (after a
+    '.') are keyed by the code before the identifier being typed. While the
+    user keeps typing that identifier, the cached results are narrowed down
+    without calling CompleteCode again. This cache is cleared whenever a cell
+    finishes executing, because that can declare new members.
+
+    Completions of other identifiers do not depend on the code before them, so
+    they are keyed by the identifier's first letter. Names that cells declare
+    also come from the kernel's SymbolIndex, but names that they import do
+    not, so this cache is cleared whenever a cell declares or imports
+    something.
+
+    CompleteCode runs on a background thread. If it does not finish within
+    `deadline` seconds, the request gets an empty reply, and the results are
+    cached for the next request when they arrive.
+
+    CompleteCode needs the debugger, so it cannot run while a cell executes.
+    In between `pause()` and `resume()`, only cached results are available.
+    """
+
+    IDENTIFIER_SUFFIX_RE = re.compile(r'[A-Za-z_0-9]*$')
+    MEMBER_CONTEXT_RE = re.compile(r'\.\s*$')
+
+    # Maximum number of member contexts to cache results for.
+    CACHE_SIZE = 64
+
+    def __init__(self, kernel, deadline=0.5):
+        self.kernel = kernel
+        self.deadline = deadline
+
+        # Maps code before the member being completed to the list of
+        # identifiers that can complete it.
+        self._cache = collections.OrderedDict()
+
+        # Maps first letters to the identifiers that start with them.
+        self._identifier_cache = {}
+
+        self._lock = threading.Lock()
+        self._in_flight = None
+        self._paused = False
+
+    def complete(self, code_to_cursor):
+        """Returns `(prefix, matches)`, where `prefix` is the part of the
+        identifier before the cursor, and `matches` are the identifiers that
+        can replace it. `matches` is None if the completer is paused and has
+        no cached results."""
+        prefix = self.IDENTIFIER_SUFFIX_RE.search(code_to_cursor).group(0)
+        context = code_to_cursor[:len(code_to_cursor) - len(prefix)]
+        if self.MEMBER_CONTEXT_RE.search(context) is not None:
+            # Ask for all members, so that the results can be narrowed down
+            # to any identifier typed after the same context.
+            cache, key, query = self._cache, context, context
+        elif len(prefix) > 0:
+            cache, key, query = self._identifier_cache, prefix[0], prefix[0]
+        else:
+            return prefix, []
+
+        matches = self._lookup(cache, key, prefix)
+        if matches is not None:
+            return prefix, matches
+
+        with self._lock:
+            if self._paused:
+                return prefix, None
+            if self._in_flight is None or not self._in_flight.is_alive():
+                self._in_flight = threading.Thread(
+                    target=self._complete_code, args=(query, cache, key))
+                self._in_flight.daemon = True
+                self._in_flight.start()
+            in_flight = self._in_flight
+        in_flight.join(self.deadline)
+
+        matches = self._lookup(cache, key, prefix)
+        if matches is not None:
+            return prefix, matches
+        return prefix, []
+
+    def pause(self):
+        """Stops calling CompleteCode, and waits for any running CompleteCode
+        to finish, so that it does not use LLDB at the same time as cell
+        execution."""
+        with self._lock:
+            self._paused = True
+            in_flight = self._in_flight
+            self._in_flight = None
+        if in_flight is not None:
+            in_flight.join()
+
+    def resume(self):
+        """Clears the member cache and allows calling CompleteCode again."""
+        with self._lock:
+            self._cache.clear()
+            self._paused = False
+
+    def forget_identifiers(self):
+        """Clears the identifier cache. Called when a cell declares or
+        imports something."""
+        with self._lock:
+            self._identifier_cache.clear()
+
+    def reset(self):
+        """Clears all cached results. Called when the REPL process restarts."""
+        with self._lock:
+            self._cache.clear()
+            self._identifier_cache.clear()
+
+    def _lookup(self, cache, key, prefix):
+        with self._lock:
+            candidates = cache.get(key)
+            if candidates is None:
+                return None
+            if cache is self._cache:
+                cache.move_to_end(key)
+        return [candidate for candidate in candidates
+                if candidate.startswith(prefix)]
+
+    def _complete_code(self, code_to_cursor, cache, key):
+        try:
+            kernel = self.kernel
+            sbresponse = kernel.target.CompleteCode(
+                kernel.swift_language, None, code_to_cursor)
+            prefix = sbresponse.GetPrefix()
+            candidates = []
+            for i in range(sbresponse.GetNumMatches()):
+                sbmatch = sbresponse.GetMatchAtIndex(i)
+                insertable_match = prefix + sbmatch.GetInsertable()
+                if insertable_match.startswith("_"):
+                    continue
+                candidates.append(insertable_match)
+            with self._lock:
+                cache[key] = candidates
+                if cache is self._cache:
+                    while len(cache) > self.CACHE_SIZE:
+                        cache.popitem(last=False)
+        except Exception as e:
+            self.kernel.log.error('Exception in CompleteCode: %s' % str(e))
+
+
+# A declaration in a SymbolIndex. `signature` is the declaration's first line.
+Symbol = collections.namedtuple('Symbol', [
+    'kind',
+    'name',
+    'signature',
+    'file_name',
+    'line',
+])
+
+
+class SymbolIndex:
+    """Indexes the top-level declarations in the cells that have executed
+    successfully, including the files that they included.
+
+    The index answers inspect requests and completes identifiers without
+    touching LLDB, so it also works while a cell executes. When a name is
+    declared again, the latest declaration wins.
+    """
+
+    SOURCE_LOCATION_RE = re.compile(
+            r'^\s*#sourceLocation\(file: "([^"]*)", line: (\d+)\)\s*$')
+
+    # String literals and comments, which are ignored when counting braces.
+    IGNORED_RE = re.compile(r'"(?:[^"\\]|\\.)*"|//.*$')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._symbols = {}
+        self._sorted_names = []
+
+    def add(self, code, file_name):
+        """Indexes the declarations in `code`, which starts at line 1 of
+        `file_name` and may contain `#sourceLocation` directives."""
+        symbols = []
+        line_number = 1
+        depth = 0
+        for line in code.split('\n'):
+            location_match = self.SOURCE_LOCATION_RE.match(line)
+            if location_match is not None:
+                file_name = location_match.group(1)
+                line_number = int(location_match.group(2))
+                continue
+            if depth == 0:
+                declaration_match = DECLARATION_RE.match(line)
+                if declaration_match is not None and \
+                        declaration_match.group(1) != 'extension':
+                    kind, name = declaration_match.groups()
+                    signature = line.strip()
+                    if signature.endswith('{'):
+                        signature = signature[:-1].rstrip()
+                    symbols.append(
+                            Symbol(kind, name, signature, file_name,
+                                   line_number))
+            code_only = self.IGNORED_RE.sub('', line)
+            depth = max(0, depth + code_only.count('{') -
+                           code_only.count('}'))
+            line_number += 1
+
+        if len(symbols) == 0:
+            return
+        with self._lock:
+            for symbol in symbols:
+                self._symbols[symbol.name] = symbol
+            self._sorted_names = sorted(self._symbols)
+
+    def clear(self):
+        with self._lock:
+            self._symbols = {}
+            self._sorted_names = []
+
+    def lookup(self, name):
+        """Returns the Symbol called `name`, or None."""
+        with self._lock:
+            return self._symbols.get(name)
+
+    def complete(self, prefix):
+        """Returns the indexed names that start with `prefix`, in order."""
+        with self._lock:
+            names = self._sorted_names
+        matches = []
+        for name in names[bisect.bisect_left(names, prefix):]:
+            if not name.startswith(prefix):
+                break
+            matches.append(name)
+        return matches
+
+
+class ResultRenderer:
+    """Renders the values of expression cells as text, within limits.
+
+    LLDB's description of a value includes all of its children, so for a
+    large array or a deeply nested value it is enormous and slow to build.
+    Values with at most `SMALL_VALUE_CHILDREN` children in total still use
+    that description. Larger values are rendered from their children:
+    at most `MAX_CHILDREN` children per value, `MAX_DEPTH` levels deep, and
+    `MAX_CHARS` characters in total. The rendering says how many elements
+    there are, and how to see more of them (with `%more`). Values without
+    children, like long strings, show the first `MAX_CHARS` characters of
+    their description.
+    """
+
+    SMALL_VALUE_CHILDREN = 256
+    MAX_CHILDREN = 100
+    MAX_DEPTH = 3
+    MAX_CHARS = 16 * 1024
+
+    def render(self, value, execution_count, start=0):
+        """Returns `(text, truncated)` for the SBValue `value`, which is the
+        result of cell `execution_count`. `start` is the index of the first
+        child to show."""
+        if start == 0 and self._is_small(value):
+            description = value.description
+            if len(description) <= self.MAX_CHARS:
+                return description, False
+            if value.GetNumChildren(1) == 0:
+                return '%s\n... (showing %d of %d characters)\n' % (
+                        description[:self.MAX_CHARS], self.MAX_CHARS,
+                        len(description)), False
+        return self._render_children(value, execution_count, start), True
+
+    def _is_small(self, value):
+        budget = self.SMALL_VALUE_CHILDREN
+        values = [value]
+        while len(values) > 0:
+            value = values.pop()
+            count = value.GetNumChildren(budget + 1)
+            budget -= count
+            if budget < 0:
+                return False
+            values += [value.GetChildAtIndex(i) for i in range(count)]
+        return True
+
+    def _render_children(self, value, execution_count, start):
+        count = value.GetNumChildren()
+        end = min(count, start + self.MAX_CHILDREN)
+        lines = ['%s with %d %s' % (
+                value.GetTypeName(), count,
+                'child' if count == 1 else 'children')]
+        size = len(lines[0])
+
+        def add_line(line):
+            nonlocal size
+            remaining = self.MAX_CHARS - size
+            if remaining <= 0:
+                return False
+            if len(line) > remaining:
+                lines.append(line[:remaining] + '...')
+                size = self.MAX_CHARS
+                return False
+            lines.append(line)
+            size += len(line) + 1
+            return True
+
+        def add_value(child, depth):
+            indent = '  ' * depth
+            name = child.GetName() or ''
+            summary = child.GetSummary() or child.GetValue()
+            child_count = child.GetNumChildren(self.MAX_CHILDREN + 1)
+            if summary is not None or child_count == 0:
+                return add_line('%s%s = %s' % (indent, name, summary or ''))
+            if depth >= self.MAX_DEPTH:
+                return add_line('%s%s: %s with %s children' % (
+                        indent, name, child.GetTypeName(),
+                        '%d+' % self.MAX_CHILDREN
+                        if child_count > self.MAX_CHILDREN
+                        else child_count))
+            if not add_line('%s%s: %s' % (indent, name, child.GetTypeName())):
+                return False
+            for i in range(min(child_count, self.MAX_CHILDREN)):
+                if not add_value(child.GetChildAtIndex(i), depth + 1):
+                    return False
+            if child_count > self.MAX_CHILDREN:
+                return add_line('%s  ...' % indent)
+            return True
+
+        for i in range(start, end):
+            if not add_value(value.GetChildAtIndex(i), 1):
+                # Show the rest of child `i` next time, unless it is the first
+                # one, which could then never be shown in full.
+                lines.append('  ...')
+                end = max(i, start + 1)
+                break
+
+        if end < count:
+            lines.append('Showing children %d..<%d. Run `%%more %d %d` to '
+                         'see more.' % (start, end, execution_count, end))
+        return '\n'.join(lines) + '\n'
+
+
+# The `Int`s in `KernelCommunicator.state`, in order.
+CommunicatorState = collections.namedtuple('CommunicatorState', [
+    'parent_message_handler_count',
+    'unconditional_handler_count',
+    'display_messages_pending',
+    'parent_message_buffer_address',
+    'parent_message_buffer_capacity',
+    'parent_message_count',
+    'display_messages_address',
+    'display_messages_count',
+])
 
 
 class SwiftKernel(Kernel):
@@ -153,22 +1399,289 @@ class SwiftKernel(Kernel):
         'version': '',
     }
 
+    # Number of truncated results that `%more` can page through.
+    MAX_TRUNCATED_RESULTS = 16
+
+    LINE_MAGIC_RE = re.compile(r'^\s*%(\w+)(.*)$')
+    CELL_MAGIC_RE = re.compile(r'^\s*%%(\w+)(.*)$')
+
+    # Whether this kernel is being warmed up for the kernel pool. See
+    # swift_kernel_pool.py.
+    warm = Bool(False)
+
+    # A warm kernel whose REPL process the next SwiftKernel adopts.
+    warm_kernel = None
+
+    # The state of a warm kernel that an adopting kernel takes over.
+    ADOPTED_ATTRIBUTES = [
+        'debugger',
+        'target',
+        'main_bp',
+        'process',
+        'expr_opts',
+        'swift_language',
+        'main_thread',
+        '_int_bitwidth',
+        '_entry_points',
+        'c_expr_opts',
+        'cached_cell_expr_opts',
+        'display_channel',
+        '_included_once',
+    ]
+
     def __init__(self, **kwargs):
+        if lldb is None:
+            importlib.import_module(LLDB_MODULE)
         super(SwiftKernel, self).__init__(**kwargs)
 
+        # Holds the parent message of each thread. See `_parent_header`.
+        self._thread_parents = threading.local()
+
         # Whether to do code completion. (Code completion currently crashes
         # the kernel a lot so it is opt-in for now).
         self.completion_enabled = False
+        self.completer = CodeCompleter(self)
+        self.symbol_index = SymbolIndex()
+
+        # The most recent values whose rendering was truncated, by execution
+        # count, for `%more`.
+        self.result_renderer = ResultRenderer()
+        self.truncated_results = collections.OrderedDict()
+
+        self.include_resolver = IncludeResolver([
+            os.path.dirname(os.path.realpath(__file__)),
+            os.path.realpath("."),
+        ])
+
+        # Keys of `%pragma once` files that have been included successfully,
+        # and of those included by the cell currently being preprocessed.
+        self._included_once = set()
+        self._pending_includes = set()
+
+        # The current cell's `%timeit` lines, as `(offset, line_index,
+        # options)` where `offset` is the line's position in the preprocessed
+        # cell, and whether it is a `%%time` cell.
+        self._pending_timeits = []
+        self._time_cell = False
+
+        self.journal = SessionJournal()
+
+        self.cell_cache = CompiledCellCache()
+        self._cached_cell_count = 0
+
+        # Statistics about the currently executing cell, and about all the
+        # cells executed so far, as (execution_count, stats) pairs. See
+        # `_begin_cell_stats`.
+        self.cell_stats = None
+        self.cell_stats_history = []
+
+        # Seconds spent in each phase of kernel startup.
+        self.startup_timings = collections.OrderedDict()
+
+        # The budgets of each cell, which `%limit` changes. See
+        # CellWatchdog.
+        self.limits = CellWatchdog.limits_from_environment(os.environ)
+
+        # Exports statistics to Prometheus, if enabled. See KernelMetrics.
+        self.metrics = None
+
+        self._init_magics()
+
+        warm_kernel = SwiftKernel.warm_kernel
+        if warm_kernel is not None and not self.warm:
+            SwiftKernel.warm_kernel = None
+            self._adopt_repl_process(warm_kernel)
+        else:
+            self._init_repl_process()
+            self._init_kernel_communicator()
+
+        # A warm kernel only prepares a REPL process for a kernel in the pool
+        # to adopt later. It never talks to a client.
+        if self.warm:
+            return
 
-        self._init_repl_process()
-        self._init_kernel_communicator()
-        self._init_int_bitwidth()
         self._init_sigint_handler()
+        self._init_stdout_handler()
+        self._init_watchdog()
+        self.display_channel.attach(self)
+        self._init_execution_thread()
+        self._init_metrics()
+
+        self.log.info('Kernel startup timings: %s' % ', '.join([
+            '%s %.3fs' % (phase, seconds)
+            for phase, seconds in self.startup_timings.items()]))
+
+    # Cells execute on `execution_thread` while the main thread handles other
+    # requests, so each thread has its own parent message.
+    @property
+    def _parent_header(self):
+        return getattr(self._thread_parents, 'header', {})
+
+    @_parent_header.setter
+    def _parent_header(self, header):
+        self._thread_parents.header = header
+
+    @property
+    def _parent_ident(self):
+        return getattr(self._thread_parents, 'ident', b'')
+
+    @_parent_ident.setter
+    def _parent_ident(self, ident):
+        self._thread_parents.ident = ident
+
+    def execute_request(self, stream, ident, parent):
+        self.execution_thread.submit(stream, ident, parent)
+
+    def execute_request_now(self, stream, ident, parent):
+        """Handles an execute request. Called on `execution_thread`."""
+        self.completer.pause()
+        try:
+            super(SwiftKernel, self).execute_request(stream, ident, parent)
+        finally:
+            self.completer.resume()
+
+    def _abort_queues(self):
+        # Abort the cells waiting for the execution thread, and then let the
+        # main thread abort the requests that have not been received yet.
+        self.execution_thread.abort_queued()
+        self.execution_thread.loop.add_callback(
+                super(SwiftKernel, self)._abort_queues)
+
+    def _publish_status(self, status, parent=None):
+        # The execution thread reports when an execute request is done.
+        parent = parent or self._parent_header
+        if status == 'idle' and parent.get('header', {}).get('msg_id') in \
+                self.execution_thread.pending:
+            return
+        super(SwiftKernel, self)._publish_status(status, parent)
+
+    @property
+    def kernel_info(self):
+        kernel_info = super(SwiftKernel, self).kernel_info
+        kernel_info['startup_timings'] = self.startup_timings
+        if self.metrics is not None:
+            kernel_info['metrics_port'] = self.metrics.port
+        return kernel_info
+
+    def _record_startup_phase(self, phase, start_time):
+        self.startup_timings[phase] = time.time() - start_time
+
+    # The phases of executing a cell, in the order that they happen.
+    CELL_PHASES = [
+        'set_parent_message',
+        'preprocess',
+        'execute',
+        'after_successful_execution',
+        'read_display_messages',
+        'send_display_messages',
+        'stdout_drain',
+        'display_drain',
+        'render_result',
+    ]
+
+    def _begin_cell_stats(self):
+        self.cell_stats = {
+            'start_time': time.time(),
+            'phases': collections.OrderedDict(),
+            'display_bytes': 0,
+            'display_messages': 0,
+            'outcome': 'ok',
+        }
+
+    def _record_cell_phase(self, phase, start_time):
+        """Adds the time since `start_time` to `phase` of the current cell."""
+        if self.cell_stats is None:
+            return
+        phases = self.cell_stats['phases']
+        phases[phase] = phases.get(phase, 0.0) + time.time() - start_time
+
+    def _finish_cell_stats(self):
+        """Returns the current cell's statistics in a JSON-able form and adds
+        them to the history."""
+        stats = self.cell_stats
+        self.cell_stats = None
+        resources = stats.get('resources', {})
+        finished = {
+            'total': time.time() - stats['start_time'],
+            'phases': stats['phases'],
+            'stdout_bytes': self.stdout_handler.sent_bytes,
+            'display_bytes': stats['display_bytes'],
+            'display_messages': stats['display_messages'],
+            'cpu_seconds': resources.get('cpu'),
+            'memory_rss_bytes': resources.get('rss'),
+            'memory_delta_bytes': resources.get('delta'),
+            'memory_peak_bytes': resources.get('peak'),
+            'outcome': stats['outcome'],
+            'cell_cache': stats.get('cell_cache'),
+        }
+        self.cell_stats_history.append((self.execution_count, finished))
+        if self.metrics is not None:
+            self.metrics.observe_cell(finished)
+        return finished
+
+    def finish_metadata(self, parent, metadata, reply_content):
+        metadata = super(SwiftKernel, self).finish_metadata(
+                parent, metadata, reply_content)
+        if self.cell_stats is not None:
+            metadata['swift_timing'] = self._finish_cell_stats()
+        return metadata
+
+    def _handle_timing(self, line_index, rest_of_line):
+        if rest_of_line.strip():
+            raise PreprocessorException(
+                    'Line %d: %%timing takes no arguments' % (line_index + 1))
+        byte_columns = ['stdout_bytes', 'display_bytes', 'memory_delta_bytes',
+                        'memory_peak_bytes']
+        columns = ['cell', 'total', 'cpu'] + self.CELL_PHASES + byte_columns
+        rows = [columns]
+        for execution_count, stats in self.cell_stats_history:
+            rows.append(['%d' % execution_count, '%.4f' % stats['total'],
+                         '-' if stats.get('cpu_seconds') is None else
+                         '%.4f' % stats['cpu_seconds']] + [
+                '%.4f' % stats['phases'][phase]
+                if phase in stats['phases'] else '-'
+                for phase in self.CELL_PHASES
+            ] + [
+                '-' if stats.get(column) is None else '%d' % stats[column]
+                for column in byte_columns
+            ])
+        widths = [max(len(row[i]) for row in rows)
+                  for i in range(len(columns))]
+        text = ''.join([
+            '  '.join([cell.rjust(width)
+                       for cell, width in zip(row, widths)]) + '\n'
+            for row in rows])
+        self.send_response(self.iopub_socket, 'stream', {
+            'name': 'stdout',
+            'text': 'Times are in seconds.\n' + text
+        })
+        return ''
+
+    def _handle_more(self, line_index, rest_of_line):
+        args = rest_of_line.split()
+        if len(args) not in (1, 2) or not all(arg.isdigit() for arg in args):
+            raise PreprocessorException(
+                    'Line %d: Usage: %%more <cell number> [<start index>]' % (
+                            line_index + 1))
+        execution_count = int(args[0])
+        value = self.truncated_results.get(execution_count)
+        if value is None:
+            raise PreprocessorException(
+                    'Line %d: Cell %d has no truncated result. (Only the '
+                    'last %d are kept.)' % (
+                            line_index + 1, execution_count,
+                            self.MAX_TRUNCATED_RESULTS))
+        start = int(args[1]) if len(args) == 2 else 0
+        text, _ = self.result_renderer.render(value, execution_count, start)
+        self._send_stdout(text)
+        return ''
 
     def _init_repl_process(self):
+        start_time = time.time()
         self.debugger = lldb.SBDebugger.Create()
         if not self.debugger:
             raise Exception('Could not start debugger')
+        self._record_startup_phase('debugger_create', start_time)
         self.debugger.SetAsync(False)
 
         # LLDB crashes while trying to load some Python stuff on Mac. Maybe
@@ -177,119 +1690,721 @@ class SwiftKernel(Kernel):
         # anyways.
         self.debugger.SetScriptLanguage(lldb.eScriptLanguageNone)
 
+        start_time = time.time()
         repl_swift = os.environ['REPL_SWIFT_PATH']
         self.target = self.debugger.CreateTargetWithFileAndArch(repl_swift, '')
         if not self.target:
             raise Exception('Could not create target %s' % repl_swift)
+        self._record_startup_phase('target_create', start_time)
+
+        self.display_channel = DisplayChannel()
 
         self.main_bp = self.target.BreakpointCreateByName(
             'repl_main', self.target.GetExecutable().GetFilename())
         if not self.main_bp:
             raise Exception('Could not set breakpoint')
 
+        self.expr_opts = lldb.SBExpressionOptions()
+        self.swift_language = lldb.SBLanguageRuntime.GetLanguageTypeFromString(
+            'swift')
+        self.expr_opts.SetLanguage(self.swift_language)
+        self.expr_opts.SetREPLMode(True)
+        self.expr_opts.SetUnwindOnError(False)
+        self.expr_opts.SetGenerateDebugInfo(True)
+
+        # Sets an infinite timeout so that users can run aribtrarily long
+        # computations.
+        self.expr_opts.SetTimeoutInMicroSeconds(0)
+
+        self._launch_repl_process()
+
+    def _launch_repl_process(self):
         repl_env = []
-        script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
+        script_dir = os.path.dirname(os.path.realpath(__file__))
         repl_env.append('PYTHONPATH=%s' % script_dir)
+        repl_env.append('SWIFT_KERNEL_DISPLAY_CHANNEL=%s' %
+                        self.display_channel.path)
         env_var_blacklist = [
             'PYTHONPATH',
-            'REPL_SWIFT_PATH'
+            'REPL_SWIFT_PATH',
+            'SWIFT_KERNEL_DISPLAY_CHANNEL',
         ]
         for key in os.environ:
             if key in env_var_blacklist:
                 continue
             repl_env.append('%s=%s' % (key, os.environ[key]))
 
+        # The debugger is synchronous, so this returns once the process has
+        # stopped at the `repl_main` breakpoint.
+        start_time = time.time()
         self.process = self.target.LaunchSimple(None,
                                                 repl_env,
                                                 os.getcwd())
         if not self.process:
             raise Exception('Could not launch process')
+        if self.process.GetState() != lldb.eStateStopped:
+            raise Exception('Process did not stop at repl_main')
+        self._record_startup_phase('launch', start_time)
 
-        self.expr_opts = lldb.SBExpressionOptions()
-        self.swift_language = lldb.SBLanguageRuntime.GetLanguageTypeFromString(
-            'swift')
-        self.expr_opts.SetLanguage(self.swift_language)
-        self.expr_opts.SetREPLMode(True)
-        self.expr_opts.SetUnwindOnError(False)
-        self.expr_opts.SetGenerateDebugInfo(True)
+        self.main_thread = self.process.GetThreadAtIndex(0)
 
-        # Sets an infinite timeout so that users can run aribtrarily long
-        # computations.
-        self.expr_opts.SetTimeoutInMicroSeconds(0)
+    def _restart_repl_process(self):
+        """Kills the REPL process and launches a new one.
+
+        The debugger and target are reused, so the modules that they have
+        already loaded do not have to be loaded again. This is much faster
+        than starting a new kernel."""
+        self.startup_timings = collections.OrderedDict()
+        self.process.Kill()
+        self.display_channel.discard()
+        self._launch_repl_process()
+        self.stdout_handler.listen_to_process()
+        self._included_once = set()
+        self.journal.clear()
+        self.cell_cache.invalidate()
+        self.symbol_index.clear()
+        self.truncated_results.clear()
+        self.completer.reset()
+        self._init_kernel_communicator()
+        if self.metrics is not None:
+            self.metrics.observe_startup(self.startup_timings, restart=True)
+        self.log.info('Kernel restart timings: %s' % ', '.join([
+            '%s %.3fs' % (phase, seconds)
+            for phase, seconds in self.startup_timings.items()]))
+
+    def _handle_replay(self, line_index, rest_of_line):
+        if rest_of_line.strip():
+            raise PreprocessorException(
+                    'Line %d: %%replay takes no arguments' % (line_index + 1))
+        start_time = time.time()
+        entries = self.journal.entries
+        self._restart_repl_process()
+        self.stdout_handler.set_suppressed(True)
+        self.display_channel.set_suppressed(True)
+        try:
+            expression_count = self._replay(entries)
+        finally:
+            self.stdout_handler.set_suppressed(False)
+            self.display_channel.set_suppressed(False)
+        self.send_response(self.iopub_socket, 'stream', {
+            'name': 'stdout',
+            'text': 'Replayed %d cells in %d expressions in %.1fs.\n' % (
+                len(entries), expression_count, time.time() - start_time)
+        })
+        return ''
+
+    def _replay(self, entries):
+        """Executes journal `entries` in as few expressions as possible.
+
+        Returns the number of expressions executed."""
+        journal = SessionJournal()
+        journal.entries = entries
+        expression_count = 0
+        for batch in journal.batches():
+            expression_count += 1
+            received_bytes = self.stdout_handler.received_bytes
+            result = self._execute_journal_entries(batch)
+            self.stdout_handler.flush()
+            had_output = self.stdout_handler.received_bytes != received_bytes
+            if isinstance(result, ExecutionResultError) and len(batch) > 1 \
+                    and not had_output:
+                # Something in the batch does not compile as a single
+                # expression, so try one cell at a time. (When there is
+                # output, it is a runtime error, and the cells before it have
+                # already run.)
+                for entry in batch:
+                    expression_count += 1
+                    result = self._execute_journal_entries([entry])
+                    if isinstance(result, ExecutionResultError):
+                        break
+            if isinstance(result, ExecutionResultError):
+                raise PreprocessorException(
+                        'Replay stopped because a cell failed:\n%s' %
+                        result.description())
+
+        # Throw away display messages from the replayed cells, and point
+        # display handlers that they registered at the current cell.
+        self._execute("""
+            _ = JupyterKernel.communicator.triggerAfterSuccessfulExecution()
+            JupyterKernel.communicator.releaseDisplayMessages()
+        """)
+        self._set_parent_message()
+        return expression_count
+
+    def _execute_journal_entries(self, entries):
+        code = '\n'.join([
+            '#sourceLocation(file: "<Cell %d>", line: 1)\n%s' % (
+                execution_count, code)
+            for execution_count, code, _ in entries])
+        result = self._execute(code)
+        if isinstance(result, ExecutionResultSuccess):
+            for execution_count, code, include_keys in entries:
+                self.journal.append(execution_count, code, include_keys)
+                self.symbol_index.add(code, '<Cell %d>' % execution_count)
+                self._included_once |= include_keys
+        return result
 
-        self.main_thread = self.process.GetThreadAtIndex(0)
+    def _handle_restart(self, line_index, rest_of_line):
+        if rest_of_line.strip():
+            raise PreprocessorException(
+                    'Line %d: %%restart takes no arguments' % (
+                            line_index + 1))
+        self._restart_repl_process()
+        self.send_response(self.iopub_socket, 'stream', {
+            'name': 'stdout',
+            'text': 'Restarted Swift REPL process in %.1fs.\n' % sum(
+                self.startup_timings.values())
+        })
+        return ''
+
+    # Names of the communicator hooks that the kernel calls through C function
+    # pointers, and the methods that they call.
+    ENTRY_POINTS = collections.OrderedDict([
+        ('updateParentMessage', 'updateParentMessageFromState'),
+        ('triggerAfterSuccessfulExecution',
+         'triggerAfterSuccessfulExecutionIntoState'),
+        ('releaseDisplayMessages', 'releaseDisplayMessages'),
+    ])
 
     def _init_kernel_communicator(self):
-        result = self._preprocess_and_execute(
-                '%include "KernelCommunicator.swift"')
-        if isinstance(result, ExecutionResultError):
+        # Every expression has a large fixed compile cost, so the whole
+        # bootstrap is done in one expression, which also evaluates to
+        # `Int.bitWidth`, the address of the communicator's state, and the
+        # addresses of the entry points.
+        start_time = time.time()
+        entry_point_decls = '\n'.join([
+            """
+                static let %sEntryPoint: @convention(c) () -> () = {
+                    JupyterKernel.communicator.%s()
+                }""" % (name, method)
+            for name, method in self.ENTRY_POINTS.items()])
+        entry_point_addresses = ' '.join([
+            '\\(unsafeBitCast(JupyterKernel.%sEntryPoint, to: Int.self))' %
+            name for name in self.ENTRY_POINTS])
+        bootstrap_code = """
+%%include "KernelCommunicator.swift"
+            enum JupyterKernel {
+                static var communicator = %s
+                %s
+            }
+            "\\(Int.bitWidth) \\(JupyterKernel.communicator.stateAddress) %s"
+        """ % (self._make_kernel_communicator_code(), entry_point_decls,
+               entry_point_addresses)
+        result = self._preprocess_and_execute(bootstrap_code)
+        if not isinstance(result, SuccessWithValue):
             raise Exception('Error initing KernelCommunicator: %s' % result)
+        fields = [int(field)
+                  for field in result.result.description.strip('"').split()]
+        self._int_bitwidth = fields[0]
+        self._communicator_state_address = fields[1]
+        self._entry_points = dict(zip(self.ENTRY_POINTS, fields[2:]))
+
+        # Entry points are called with C expressions, which are much cheaper
+        # to compile than Swift expressions.
+        self.c_expr_opts = lldb.SBExpressionOptions()
+        self.c_expr_opts.SetLanguage(lldb.eLanguageTypeC)
+        self.c_expr_opts.SetUnwindOnError(True)
+        self.c_expr_opts.SetTimeoutInMicroSeconds(0)
+
+        # Cached cells are user code, so they stop where they fail, like
+        # other cells.
+        self.cached_cell_expr_opts = lldb.SBExpressionOptions()
+        self.cached_cell_expr_opts.SetLanguage(lldb.eLanguageTypeC)
+        self.cached_cell_expr_opts.SetUnwindOnError(False)
+        self.cached_cell_expr_opts.SetTimeoutInMicroSeconds(0)
+        self._record_startup_phase('bootstrap', start_time)
+
+    def _int_format(self, count):
+        return '=%d%s' % (count, {32: 'i', 64: 'q'}[self._int_bitwidth])
+
+    def _read_memory(self, address, count):
+        # ReadMemory requires that count is positive.
+        if count == 0:
+            return bytes()
+        error = lldb.SBError()
+        data = self.process.ReadMemory(address, count, error)
+        if error.Fail():
+            raise Exception('reading memory: %s' % str(error))
+        return data
 
+    def _write_memory(self, address, data):
+        error = lldb.SBError()
+        self.process.WriteMemory(address, data, error)
+        if error.Fail():
+            raise Exception('writing memory: %s' % str(error))
+
+    def _read_communicator_state(self):
+        """Reads the `KernelCommunicator.state` without evaluating an
+        expression. Returns a CommunicatorState."""
+        int_format = self._int_format(len(CommunicatorState._fields))
+        return CommunicatorState(*struct.unpack(int_format, self._read_memory(
+            self._communicator_state_address, struct.calcsize(int_format))))
+
+    def _call_entry_point(self, name):
+        """Calls a communicator hook through its C function pointer. Returns
+        whether the call worked."""
+        result = self.target.EvaluateExpression(
+            '((void (*)(void))%d)()' % self._entry_points[name],
+            self.c_expr_opts)
+        if result.error.type in [lldb.eErrorTypeInvalid,
+                                 lldb.eErrorTypeGeneric]:
+            return True
+        self.log.error('Error calling %s entry point: %s' % (
+            name, result.error.description))
+        return False
+
+    def _make_kernel_communicator_code(self):
         session_key = self.session.key.decode('utf8')
-        decl_code = """
-            enum JupyterKernel {
-                static var communicator = KernelCommunicator(
+        return """KernelCommunicator(
                     jupyterSession: KernelCommunicator.JupyterSession(
-                        id: %s, key: %s, username: %s))
-            }
-        """ % (json.dumps(self.session.session), json.dumps(session_key),
-               json.dumps(self.session.username))
-        result = self._preprocess_and_execute(decl_code)
-        if isinstance(result, ExecutionResultError):
-            raise Exception('Error declaring JupyterKernel: %s' % result)
+                        id: %s, key: %s, username: %s))""" % (
+            json.dumps(self.session.session), json.dumps(session_key),
+            json.dumps(self.session.username))
+
+    def _adopt_repl_process(self, warm_kernel):
+        """Takes over the REPL process of `warm_kernel`, and points it at this
+        kernel's session and working directory."""
+        start_time = time.time()
+        for attribute in self.ADOPTED_ATTRIBUTES:
+            setattr(self, attribute, getattr(warm_kernel, attribute))
+        for phase, seconds in warm_kernel.startup_timings.items():
+            self.startup_timings['warm_' + phase] = seconds
 
-    def _init_int_bitwidth(self):
-        result = self._execute('Int.bitWidth')
+        result = self._execute("""
+            #if canImport(Glibc)
+            import Glibc
+            #else
+            import Darwin
+            #endif
+            _ = chdir(%s)
+            JupyterKernel.communicator = %s
+            JupyterKernel.communicator.stateAddress
+        """ % (json.dumps(os.getcwd()), self._make_kernel_communicator_code()))
         if not isinstance(result, SuccessWithValue):
-            raise Exception('Expected value from Int.bitWidth, but got: %s' %
-                            result)
-        self._int_bitwidth = int(result.result.description)
+            raise Exception('Error adopting warm REPL process: %s' % result)
+        self._communicator_state_address = int(result.result.description)
+        self._record_startup_phase('adopt', start_time)
 
     def _init_sigint_handler(self):
         self.sigint_handler = SIGINTHandler(self)
         self.sigint_handler.start()
 
+    def _init_stdout_handler(self):
+        self.stdout_handler = StdoutHandler(self)
+        self.stdout_handler.start()
+
+    def _init_watchdog(self):
+        self.watchdog = CellWatchdog(self)
+        self.watchdog.start()
+
+    def _init_metrics(self):
+        ports = os.environ.get('SWIFT_KERNEL_METRICS_PORT')
+        if not ports:
+            return
+        try:
+            self.metrics = KernelMetrics(
+                    self, KernelMetrics.parse_ports(ports),
+                    os.environ.get('SWIFT_KERNEL_METRICS_ADDRESS',
+                                   KernelMetrics.DEFAULT_ADDRESS))
+        except Exception as e:
+            # Metrics are not worth failing to start for.
+            self.log.error('Could not export metrics: %s' % str(e))
+            return
+        self.log.info('Exporting metrics on port %d' % self.metrics.port)
+
+    def _init_execution_thread(self):
+        self.execution_thread = ExecutionThread(self)
+        self.execution_thread.start()
+
     def _file_name_for_source_location(self):
         return '<Cell %d>' % self.execution_count
 
-    def _preprocess_and_execute(self, code):
+    def _preprocess_and_execute(self, code, journal=False):
+        start_time = time.time()
         try:
             preprocessed = self._preprocess(code)
         except PreprocessorException as e:
             return PreprocessorError(e)
+        finally:
+            self._record_cell_phase('preprocess', start_time)
+
+        start_time = time.time()
+        start_sample = self.watchdog.sample() if self._time_cell else None
+        try:
+            result = self._execute_in_steps(preprocessed, journal)
+        except PreprocessorException as e:
+            return PreprocessorError(e)
+        finally:
+            self._record_cell_phase('execute', start_time)
+        if isinstance(result, ExecutionResultSuccess):
+            if self._time_cell:
+                self._report_cell_time(start_time, start_sample)
+            self._included_once |= self._pending_includes
+            self.symbol_index.add(
+                    preprocessed, self._file_name_for_source_location())
+            if journal:
+                self.journal.append(self.execution_count, preprocessed,
+                                    self._pending_includes)
+        return result
 
-        return self._execute(preprocessed)
+    def _execute_in_steps(self, code, journal):
+        """Executes the preprocessed cell `code`, stopping at each `%timeit`
+        line to time its statement, so that the statement can use what the
+        lines before it declared."""
+        result = SuccessWithoutValue()
+        start = 0
+        start_line_index = 0
+        steps = self._pending_timeits + [(len(code), None, None)]
+        for offset, line_index, options in steps:
+            # Pad the step with empty lines to keep its line numbers.
+            step = '\n' * start_line_index + code[start:offset]
+            if step.strip():
+                if journal:
+                    result = self._execute_with_cache(step)
+                else:
+                    result = self._execute(step)
+                if not isinstance(result, ExecutionResultSuccess):
+                    return result
+            if options is not None:
+                self._timeit(options, None, line_index)
+            start, start_line_index = offset, line_index
+        return result
+
+    def _report_cell_time(self, start_time, start_sample):
+        wall_seconds = time.time() - start_time
+        self.stdout_handler.flush()
+        sample = self.watchdog.sample()
+        if start_sample is None or sample is None:
+            cpu = 'unavailable'
+        else:
+            cpu = self._format_seconds(sample['cpu'] - start_sample['cpu'])
+        self._send_stdout('Wall time: %s\nCPU time: %s\n' % (
+            self._format_seconds(wall_seconds), cpu))
 
     def _preprocess(self, code):
+        self._pending_includes = set()
+        self._pending_timeits = []
+        self._time_cell = False
+
+        # Fast path: cells without any '%' cannot contain magics.
+        if '%' not in code:
+            return code
+
         lines = code.split('\n')
+        cell_magic = None
+        cell_magic_match = self.CELL_MAGIC_RE.match(lines[0])
+        if cell_magic_match is not None:
+            name = cell_magic_match.group(1)
+            if name not in self.cell_magics:
+                raise PreprocessorException(
+                        'Line 1: Unknown cell magic %%%%%s' % name)
+            cell_magic = (self.cell_magics[name], cell_magic_match.group(2))
+            lines[0] = ''
+
         preprocessed_lines = [
-                self._preprocess_line(i, line) for i, line in enumerate(lines)]
-        return '\n'.join(preprocessed_lines)
+                self._preprocess_line(i, line) if '%' in line else line
+                for i, line in enumerate(lines)]
+        self._locate_timeits(preprocessed_lines)
+        preprocessed = '\n'.join(preprocessed_lines)
+        if cell_magic is not None:
+            handler, rest_of_line = cell_magic
+            return handler(rest_of_line, preprocessed)
+        return preprocessed
+
+    def _locate_timeits(self, preprocessed_lines):
+        """Finds the `%timeit` lines that `_handle_timeit_line` recorded in
+        the preprocessed cell. They must be at the top level, since the cell
+        is split there."""
+        options_by_line = dict(self._pending_timeits)
+        self._pending_timeits = []
+        offset = 0
+        depth = 0
+        for line_index, line in enumerate(preprocessed_lines):
+            if line_index in options_by_line:
+                if depth > 0:
+                    raise PreprocessorException(
+                            'Line %d: %%timeit must be at the top level of '
+                            'the cell' % (line_index + 1))
+                self._pending_timeits.append(
+                        (offset, line_index, options_by_line[line_index]))
+            offset += len(line) + 1
+            for code_line in line.split('\n'):
+                code_only = SymbolIndex.IGNORED_RE.sub('', code_line)
+                depth = max(0, depth + code_only.count('{') -
+                               code_only.count('}'))
+
+    def register_line_magic(self, name, handler):
+        """Registers a handler for lines of the form `%name rest_of_line`.
+
+        The handler is called with the 0-based line index and the rest of the
+        line, and returns the code that replaces the line.
+        """
+        self.line_magics[name] = handler
+
+    def register_cell_magic(self, name, handler):
+        """Registers a handler for cells whose first line is
+        `%%name rest_of_line`.
+
+        The handler is called with the rest of the first line and the
+        preprocessed cell, in which the first line has been replaced by an
+        empty line so that line numbers are unchanged. It returns the code to
+        execute.
+        """
+        self.cell_magics[name] = handler
+
+    # One `%timeit` option. Options come in any order, before the code.
+    TIMEIT_OPTION_RE = re.compile(r'^\s*-([nr])\s*(\d+)\s*')
+
+    # Compiles the code being timed into a closure.
+    TIMED_CLOSURE_CODE = """import Dispatch
+let __swiftJupyterTimed = { () -> () in
+#sourceLocation(file: "%s", line: %d)
+%s
+}
+"""
+
+    # Runs the closure `repeat` times in a loop of `number` iterations, and
+    # evaluates to a string "<number> <seconds per iteration>...". When
+    # `number` is 0, picks a number that makes a loop take at least 0.2s.
+    TIMED_RUN_CODE = """{ () -> String in
+    func measure(_ number: Int) -> Double {
+        let start = DispatchTime.now().uptimeNanoseconds
+        for _ in 0..<number { __swiftJupyterTimed() }
+        return Double(DispatchTime.now().uptimeNanoseconds - start) / 1e9
+    }
+    var number = %d
+    var first: Double? = nil
+    if number == 0 {
+        number = 1
+        while true {
+            let seconds = measure(number)
+            if seconds >= 0.2 || number >= 1_000_000_000 {
+                first = seconds / Double(number)
+                break
+            }
+            number *= 10
+        }
+    }
+    var times: [Double] = first.map { [$0] } ?? []
+    while times.count < %d {
+        times.append(measure(number) / Double(number))
+    }
+    return "\\(number) " + times.map { String($0) }.joined(separator: " ")
+}()
+"""
+
+    def _time_code(self, code, line_index, number, repeat):
+        """Compiles `code` once and runs it.
+
+        Returns `(compile_seconds, number, times)`, where `times` has the
+        seconds per iteration of each of the `repeat` loops of `number`
+        iterations."""
+        start_time = time.time()
+        result = self._execute(self.TIMED_CLOSURE_CODE % (
+            self._file_name_for_source_location(), line_index + 1, code))
+        compile_seconds = time.time() - start_time
+        if isinstance(result, ExecutionResultError):
+            raise PreprocessorException(result.description())
+
+        result = self._execute(self.TIMED_RUN_CODE % (number, repeat))
+        if not isinstance(result, SuccessWithValue):
+            raise PreprocessorException(
+                    'Timed code did not finish: %s' % (
+                            result.description()
+                            if isinstance(result, ExecutionResultError)
+                            else result))
+        fields = result.result.description.strip('"').split()
+        self.stdout_handler.flush()
+        return (compile_seconds, int(fields[0]),
+                [float(field) for field in fields[1:]])
+
+    @staticmethod
+    def _format_seconds(seconds):
+        for unit, scale in [('s', 1.0), ('ms', 1e-3), ('\u00b5s', 1e-6)]:
+            if seconds >= scale:
+                return '%.3g %s' % (seconds / scale, unit)
+        return '%.3g ns' % (seconds / 1e-9)
+
+    @staticmethod
+    def _format_bytes(count):
+        for unit, scale in [('GiB', 1024 ** 3), ('MiB', 1024 ** 2),
+                            ('KiB', 1024)]:
+            if count >= scale:
+                return '%.1f %s' % (count / scale, unit)
+        return '%d bytes' % count
+
+    def _format_limit(self, budget, limit):
+        if limit is None:
+            return 'none'
+        if budget == 'memory':
+            return self._format_bytes(limit)
+        return '%g s' % round(limit, 1)
+
+    def _parse_limits(self, text, location):
+        """Parses `%limit` arguments: pairs of a budget and a limit."""
+        words = text.split()
+        limits = collections.OrderedDict()
+        usage = '%sUsage: %%limit [%s <limit or none>]...' % (
+                location, '|'.join(CellWatchdog.BUDGETS))
+        if len(words) % 2 != 0:
+            raise PreprocessorException(usage)
+        for budget, limit in zip(words[::2], words[1::2]):
+            if budget not in CellWatchdog.BUDGETS:
+                raise PreprocessorException(usage)
+            try:
+                limits[budget] = CellWatchdog.parse_limit(budget, limit)
+            except ValueError as e:
+                raise PreprocessorException('%s%s' % (location, str(e)))
+        return limits
+
+    def _handle_limit_line(self, line_index, rest_of_line):
+        limits = self._parse_limits(rest_of_line, 'Line %d: ' % (
+                line_index + 1))
+        self.limits.update(limits)
+        self.watchdog.set_cell_limits(limits)
+        self._send_stdout('Limits per cell: %s\n' % ', '.join([
+            '%s %s' % (budget, self._format_limit(budget, limit))
+            for budget, limit in self.limits.items()]))
+        return ''
+
+    def _handle_limit_cell(self, rest_of_line, code):
+        if not rest_of_line.strip():
+            raise PreprocessorException(
+                    'Line 1: %%%%limit needs at least one limit')
+        self.watchdog.set_cell_limits(
+                self._parse_limits(rest_of_line, 'Line 1: '))
+        return code
+
+    def _budget_exceeded_message(self, exceeded):
+        budget = exceeded['budget']
+        value = self._format_limit(budget, exceeded['value'])
+        limit = self._format_limit(budget, exceeded['limit'])
+        if budget == 'memory':
+            return [
+                'Memory limit exceeded: the Swift process was using %s, '
+                'over the limit of %s, so the cell was interrupted.' % (
+                    value, limit),
+                'Memory that the cell allocated may still be in use. Use '
+                '%restart to free it, or %limit to change the limit.',
+            ]
+        if budget == 'cpu':
+            description = 'CPU time limit exceeded: the Swift process used ' \
+                          '%s of CPU time' % value
+        else:
+            description = 'Time limit exceeded: the cell ran for %s' % value
+        return [
+            '%s, over the limit of %s, so the cell was interrupted.' % (
+                description, limit),
+            'Use %limit to change the limit.',
+        ]
+
+    def _send_stdout(self, text):
+        self.send_response(self.iopub_socket, 'stream', {
+            'name': 'stdout',
+            'text': text
+        })
+
+    @classmethod
+    def _parse_timeit_options(cls, options):
+        """Returns `(number, repeat, rest)` for `%timeit` `options`, where
+        `rest` is what follows the options. A number of 0 means to choose
+        the number of loops automatically."""
+        values = {'n': 0, 'r': 7}
+        option_match = cls.TIMEIT_OPTION_RE.match(options)
+        while option_match is not None:
+            values[option_match.group(1)] = int(option_match.group(2))
+            options = options[option_match.end():]
+            option_match = cls.TIMEIT_OPTION_RE.match(options)
+        return values['n'], values['r'], options.lstrip()
+
+    def _timeit(self, options, code, line_index):
+        number, repeat, rest = self._parse_timeit_options(options)
+        if repeat < 1:
+            raise PreprocessorException('%timeit -r must be at least 1')
+        if code is None:
+            code = rest
+        compile_seconds, number, times = self._time_code(
+            code, line_index, number, repeat)
+
+        mean = sum(times) / len(times)
+        stddev = (sum([(t - mean) ** 2 for t in times]) / len(times)) ** 0.5
+        self._send_stdout(
+            '%s \u00b1 %s per loop (mean \u00b1 std. dev. of %d run%s, '
+            '%d loop%s '
+            'each)\nmin %s, max %s, compile time %s\n' % (
+                self._format_seconds(mean), self._format_seconds(stddev),
+                len(times), '' if len(times) == 1 else 's',
+                number, '' if number == 1 else 's',
+                self._format_seconds(min(times)),
+                self._format_seconds(max(times)),
+                self._format_seconds(compile_seconds)))
+
+    def _handle_timeit_line(self, line_index, rest_of_line):
+        # Timed when execution reaches the line, by `_execute_in_steps`.
+        self._pending_timeits.append((line_index, rest_of_line))
+        return ''
+
+    def _handle_timeit_cell(self, rest_of_line, code):
+        if self._pending_timeits:
+            raise PreprocessorException(
+                    'Line %d: %%timeit cannot be used in a %%%%timeit cell' % (
+                            self._pending_timeits[0][1] + 1))
+        self._timeit(rest_of_line, code, 0)
+        return ''
+
+    def _handle_time_cell(self, rest_of_line, code):
+        if rest_of_line.strip():
+            raise PreprocessorException('%%time takes no arguments')
+        # The cell runs as usual, so its declarations stay visible, and
+        # `_preprocess_and_execute` reports how long it took.
+        self._time_cell = True
+        return code
+
+    def _init_magics(self):
+        self.line_magics = {}
+        self.cell_magics = {}
+        self.register_line_magic('include', self._read_include)
+        self.register_line_magic('enableCompletion',
+                                 self._handle_enable_completion)
+        self.register_line_magic('restart', self._handle_restart)
+        self.register_line_magic('replay', self._handle_replay)
+        self.register_line_magic('timing', self._handle_timing)
+        self.register_line_magic('more', self._handle_more)
+        self.register_line_magic('limit', self._handle_limit_line)
+        self.register_cell_magic('limit', self._handle_limit_cell)
+        self.register_line_magic('timeit', self._handle_timeit_line)
+        self.register_cell_magic('timeit', self._handle_timeit_cell)
+        self.register_cell_magic('time', self._handle_time_cell)
+
+    def _handle_enable_completion(self, line_index, rest_of_line):
+        if rest_of_line.strip():
+            raise PreprocessorException(
+                    'Line %d: %%enableCompletion takes no arguments' % (
+                            line_index + 1))
 
-    def _handle_enable_completion(self):
         if not hasattr(self.target, 'CompleteCode'):
             self.send_response(self.iopub_socket, 'stream', {
                 'name': 'stdout',
                 'text': 'Completion NOT enabled because toolchain does not ' +
                         'have CompleteCode API.\n'
             })
-            return
+            return ''
 
         self.completion_enabled = True
         self.send_response(self.iopub_socket, 'stream', {
             'name': 'stdout',
             'text': 'Completion enabled!\n'
         })
+        return ''
 
     def _preprocess_line(self, line_index, line):
-        include_match = re.match(r'^\s*%include (.*)$', line)
-        if include_match is not None:
-            return self._read_include(line_index, include_match.group(1))
-        enable_completion_match = re.match(r'^\s*%enableCompletion\s*$', line)
-        if enable_completion_match is not None:
-            self._handle_enable_completion()
-            return ''
-        return line
+        magic_match = self.LINE_MAGIC_RE.match(line)
+        if magic_match is None:
+            return line
+        handler = self.line_magics.get(magic_match.group(1))
+        if handler is None:
+            return line
+        return handler(line_index, magic_match.group(2))
 
     def _read_include(self, line_index, rest_of_line):
         name_match = re.match(r'^\s*"([^"]+)"\s*', rest_of_line)
@@ -299,23 +2414,24 @@ class SwiftKernel(Kernel):
                             line_index + 1))
         name = name_match.group(1)
 
-        include_paths = [
-            os.path.dirname(os.path.realpath(sys.argv[0])),
-            os.path.realpath("."),
-        ]
-
-        code = None
-        for include_path in include_paths:
-            try:
-                with open(os.path.join(include_path, name), 'r') as f:
-                    code = f.read()
-            except IOError:
-                continue
-
-        if code is None:
+        path = self.include_resolver.resolve(name)
+        if path is None:
             raise PreprocessorException(
                     'Line %d: Could not find "%s". Searched %s.' % (
-                            line_index + 1, name, include_paths))
+                            line_index + 1, name,
+                            self.include_resolver.include_paths))
+
+        try:
+            key, code, once = self.include_resolver.read(path)
+        except IOError as e:
+            raise PreprocessorException(
+                    'Line %d: Could not read "%s": %s' % (
+                            line_index + 1, name, str(e)))
+
+        if once:
+            if key in self._included_once or key in self._pending_includes:
+                return ''
+            self._pending_includes.add(key)
 
         return '\n'.join([
             '#sourceLocation(file: "%s", line: 1)' % name,
@@ -339,29 +2455,125 @@ class SwiftKernel(Kernel):
         else:
             return SwiftError(result)
 
-    def _after_successful_execution(self):
-        result = self._execute(
-                'JupyterKernel.communicator.triggerAfterSuccessfulExecution()')
+    # Compiles a cell into a closure that can be called from C, and evaluates
+    # to the closure's address. The closure's source location is the cell that
+    # compiled it, so errors in later runs of the closure name that cell.
+    CACHED_CELL_CODE = """let __swiftJupyterCachedCell%(id)d: @convention(c) () -> () = {
+#sourceLocation(file: "%(file_name)s", line: 1)
+%(code)s
+}
+"\\(unsafeBitCast(__swiftJupyterCachedCell%(id)d, to: Int.self))"
+"""
+
+    def _execute_with_cache(self, code):
+        """Executes a user's cell, using `cell_cache` where possible."""
+        cache = self.cell_cache
+        if not code.strip():
+            return self._execute(code)
+        if CompiledCellCache.declares(code):
+            cache.invalidate()
+            self.completer.forget_identifiers()
+            return self._execute(code)
+
+        address = cache.lookup(code)
+        if address is True:
+            address = self._compile_cached_cell(code)
+            cache.compiled(code, address)
+            self._set_cell_cache_stat('compiled' if address else 'uncacheable')
+        elif address is not None:
+            self._set_cell_cache_stat('hit')
+        if address is None:
+            result = self._execute(code)
+            if isinstance(result, SuccessWithoutValue):
+                cache.ran(code)
+            return result
+
+        result = self.target.EvaluateExpression(
+            '((void (*)(void))%d)()' % address, self.cached_cell_expr_opts)
+        if result.error.type in [lldb.eErrorTypeInvalid,
+                                 lldb.eErrorTypeGeneric]:
+            return SuccessWithoutValue()
+        return SwiftError(result)
+
+    def _compile_cached_cell(self, code):
+        """Compiles `code` into a closure. Returns its address, or None."""
+        self._cached_cell_count += 1
+        result = self._execute(self.CACHED_CELL_CODE % {
+            'id': self._cached_cell_count,
+            'file_name': self._file_name_for_source_location(),
+            'code': code,
+        })
         if not isinstance(result, SuccessWithValue):
-            self.log.error(
-                    'Expected value from triggerAfterSuccessfulExecution(), '
-                    'but got: %s' % result)
-            return
+            return None
+        try:
+            return int(result.result.description.strip('"'))
+        except ValueError:
+            return None
+
+    def _set_cell_cache_stat(self, value):
+        if self.cell_stats is not None:
+            self.cell_stats['cell_cache'] = value
 
-        messages = self._read_jupyter_messages(result.result)
+    def _after_successful_execution(self):
+        start_time = time.time()
+        if self._call_entry_point('triggerAfterSuccessfulExecution'):
+            self._record_cell_phase('after_successful_execution', start_time)
+            start_time = time.time()
+            state = self._read_communicator_state()
+            buf = self._read_memory(state.display_messages_address,
+                                    state.display_messages_count)
+        else:
+            result = self._execute(
+                'JupyterKernel.communicator.triggerAfterSuccessfulExecution()')
+            self._record_cell_phase('after_successful_execution', start_time)
+            if not isinstance(result, SuccessWithValue):
+                self.log.error(
+                        'Expected value from triggerAfterSuccessfulExecution(), '
+                        'but got: %s' % result)
+                return
+            start_time = time.time()
+            buf = self._read_byte_array(result.result)
+
+        messages = self._read_jupyter_messages(buf)
+        self._record_cell_phase('read_display_messages', start_time)
+
+        start_time = time.time()
         self._send_jupyter_messages(messages)
+        self._record_cell_phase('send_display_messages', start_time)
+
+    def _read_jupyter_messages(self, buf):
+        if self.cell_stats is not None:
+            self.cell_stats['display_bytes'] += len(buf)
+
+        # The buffer has been copied, so free it in the Swift process now
+        # rather than keeping it alive until the next cell.
+        self._call_entry_point('releaseDisplayMessages')
 
-    def _read_jupyter_messages(self, sbvalue):
         return {
-            'display_messages': [
-                self._read_display_message(display_message_sbvalue)
-                for display_message_sbvalue
-                in sbvalue
-            ]
+            'display_messages': self._unpack_display_messages(buf)
         }
 
-    def _read_display_message(self, sbvalue):
-        return [self._read_byte_array(part) for part in sbvalue]
+    def _unpack_display_messages(self, buf):
+        """Slices the buffer packed by `KernelCommunicator.pack` into a list
+        of messages, where each message is a list of memoryviews of its
+        parts."""
+        view = memoryview(buf)
+        int64 = struct.Struct('=q')
+        position = [0]
+
+        def next_int():
+            value = int64.unpack_from(view, position[0])[0]
+            position[0] += int64.size
+            return value
+
+        headers = []
+        for _ in range(next_int()):
+            headers.append([(next_int(), next_int())
+                            for _ in range(next_int())])
+        return [
+            [view[offset:offset + count] for offset, count in header]
+            for header in headers
+        ]
 
     def _read_byte_array(self, sbvalue):
         get_position_error = lldb.SBError()
@@ -399,14 +2611,36 @@ class SwiftKernel(Kernel):
         return data
 
     def _send_jupyter_messages(self, messages):
+        if self.cell_stats is not None:
+            self.cell_stats['display_messages'] += len(
+                    messages['display_messages'])
         for display_message in messages['display_messages']:
             self.iopub_socket.send_multipart(display_message)
 
-    def _set_parent_message(self):
+    def _set_parent_message(self, state=None):
+        parent_json = json.dumps(squash_dates(self._parent_header))
+
+        # Fast path: write the JSON into the communicator's buffer, and call
+        # the entry point that reads it.
+        parent_bytes = parent_json.encode('utf8')
+        if state is None:
+            state = self._read_communicator_state()
+        if len(parent_bytes) <= state.parent_message_buffer_capacity:
+            self._write_memory(state.parent_message_buffer_address,
+                               parent_bytes)
+            count_index = CommunicatorState._fields.index(
+                'parent_message_count')
+            self._write_memory(
+                self._communicator_state_address +
+                count_index * self._int_bitwidth // 8,
+                struct.pack(self._int_format(1), len(parent_bytes)))
+            if self._call_entry_point('updateParentMessage'):
+                return
+
         result = self._execute("""
             JupyterKernel.communicator.updateParentMessage(
                 to: KernelCommunicator.ParentMessage(json: %s))
-        """ % json.dumps(json.dumps(squash_dates(self._parent_header))))
+        """ % json.dumps(parent_json))
         if isinstance(result, ExecutionResultError):
             raise Exception('Error setting parent message: %s' % result)
 
@@ -445,37 +2679,65 @@ class SwiftKernel(Kernel):
         return error_message
 
     def _execute_cell(self, code):
-        self._set_parent_message()
-        result = self._preprocess_and_execute(code)
+        # Only evaluate the communicator hooks when something in the process
+        # needs them.
+        state = self._read_communicator_state()
+        if state.parent_message_handler_count > 0:
+            start_time = time.time()
+            self._set_parent_message(state)
+            self._record_cell_phase('set_parent_message', start_time)
+        result = self._preprocess_and_execute(code, journal=True)
         if isinstance(result, ExecutionResultSuccess):
-            self._after_successful_execution()
+            state = self._read_communicator_state()
+            if state.unconditional_handler_count > 0 or \
+                    state.display_messages_pending:
+                self._after_successful_execution()
         return result
 
     def do_execute(self, code, silent, store_history=True,
                    user_expressions=None, allow_stdin=False):
-        # Start up a new thread to collect stdout.
-        stdout_handler = StdoutHandler(self)
-        stdout_handler.start()
+        self._begin_cell_stats()
+
+        # Tag stdout with this cell's parent message.
+        stdout_handler = self.stdout_handler
+        stdout_handler.begin_cell(self._parent_header)
+        self.watchdog.begin_cell()
 
         # Execute the cell, handle unexpected exceptions, and make sure to
-        # always clean up the stdout handler.
+        # always send all of the cell's stdout.
         try:
             result = self._execute_cell(code)
         except Exception as e:
+            self.cell_stats['outcome'] = 'kernel_error'
             return self._send_exception_report('_execute_cell', e)
         finally:
-            stdout_handler.stop_event.set()
-            stdout_handler.join()
+            resources = self.watchdog.end_cell()
+            self.cell_stats['resources'] = resources
+            start_time = time.time()
+            stdout_handler.end_cell()
+            self._record_cell_phase('stdout_drain', start_time)
+            start_time = time.time()
+            self.display_channel.flush()
+            self._record_cell_phase('display_drain', start_time)
 
         # Send values/errors and status to the client.
         if isinstance(result, SuccessWithValue):
+            start_time = time.time()
+            text, truncated = self.result_renderer.render(
+                    result.result, self.execution_count)
+            if truncated:
+                self.truncated_results[self.execution_count] = result.result
+                while len(self.truncated_results) > \
+                        self.MAX_TRUNCATED_RESULTS:
+                    self.truncated_results.popitem(last=False)
             self.send_response(self.iopub_socket, 'execute_result', {
                 'execution_count': self.execution_count,
                 'data': {
-                    'text/plain': result.result.description
+                    'text/plain': text
                 },
                 'metadata': {}
             })
+            self._record_cell_phase('render_result', start_time)
             return {
                 'status': 'ok',
                 'execution_count': self.execution_count,
@@ -490,12 +2752,20 @@ class SwiftKernel(Kernel):
                 'user_expressions': {}
             }
         elif isinstance(result, ExecutionResultError):
+            if resources['exceeded'] is not None:
+                self.cell_stats['outcome'] = 'limit_exceeded'
+                error_message = self._make_error_message(
+                        self._budget_exceeded_message(resources['exceeded']))
+                self.send_response(self.iopub_socket, 'error', error_message)
+                return error_message
+
             if stdout_handler.had_stdout:
                 # When there is stdout, it is a runtime error. Stdout, which we
                 # have already sent to the client, contains the error message
                 # (plus some other ugly traceback that we should eventually
                 # figure out how to suppress), so this block of code only needs
                 # to add a traceback.
+                self.cell_stats['outcome'] = 'runtime_error'
                 traceback = []
                 traceback.append('Current stack trace:')
                 traceback += [
@@ -509,40 +2779,110 @@ class SwiftKernel(Kernel):
 
             # There is no stdout, so it must be a compile error. Simply return
             # the error without trying to get a stack trace.
+            self.cell_stats['outcome'] = 'compile_error'
             error_message = self._make_error_message([result.description()])
             self.send_response(self.iopub_socket, 'error', error_message)
             return error_message
 
+    def do_shutdown(self, restart):
+        # Jupyter replaces this whole process when it restarts the kernel, so
+        # kill the REPL process either way. (`%restart` restarts just the REPL
+        # process, which is much faster.)
+        self.stdout_handler.stop()
+        self.watchdog.stop()
+        self.process.Kill()
+        self.display_channel.stop()
+        return {'status': 'ok', 'restart': restart}
+
     def do_complete(self, code, cursor_pos):
-        if not self.completion_enabled:
-            return
+        start_time = time.time()
+        try:
+            return self._complete(code, cursor_pos)
+        finally:
+            if self.metrics is not None:
+                self.metrics.completion_seconds.observe(
+                        time.time() - start_time)
 
+    def _complete(self, code, cursor_pos):
         code_to_cursor = code[:cursor_pos]
-        sbresponse = self.target.CompleteCode(
-            self.swift_language, None, code_to_cursor)
-        prefix = sbresponse.GetPrefix()
-        insertable_matches = []
-        for i in range(sbresponse.GetNumMatches()):
-            sbmatch = sbresponse.GetMatchAtIndex(i)
-            insertable_match = prefix + sbmatch.GetInsertable()
-            if insertable_match.startswith("_"):
-                continue
-            insertable_matches.append(insertable_match)
+        prefix = CodeCompleter.IDENTIFIER_SUFFIX_RE.search(
+                code_to_cursor).group(0)
+        context = code_to_cursor[:len(code_to_cursor) - len(prefix)]
+        is_member = CodeCompleter.MEMBER_CONTEXT_RE.search(context) is not None
+
+        # Names declared by earlier cells come from the symbol index, and
+        # names declared earlier in this cell are right here.
+        matches = []
+        if not is_member and len(prefix) > 0:
+            matches = self.symbol_index.complete(prefix)
+            matches += sorted(set([
+                name for _, name in DECLARATION_RE.findall(context)
+                if name.startswith(prefix)]) - set(matches))
+
+        if self.completion_enabled:
+            _, lldb_matches = self.completer.complete(code_to_cursor)
+            if lldb_matches is None and is_member:
+                # Completing needs the Swift process, which is busy
+                # executing.
+                return {
+                    'status': 'error',
+                    'ename': 'KernelBusy',
+                    'evalue': 'Cannot complete while a cell is executing.',
+                    'traceback': [],
+                }
+            seen = set(matches)
+            matches += [match for match in lldb_matches or []
+                        if match not in seen]
+        elif is_member:
+            return
+
         return {
             'status': 'ok',
-            'matches': insertable_matches,
+            'matches': matches,
             'cursor_start': cursor_pos - len(prefix),
             'cursor_end': cursor_pos,
         }
 
+    def do_inspect(self, code, cursor_pos, detail_level=0):
+        name = CodeCompleter.IDENTIFIER_SUFFIX_RE.search(
+                code[:cursor_pos]).group(0)
+        name += re.match(r'[A-Za-z_0-9]*', code[cursor_pos:]).group(0)
+        symbol = self.symbol_index.lookup(name)
+        if symbol is None:
+            return {'status': 'ok', 'found': False, 'data': {},
+                    'metadata': {}}
+        return {
+            'status': 'ok',
+            'found': True,
+            'data': {
+                'text/plain': '%s\n\nDeclared in %s, line %d.' % (
+                        symbol.signature, symbol.file_name, symbol.line)
+            },
+            'metadata': {},
+        }
+
 if __name__ == '__main__':
     # Jupyter sends us SIGINT when the user requests execution interruption.
     # Here, we block all threads from receiving the SIGINT, so that we can
     # handle it in a specific handler thread.
     signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGINT])
 
+    argv = sys.argv
+    if len(argv) == 3 and argv[1] == '--pool-worker':
+        # Warm up a REPL process, then wait for the pool to hand us a
+        # connection file.
+        import swift_kernel_pool
+        connection_file = swift_kernel_pool.run_worker(argv[2], SwiftKernel)
+        argv = [argv[0], '-f', connection_file]
+    elif int(os.environ.get('SWIFT_KERNEL_POOL_SIZE', '0')) > 0:
+        # Try to get a warm kernel from the pool. If that works, the pooled
+        # kernel serves the client and we just wait for it to exit.
+        import swift_kernel_pool
+        if swift_kernel_pool.run_client(argv):
+            sys.exit(0)
+
     from ipykernel.kernelapp import IPKernelApp
     # We pass the kernel name as a command-line arg, since Jupyter gives those
     # highest priority (in particular overriding any system-wide config).
     IPKernelApp.launch_instance(
-        argv=sys.argv + ['--IPKernelApp.kernel_class=__main__.SwiftKernel'])
+        argv=argv + ['--IPKernelApp.kernel_class=__main__.SwiftKernel'])
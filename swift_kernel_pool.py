@@ -0,0 +1,391 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A pool of pre-launched Swift kernels.
+
+Starting a kernel is slow: it creates a debugger and a target, launches
+repl_swift, and bootstraps the KernelCommunicator. The pool does all that
+ahead of time.
+
+There are three kinds of processes:
+
+- The pool manager (`python swift_kernel_pool.py ...`) keeps
+  `SWIFT_KERNEL_POOL_SIZE` workers warm, hands them out, and refills the pool
+  in the background. After `SWIFT_KERNEL_POOL_IDLE_TIMEOUT` seconds without
+  requests, it stops its warm workers and stops taking requests, but it only
+  exits once the workers it handed out have exited: they are its children,
+  and ipykernel exits when its parent does.
+- A worker (`python swift_kernel.py --pool-worker <socket>`) warms up a
+  SwiftKernel, tells the manager it is ready, and waits for a connection
+  file. It then runs the kernel as usual; the SwiftKernel adopts the warm
+  REPL process and rebinds it to the new session. It exits when its client
+  does, even if the client is killed.
+- A client is the process that Jupyter starts from the kernelspec. It asks
+  the manager for a worker, and then stands in for it: it forwards
+  interrupts and exits when the worker exits. If no worker is ready, the
+  client starts the kernel itself.
+
+All messages are single lines of JSON over a Unix socket.
+
+Workers inherit the environment of the client that started the pool, so
+each kernel environment (toolchain, Python, limits and so on) gets a pool,
+and a socket, of its own.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+# Environment variables that change how a kernel behaves, besides the
+# SWIFT_KERNEL_ ones.
+KERNEL_ENV_KEYS = [
+    'LD_LIBRARY_PATH',
+    'PYTHONPATH',
+    'PYTHON_LIBRARY',
+    'PYTHON_VERSION',
+    'REPL_SWIFT_PATH',
+]
+
+
+def kernel_env_hash(environ):
+    """Returns a short hash of the parts of `environ` that a kernel depends
+    on, so that kernels with different kernelspecs use different pools."""
+    kernel_env = sorted(
+        (key, value) for key, value in environ.items()
+        if (key in KERNEL_ENV_KEYS or key.startswith('SWIFT_KERNEL_')) and
+        key != 'SWIFT_KERNEL_POOL_SOCKET')
+    data = json.dumps([sys.executable, os.path.realpath(__file__), kernel_env])
+    return hashlib.sha256(data.encode('utf8')).hexdigest()[:16]
+
+
+def default_socket_path():
+    return os.path.join(tempfile.gettempdir(),
+                        'swift-kernel-pool-%d-%s.sock' % (
+                            os.getuid(), kernel_env_hash(os.environ)))
+
+
+def _send_message(sock, message):
+    sock.sendall((json.dumps(message) + '\n').encode('utf8'))
+
+
+def _receive_message(sock):
+    """Returns the next message from `sock`, or None at EOF."""
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(4096)
+        if len(chunk) == 0:
+            return None
+        data += chunk
+    return json.loads(data.decode('utf8'))
+
+
+def _connect(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+class KernelPool:
+    """Keeps `size` warm workers ready and hands them out to clients."""
+
+    # How long to wait for a connection to send its first message.
+    RECEIVE_TIMEOUT = 10
+
+    # Seconds between checks for exited workers after the pool shuts down.
+    REAP_INTERVAL = 1
+
+    def __init__(self, socket_path, size, idle_timeout, kernel_script):
+        self.socket_path = socket_path
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.kernel_script = kernel_script
+
+        # Workers that are still warming up, as pid -> Popen.
+        self.starting = {}
+
+        # Workers that are ready, as a list of (Popen, socket).
+        self.ready = []
+
+        # Workers that have been handed out, so that we can reap them.
+        self.adopted = []
+
+        self.last_request_time = time.time()
+
+    def _listen(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.socket_path)
+        except socket.error:
+            # Another manager may be running. If it is not, the socket is
+            # stale, so replace it.
+            existing = _connect(self.socket_path)
+            if existing is not None:
+                existing.close()
+                raise Exception('Kernel pool already running at %s' %
+                                self.socket_path)
+            os.unlink(self.socket_path)
+            sock.bind(self.socket_path)
+        sock.listen(16)
+        sock.settimeout(1)
+        return sock
+
+    def _refill(self):
+        while len(self.starting) + len(self.ready) < self.size:
+            worker = subprocess.Popen(
+                [sys.executable, self.kernel_script, '--pool-worker',
+                 self.socket_path],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            self.starting[worker.pid] = worker
+
+    def _reap(self):
+        for pid, worker in list(self.starting.items()):
+            if worker.poll() is not None:
+                del self.starting[pid]
+        for worker, conn in list(self.ready):
+            if worker.poll() is not None:
+                conn.close()
+                self.ready.remove((worker, conn))
+        self.adopted = [
+            worker for worker in self.adopted if worker.poll() is None]
+
+    def _handle_worker_ready(self, conn, pid):
+        worker = self.starting.pop(pid, None)
+        if worker is None:
+            conn.close()
+            return
+        self.ready.append((worker, conn))
+
+    def _handle_client(self, conn, request):
+        self.last_request_time = time.time()
+        while len(self.ready) > 0:
+            worker, worker_conn = self.ready.pop(0)
+            try:
+                _send_message(worker_conn, {
+                    'connection_file': request['connection_file'],
+                    'cwd': request['cwd'],
+                    'client_pid': request.get('pid'),
+                })
+            except socket.error:
+                continue
+            finally:
+                worker_conn.close()
+            self.adopted.append(worker)
+            _send_message(conn, {'pid': worker.pid})
+            return
+        _send_message(conn, {'error': 'no warm kernel available'})
+
+    def _handle_connection(self, conn):
+        conn.settimeout(self.RECEIVE_TIMEOUT)
+        message = _receive_message(conn)
+        if message is not None and 'ready' in message:
+            conn.settimeout(None)
+            self._handle_worker_ready(conn, message['ready'])
+            return
+        if message is not None and 'connection_file' in message:
+            self._handle_client(conn, message)
+        conn.close()
+
+    def _shutdown(self):
+        # Workers exit when their connection to the manager closes.
+        for worker, conn in self.ready:
+            conn.close()
+        for worker in self.starting.values():
+            worker.terminate()
+        os.unlink(self.socket_path)
+
+    def serve_forever(self):
+        listener = self._listen()
+        try:
+            while time.time() - self.last_request_time < self.idle_timeout:
+                self._reap()
+                self._refill()
+                try:
+                    conn, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                try:
+                    self._handle_connection(conn)
+                except (socket.error, ValueError):
+                    conn.close()
+        finally:
+            listener.close()
+            self._shutdown()
+
+        while len(self.adopted) > 0:
+            time.sleep(self.REAP_INTERVAL)
+            self._reap()
+
+
+def run_worker(socket_path, kernel_class):
+    """Warms up a kernel and waits for the pool to assign it a client.
+
+    Returns the client's connection file. Exits if the pool shuts down
+    first."""
+    from jupyter_client.session import Session
+
+    # Warm up with a placeholder session. The kernel that adopts the REPL
+    # process rebinds it to the real session.
+    warm_kernel = kernel_class(session=Session(key=b''), warm=True)
+    kernel_class.warm_kernel = warm_kernel
+
+    sock = _connect(socket_path)
+    message = None
+    if sock is not None:
+        _send_message(sock, {'ready': os.getpid()})
+        try:
+            message = _receive_message(sock)
+        except (socket.error, ValueError):
+            message = None
+        sock.close()
+    if message is None:
+        warm_kernel.process.Kill()
+        warm_kernel.display_channel.stop()
+        sys.exit(0)
+
+    client_pid = message.get('client_pid')
+    if client_pid is not None:
+        # The client is the kernel's parent as far as Jupyter is concerned.
+        # ipykernel's parent poller only notices when our actual parent, the
+        # manager, exits, so watch the client as well.
+        os.environ['JPY_PARENT_PID'] = str(client_pid)
+        _exit_with(client_pid)
+
+    os.chdir(message['cwd'])
+    return message['connection_file']
+
+
+def _exit_with(pid):
+    """Exits this process soon after the process `pid` exits."""
+    def watch():
+        while _pid_exists(pid):
+            time.sleep(1)
+        os._exit(1)
+
+    watcher = threading.Thread(target=watch)
+    watcher.daemon = True
+    watcher.start()
+
+
+def _start_pool(socket_path):
+    kernel_script = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), 'swift_kernel.py')
+    subprocess.Popen(
+        [sys.executable, os.path.realpath(__file__),
+         '--socket', socket_path,
+         '--size', os.environ.get('SWIFT_KERNEL_POOL_SIZE', '1'),
+         '--idle-timeout',
+         os.environ.get('SWIFT_KERNEL_POOL_IDLE_TIMEOUT', '3600'),
+         '--kernel-script', kernel_script],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True)
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def run_client(argv):
+    """Asks the pool for a warm kernel to serve the connection file in `argv`.
+
+    Returns False if the pool could not provide a kernel, in which case the
+    caller should start one itself. Otherwise, waits until the pooled kernel
+    exits and returns True."""
+    if '-f' not in argv[:-1]:
+        return False
+    connection_file = os.path.realpath(argv[argv.index('-f') + 1])
+    socket_path = os.environ.get('SWIFT_KERNEL_POOL_SOCKET',
+                                 default_socket_path())
+
+    sock = _connect(socket_path)
+    if sock is None:
+        # Start the pool for the next kernel. This kernel starts cold.
+        _start_pool(socket_path)
+        return False
+    try:
+        _send_message(sock, {
+            'connection_file': connection_file,
+            'cwd': os.getcwd(),
+            'pid': os.getpid(),
+        })
+        reply = _receive_message(sock)
+    except (socket.error, ValueError):
+        reply = None
+    finally:
+        sock.close()
+    if reply is None or 'pid' not in reply:
+        return False
+
+    # Jupyter interrupts and terminates the kernel through this process, so
+    # pass those signals on to the pooled kernel. (SIGINT is blocked in all
+    # threads, so wait for it explicitly.)
+    pid = reply['pid']
+
+    def forward_sigint():
+        while True:
+            signal.sigwait([signal.SIGINT])
+            os.kill(pid, signal.SIGINT)
+
+    sigint_forwarder = threading.Thread(target=forward_sigint)
+    sigint_forwarder.daemon = True
+    sigint_forwarder.start()
+
+    def forward_sigterm(signum, frame):
+        os.kill(pid, signal.SIGTERM)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, forward_sigterm)
+
+    while _pid_exists(pid):
+        time.sleep(0.5)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Keep pre-launched Swift kernels ready')
+    parser.add_argument('--socket', default=default_socket_path())
+    parser.add_argument('--size', type=int, default=1)
+    parser.add_argument('--idle-timeout', type=float, default=3600)
+    parser.add_argument('--kernel-script', required=True)
+    args = parser.parse_args()
+
+    KernelPool(args.socket, args.size, args.idle_timeout,
+               args.kernel_script).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs Swift notebooks without Jupyter.
+
+Each worker process creates one SwiftKernel, and so one REPL process, and
+executes notebooks by calling the kernel's `do_execute` directly. There is no
+notebook server and no ZMQ: the messages that the kernel publishes go
+straight into the notebook's outputs. Between notebooks, a worker restarts
+its REPL process like `%restart` does, which is much faster than starting a
+new kernel.
+
+A notebook stops at its first failing cell. The runner writes the outputs
+and each cell's timings (as `swift_timing` cell metadata) back into the
+notebook, prints a line per notebook, and exits with status 1 if any
+notebook failed.
+
+Usage:
+
+    python swift_notebook_runner.py [--jobs N] [--kernel-name swift]
+        [--output-dir DIR] [--report FILE] notebook.ipynb ...
+
+`--kernel-name` runs the kernel with the environment of that kernelspec, as
+Jupyter would. Without it, the environment must already point the kernel at
+the toolchain (`PYTHONPATH`, `LD_LIBRARY_PATH` and `REPL_SWIFT_PATH`).
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+
+class OutputCollector:
+    """Stands in for the kernel's IOPub socket, and turns the messages that
+    the kernel publishes for the current cell into notebook outputs.
+
+    The kernel publishes from several threads, so this is thread-safe."""
+
+    def __init__(self, session):
+        self.session = session
+        self._lock = threading.Lock()
+        self.begin_cell(None)
+
+    def begin_cell(self, msg_id):
+        """Starts collecting the outputs of the request `msg_id`."""
+        with self._lock:
+            self.msg_id = msg_id
+            self.outputs = []
+            self._clear_before_next_output = False
+            # Indices in `outputs` of the outputs with each display id.
+            self._display_outputs = {}
+
+    def send_multipart(self, msg_parts, **kwargs):
+        _, msg_list = self.session.feed_identities(msg_parts)
+        msg = self.session.deserialize(msg_list)
+        with self._lock:
+            if msg['parent_header'].get('msg_id') == self.msg_id:
+                self._handle(msg)
+
+    def _handle(self, msg):
+        import nbformat
+
+        msg_type = msg['msg_type']
+        content = msg['content']
+        if msg_type == 'clear_output':
+            if content.get('wait'):
+                self._clear_before_next_output = True
+            else:
+                self._clear()
+            return
+        if msg_type == 'update_display_data':
+            display_id = content.get('transient', {}).get('display_id')
+            for index in self._display_outputs.get(display_id, []):
+                self.outputs[index]['data'] = content['data']
+                self.outputs[index]['metadata'] = content['metadata']
+            return
+        if msg_type not in ['stream', 'display_data', 'execute_result',
+                            'error']:
+            return
+
+        if self._clear_before_next_output:
+            self._clear()
+        if msg_type == 'stream' and len(self.outputs) > 0 and \
+                self.outputs[-1]['output_type'] == 'stream' and \
+                self.outputs[-1]['name'] == content['name']:
+            self.outputs[-1]['text'] += content['text']
+            return
+        display_id = content.get('transient', {}).get('display_id')
+        if display_id is not None:
+            self._display_outputs.setdefault(display_id, []).append(
+                    len(self.outputs))
+        self.outputs.append(nbformat.v4.output_from_msg(msg))
+
+    def _clear(self):
+        self.outputs = []
+        self._display_outputs = {}
+        self._clear_before_next_output = False
+
+
+class NotebookRunner:
+    """Executes notebooks one at a time on a SwiftKernel of its own."""
+
+    def __init__(self):
+        from jupyter_client.session import Session, new_id_bytes
+
+        self.session = Session(key=new_id_bytes())
+        self.collector = OutputCollector(self.session)
+        self.kernel = None
+
+    def _start_kernel(self, notebook_dir):
+        """Starts the kernel, or restarts its REPL process, in
+        `notebook_dir`."""
+        import swift_kernel
+
+        os.chdir(notebook_dir)
+        if self.kernel is None:
+            self.kernel = swift_kernel.SwiftKernel(
+                    session=self.session,
+                    iopub_socket=self.collector,
+                    log=logging.getLogger('swift_notebook_runner'))
+            return
+        self.kernel.include_resolver = swift_kernel.IncludeResolver([
+            os.path.dirname(os.path.realpath(swift_kernel.__file__)),
+            notebook_dir,
+        ])
+        self.kernel._restart_repl_process()
+        # Undo what magics in the previous notebook changed.
+        self.kernel.limits = swift_kernel.CellWatchdog.limits_from_environment(
+                os.environ)
+        self.kernel.completion_enabled = False
+        self.kernel.execution_count = 0
+        self.kernel.cell_stats_history = []
+
+    def _execute_cell(self, code):
+        """Executes `code` like an execute request would. Returns the reply
+        content, the reply metadata, and the outputs."""
+        kernel = self.kernel
+        parent = self.session.msg('execute_request', content={
+            'code': code,
+            'silent': False,
+            'store_history': True,
+            'user_expressions': {},
+            'allow_stdin': False,
+        })
+        kernel.set_parent([], parent)
+        self.collector.begin_cell(parent['header']['msg_id'])
+        metadata = kernel.init_metadata(parent)
+        kernel.execution_count += 1
+        reply = kernel.do_execute(code, False)
+        metadata = kernel.finish_metadata(parent, metadata, reply)
+        return reply, metadata, self.collector.outputs
+
+    def run(self, path, output_path):
+        """Executes the notebook at `path` and writes it to `output_path`.
+
+        Returns a JSON-able summary of the run."""
+        import nbformat
+
+        start_time = time.time()
+        summary = {
+            'path': path,
+            'output_path': output_path,
+            'status': 'ok',
+            'cells': [],
+        }
+        notebook = nbformat.read(path, as_version=4)
+        for cell in notebook.cells:
+            if cell.cell_type == 'code':
+                cell.outputs = []
+                cell.execution_count = None
+                cell.metadata.pop('swift_timing', None)
+
+        try:
+            self._start_kernel(os.path.dirname(os.path.realpath(path)))
+            for index, cell in enumerate(notebook.cells):
+                if cell.cell_type != 'code' or not cell.source.strip():
+                    continue
+                cell_start_time = time.time()
+                reply, metadata, outputs = self._execute_cell(cell.source)
+                cell.outputs = outputs
+                cell.execution_count = reply.get('execution_count')
+                if 'swift_timing' in metadata:
+                    cell.metadata['swift_timing'] = metadata['swift_timing']
+                summary['cells'].append({
+                    'index': index,
+                    'execution_count': cell.execution_count,
+                    'status': reply['status'],
+                    'seconds': time.time() - cell_start_time,
+                })
+                if reply['status'] != 'ok':
+                    summary['status'] = 'error'
+                    summary['error'] = {
+                        'index': index,
+                        'ename': reply.get('ename'),
+                        'evalue': reply.get('evalue'),
+                        'traceback': reply.get('traceback', []),
+                    }
+                    break
+        except Exception as e:
+            # The kernel is in an unknown state, so start a new one for the
+            # next notebook.
+            summary['status'] = 'error'
+            summary['error'] = {
+                'index': None,
+                'ename': type(e).__name__,
+                'evalue': str(e),
+                'traceback': [],
+            }
+            self.shutdown()
+
+        nbformat.write(notebook, output_path)
+        summary['seconds'] = time.time() - start_time
+        return summary
+
+    def shutdown(self):
+        if self.kernel is not None:
+            kernel = self.kernel
+            self.kernel = None
+            kernel.do_shutdown(False)
+
+
+def _worker(tasks, results):
+    # Like the kernel's main thread, leave SIGINT to the kernel's
+    # SIGINTHandler, which interrupts the executing cell.
+    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGINT])
+    logging.basicConfig(level=logging.WARNING)
+    runner = NotebookRunner()
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, path, output_path = task
+            results.put((index, runner.run(path, output_path)))
+    finally:
+        runner.shutdown()
+
+
+def _use_kernelspec(kernel_name):
+    """Sets up this process's environment like Jupyter does for the kernel
+    `kernel_name`, so that the workers inherit it."""
+    from jupyter_client.kernelspec import KernelSpecManager
+
+    spec = KernelSpecManager().get_kernel_spec(kernel_name)
+    os.environ.update(spec.env)
+    # Spawned workers start with this process's `sys.path`, rather than one
+    # computed from PYTHONPATH.
+    if 'PYTHONPATH' in spec.env:
+        sys.path[1:1] = spec.env['PYTHONPATH'].split(os.pathsep)
+
+
+def run_notebooks(paths, output_paths, jobs):
+    """Runs the notebooks at `paths` on `jobs` worker processes.
+
+    Yields a summary per notebook as it finishes."""
+    # Workers must not inherit the threads and sockets of this process, so
+    # they start fresh.
+    context = multiprocessing.get_context('spawn')
+    tasks = context.Queue()
+    results = context.Queue()
+    for task in enumerate(zip(paths, output_paths)):
+        index, (path, output_path) = task
+        tasks.put((index, path, output_path))
+    jobs = min(jobs, len(paths))
+    workers = [context.Process(target=_worker, args=(tasks, results))
+               for _ in range(jobs)]
+    for worker in workers:
+        tasks.put(None)
+        worker.start()
+
+    try:
+        remaining = set(range(len(paths)))
+        while len(remaining) > 0:
+            try:
+                index, summary = results.get(timeout=1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+                continue
+            remaining.discard(index)
+            yield index, summary
+
+        # Workers that died took their notebooks with them.
+        for index in sorted(remaining):
+            yield index, {
+                'path': paths[index],
+                'output_path': output_paths[index],
+                'status': 'error',
+                'cells': [],
+                'error': {
+                    'index': None,
+                    'ename': 'WorkerDied',
+                    'evalue': 'The worker process exited unexpectedly',
+                    'traceback': [],
+                },
+            }
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+
+def _describe_error(error):
+    # The kernel reports Swift errors in the traceback only.
+    if error['ename']:
+        return '%s: %s' % (error['ename'], error['evalue'])
+    lines = '\n'.join(error['traceback']).strip().splitlines()
+    return lines[0] if len(lines) > 0 else 'unknown error'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Run Swift notebooks without Jupyter')
+    parser.add_argument('notebooks', nargs='+')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='number of notebooks to run in parallel '
+                             '(default: one per CPU)')
+    parser.add_argument('--kernel-name',
+                        help='use the environment of this kernelspec')
+    parser.add_argument('--output-dir',
+                        help='write executed notebooks here instead of '
+                             'overwriting them')
+    parser.add_argument('--report', help='write a JSON report here')
+    args = parser.parse_args()
+
+    if args.kernel_name is not None:
+        _use_kernelspec(args.kernel_name)
+    paths = [os.path.realpath(path) for path in args.notebooks]
+    if args.output_dir is None:
+        output_paths = paths
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        output_paths = [
+            os.path.join(os.path.realpath(args.output_dir),
+                         os.path.basename(path))
+            for path in paths]
+
+    start_time = time.time()
+    summaries = [None] * len(paths)
+    for index, summary in run_notebooks(paths, output_paths, args.jobs):
+        summaries[index] = summary
+        if summary['status'] == 'ok':
+            print('PASS %s (%d cells, %.1fs)' % (
+                    args.notebooks[index], len(summary['cells']),
+                    summary.get('seconds', 0)))
+        else:
+            error = summary['error']
+            where = '' if error['index'] is None else \
+                    ' in cell %d' % (error['index'] + 1)
+            print('FAIL %s%s: %s' % (
+                    args.notebooks[index], where, _describe_error(error)))
+        sys.stdout.flush()
+
+    failures = len([summary for summary in summaries
+                    if summary['status'] != 'ok'])
+    print('%d notebooks, %d failed, in %.1fs' % (
+            len(summaries), failures, time.time() - start_time))
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump({'notebooks': summaries}, f, indent=2)
+            f.write('\n')
+    sys.exit(1 if failures > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,21 +12,196 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ctypes
+import fcntl
+import json
+import os
+import struct
+import threading
+
 from ipykernel.zmqshell import ZMQInteractiveShell
 from jupyter_client.session import Session
 
 
+def _open_channel(path):
+    """Opens the kernel's display channel for writing, or returns None if
+    the kernel is not listening."""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        return None
+    # Writes should wait for the kernel to make room in the pipe.
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+    return fd
+
+
 class CapturingSocket:
     """Simulates a ZMQ socket, saving messages instead of sending them.
 
     We use this to capture display messages.
+
+    If the kernel's display channel (a named pipe) is available, messages are
+    written to it right away, and the kernel sends them while the cell is
+    still executing. Otherwise, they are saved in `messages` until the cell
+    finishes and the kernel calls `take_messages()`.
+
+    Saved messages that the client would never show are dropped: output
+    followed by a `clear_output`, and display updates followed by another
+    update of the same display. (The kernel does the same for messages that
+    pile up in the channel.) Once the cell's output adds up to `max_bytes`,
+    further messages are dropped too, and `take_messages()` adds a notice
+    saying how many. Output that a `clear_output` or a later update has
+    replaced does not count.
+
+    If `pending_flag_address` is given, the integer at that address is set to
+    1 whenever a message is saved, which tells the kernel that there are
+    messages to collect.
     """
 
-    def __init__(self):
+    # Messages whose output a `clear_output` clears.
+    CLEARED_MSG_TYPES = set([
+        'clear_output', 'display_data', 'execute_result', 'stream'])
+
+    def __init__(self, pending_flag_address=None, channel_path=None,
+                 session=None, max_bytes=64 * 1024 * 1024):
         self.messages = []
+        self.session = session
+        self.max_bytes = max_bytes
+
+        # (type, display id, size) of each message in `messages`.
+        self._saved = []
+        self._size = 0
+        self._dropped_count = 0
+        self._dropped_size = 0
+        self._dropped_parent = None
+        # For the channel: the cell whose output `_size` counts, and the size
+        # of the last update written for each display.
+        self._channel_parent_id = None
+        self._update_sizes = {}
+        self.pending_flag = None
+        if pending_flag_address is not None:
+            self.pending_flag = ctypes.c_ssize_t.from_address(
+                pending_flag_address)
+        self.channel = None
+        if channel_path is not None:
+            self.channel = _open_channel(channel_path)
+        self.channel_lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """Whether `take_messages()` has anything to return."""
+        return len(self.messages) > 0 or self._dropped_count > 0
 
     def send_multipart(self, msg, **kwargs):
-        self.messages.append(msg)
+        size = sum(len(part) for part in msg)
+        msg_type, display_id, parent = self._parse(msg)
+        if self.channel is not None:
+            self._send_to_channel(msg, msg_type, display_id, parent, size)
+            return
+
+        if msg_type == 'clear_output':
+            self._drop_saved(lambda saved_type, _: (
+                saved_type in self.CLEARED_MSG_TYPES))
+        elif msg_type == 'update_display_data':
+            self._drop_saved(lambda saved_type, saved_display_id: (
+                saved_type == 'update_display_data' and
+                saved_display_id == display_id))
+
+        if self._size + size > self.max_bytes and msg_type != 'clear_output':
+            self._drop(size, parent)
+        else:
+            self.messages.append(msg)
+            self._saved.append((msg_type, display_id, size))
+            self._size += size
+        if self.pending_flag is not None:
+            self.pending_flag.value = 1
+
+    def _send_to_channel(self, msg, msg_type, display_id, parent, size):
+        parent_id = parent.get('msg_id')
+        if parent_id != self._channel_parent_id or msg_type == 'clear_output':
+            self._channel_parent_id = parent_id
+            self._size = 0
+            self._update_sizes = {}
+        replaced_size = 0
+        if msg_type == 'update_display_data':
+            replaced_size = self._update_sizes.get(display_id, 0)
+
+        if self._size - replaced_size + size > self.max_bytes and \
+                msg_type != 'clear_output':
+            # `take_messages()` adds the notice once the cell finishes.
+            self._drop(size, parent)
+            if self.pending_flag is not None:
+                self.pending_flag.value = 1
+            return
+        if msg_type == 'update_display_data':
+            self._update_sizes[display_id] = size
+        self._size += size - replaced_size
+        self._write_to_channel(msg)
+
+    def _drop(self, size, parent):
+        self._dropped_count += 1
+        self._dropped_size += size
+        self._dropped_parent = parent
+
+    def _write_to_channel(self, msg):
+        parts = [memoryview(part).tobytes() for part in msg]
+        frame = [struct.pack('=q', len(parts))]
+        for part in parts:
+            frame.append(struct.pack('=q', len(part)))
+            frame.append(part)
+        data = memoryview(b''.join(frame))
+        with self.channel_lock:
+            while len(data) > 0:
+                data = data[os.write(self.channel, data):]
+
+    def take_messages(self):
+        """Returns the saved messages, and forgets them."""
+        messages = self.messages
+        if self._dropped_count > 0 and self.session is not None:
+            text = ('%d display messages (%.1f MB) were not shown, because '
+                    'the cell displayed more than %.1f MB. Set '
+                    'IPythonDisplay.socket.max_bytes to change the limit.\n' % (
+                        self._dropped_count, self._dropped_size / 1e6,
+                        self.max_bytes / 1e6))
+            notice = self.session.msg('stream', {
+                'name': 'stderr',
+                'text': text,
+            }, parent=self._dropped_parent)
+            messages.append(self.session.serialize(notice, ident=b'stream'))
+        self.messages = []
+        self._saved = []
+        self._size = 0
+        self._dropped_count = 0
+        self._dropped_size = 0
+        self._dropped_parent = None
+        return messages
+
+    @staticmethod
+    def _parse(msg):
+        """Returns the type, display id and parent header of a serialized
+        message. The display id is only looked up for display updates."""
+        delimiter = msg.index(b'<IDS|MSG>')
+        header = json.loads(msg[delimiter + 2].decode('utf8'))
+        parent = json.loads(msg[delimiter + 3].decode('utf8'))
+        display_id = None
+        if header['msg_type'] == 'update_display_data':
+            content = json.loads(msg[delimiter + 5].decode('utf8'))
+            display_id = content.get('transient', {}).get('display_id')
+        return header['msg_type'], display_id, parent
+
+    def _drop_saved(self, should_drop):
+        kept = []
+        kept_saved = []
+        for msg, saved in zip(self.messages, self._saved):
+            msg_type, display_id, size = saved
+            if should_drop(msg_type, display_id):
+                self._size -= size
+            else:
+                kept.append(msg)
+                kept_saved.append(saved)
+        self.messages = kept
+        self._saved = kept_saved
 
 
 class SwiftShell(ZMQInteractiveShell):
@@ -43,14 +218,17 @@ class SwiftShell(ZMQInteractiveShell):
         pass
 
 
-def create_shell(username, session_id, key):
+def create_shell(username, session_id, key, pending_flag_address=None):
     """Instantiates a CapturingSocket and SwiftShell and hooks them up.
     
     After you call this, the returned CapturingSocket should capture all
     IPython display messages.
     """
-    socket = CapturingSocket()
     session = Session(username=username, session=session_id, key=key)
+    socket = CapturingSocket(
+        pending_flag_address,
+        os.environ.get('SWIFT_KERNEL_DISPLAY_CHANNEL'),
+        session)
     shell = SwiftShell.instance()
     shell.display_pub.session = session
     shell.display_pub.pub_socket = socket
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how fast `IPythonDisplay.bytes` copies Python bytes into Swift.
+
+Usage: python test/benchmark_display_bytes.py [--kernel-name swift]
+"""
+
+import argparse
+
+from jupyter_client.manager import start_new_kernel
+
+
+SETUP_CODE = """
+    %include "EnableIPythonDisplay.swift"
+    import Foundation
+"""
+
+BENCHMARK_CODE = """
+    do {
+        let size = %(size)d
+        let iterations = %(iterations)d
+        let data = Python.bytes(Python.bytearray(size))
+        let start = Date()
+        var total = 0
+        for _ in 0..<iterations {
+            total += IPythonDisplay.bytes(data).count
+        }
+        let seconds = Date().timeIntervalSince(start)
+        print("\\(size) bytes x \\(iterations): " +
+              "\\(Double(total) / seconds / 1_000_000) MB/s")
+    }
+"""
+
+
+def execute(kc, code):
+    """Executes `code` and returns its stdout, raising on errors."""
+    msg_id = kc.execute(code)
+    stdout = []
+    while True:
+        msg = kc.get_iopub_msg(timeout=600)
+        if msg['parent_header'].get('msg_id') != msg_id:
+            continue
+        if msg['msg_type'] == 'stream':
+            stdout.append(msg['content']['text'])
+        elif msg['msg_type'] == 'error':
+            raise Exception('\n'.join(msg['content']['traceback']))
+        elif msg['msg_type'] == 'status' and \
+                msg['content']['execution_state'] == 'idle':
+            return ''.join(stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Benchmark IPythonDisplay.bytes throughput')
+    parser.add_argument('--kernel-name', default='swift')
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    km, kc = start_new_kernel(kernel_name=args.kernel_name)
+    try:
+        execute(kc, SETUP_CODE)
+        for size in [1024, 64 * 1024, 2 * 1024 * 1024, 16 * 1024 * 1024]:
+            print(execute(kc, BENCHMARK_CODE % {
+                'size': size,
+                'iterations': args.iterations,
+            }).strip())
+    finally:
+        kc.stop_channels()
+        km.shutdown_kernel()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the kernel's own overhead through the Jupyter protocol.
+
+By default, the kernel runs against the LLDB stand-in in fake_lldb.py, so
+that the numbers measure the kernel rather than the Swift compiler, and so
+that the benchmarks run without a Swift toolchain. `--kernel-name swift` runs
+equivalent Swift code on a real kernel instead.
+
+Results are written as JSON, so that runs on different commits can be
+compared.
+
+Usage: python test/benchmark_kernel.py [--kernel-name swift] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+
+import fake_lldb
+
+
+# Each benchmark's cells, as (code for the LLDB stand-in, Swift code).
+SETUP_CODE = (
+    '%include "EnableIPythonDisplay.swift"',
+    '''
+        %include "EnableIPythonDisplay.swift"
+        #if canImport(Glibc)
+        import Glibc
+        #else
+        import Darwin
+        #endif
+        let __display = Python.import("IPython.display")
+    ''')
+
+EMPTY_CELL_CODE = ('', '()')
+
+STDOUT_CODE = (
+    'fakeStdout(lines: %(lines)d, width: %(width)d)',
+    '''
+        do {
+            let line = String(repeating: "x", count: %(width)d - 1)
+            for _ in 0..<%(lines)d { print(line) }
+        }
+    ''')
+
+STDOUT_LATENCY_CODE = (
+    'print("ready")\nfakeSleep(seconds: %(seconds)f)',
+    'print("ready")\nusleep(UInt32(%(seconds)f * 1e6))')
+
+DISPLAY_CODE = (
+    'fakeDisplay(count: %(count)d, bytes: %(bytes)d)',
+    '''
+        do {
+            let text = String(repeating: "x", count: %(bytes)d)
+            for _ in 0..<%(count)d { __display.display(text) }
+        }
+    ''')
+
+
+class Benchmark:
+    def __init__(self, kc, fake):
+        self.kc = kc
+        self.fake = fake
+
+    def code(self, variants, **arguments):
+        code = variants[0 if self.fake else 1]
+        if arguments:
+            code = code % arguments
+        return code
+
+    def execute(self, code):
+        """Executes `code`. Returns the time until the kernel went idle, the
+        time until the first output arrived, the iopub messages, and the
+        reply."""
+        start_time = time.time()
+        msg_id = self.kc.execute(code)
+        first_output_time = None
+        messages = []
+        while True:
+            msg = self.kc.get_iopub_msg(timeout=600)
+            if msg['parent_header'].get('msg_id') != msg_id:
+                continue
+            if msg['msg_type'] in ['stream', 'display_data'] and \
+                    first_output_time is None:
+                first_output_time = time.time() - start_time
+            if msg['msg_type'] == 'status' and \
+                    msg['content']['execution_state'] == 'idle':
+                break
+            messages.append(msg)
+        seconds = time.time() - start_time
+        reply = self.kc.get_shell_msg(timeout=600)
+        if reply['content']['status'] != 'ok':
+            raise Exception('Cell failed: %s\n%s' % (
+                    code, '\n'.join(reply['content']['traceback'])))
+        return seconds, first_output_time, messages, reply
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples),
+        'median': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'min': samples[0],
+        'max': samples[-1],
+    }
+
+
+def kernel_phases(replies):
+    """Averages the kernel's own phase timings over `replies`."""
+    totals = {}
+    for reply in replies:
+        timing = reply['metadata'].get('swift_timing', {})
+        for phase, seconds in timing.get('phases', {}).items():
+            totals[phase] = totals.get(phase, 0) + seconds
+    return {phase: seconds / len(replies) for phase, seconds in totals.items()}
+
+
+def benchmark_cell_overhead(benchmark, repeat):
+    samples = []
+    replies = []
+    code = benchmark.code(EMPTY_CELL_CODE)
+    for _ in range(repeat):
+        seconds, _, _, reply = benchmark.execute(code)
+        samples.append(seconds)
+        replies.append(reply)
+    return {
+        'seconds': summarize(samples),
+        'kernel_phases': kernel_phases(replies),
+    }
+
+
+def benchmark_stdout_throughput(benchmark, lines, width):
+    seconds, _, messages, _ = benchmark.execute(
+            benchmark.code(STDOUT_CODE, lines=lines, width=width))
+    received = sum(len(msg['content']['text']) for msg in messages
+                   if msg['msg_type'] == 'stream')
+    if received != lines * width:
+        raise Exception('Expected %d bytes of stdout, got %d' % (
+                lines * width, received))
+    return {
+        'bytes': received,
+        'messages': len(messages),
+        'seconds': seconds,
+        'megabytes_per_second': received / seconds / 1e6,
+    }
+
+
+def benchmark_stdout_latency(benchmark, repeat):
+    samples = []
+    seconds = 0.5
+    for _ in range(repeat):
+        _, first_output_time, _, _ = benchmark.execute(
+                benchmark.code(STDOUT_LATENCY_CODE, seconds=seconds))
+        samples.append(first_output_time)
+    return {'seconds': summarize(samples)}
+
+
+def benchmark_display_throughput(benchmark, count, size):
+    seconds, _, messages, reply = benchmark.execute(
+            benchmark.code(DISPLAY_CODE, count=count, bytes=size))
+    received = len([msg for msg in messages
+                    if msg['msg_type'] == 'display_data'])
+    if received != count:
+        raise Exception('Expected %d display messages, got %d' % (
+                count, received))
+    return {
+        'messages': received,
+        'seconds': seconds,
+        'messages_per_second': received / seconds,
+        'megabytes_per_second': received * size / seconds / 1e6,
+        'kernel_phases': kernel_phases([reply]),
+    }
+
+
+def benchmark_preprocess(benchmark, lines, repeat):
+    results = {}
+    for name, line in [('plain', 'let x%d = 1'),
+                       ('percent_in_strings', 'let x%d = "100%%"')]:
+        code = '\n'.join(line % i for i in range(lines))
+        replies = [benchmark.execute(code)[3] for _ in range(repeat)]
+        results[name] = kernel_phases(replies).get('preprocess')
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.realpath(__file__)),
+                stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Benchmark the Swift kernel through the Jupyter '
+                        'protocol')
+    parser.add_argument('--kernel-name',
+                        help='run against this kernelspec instead of the '
+                             'LLDB stand-in')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--output', help='write the JSON results here')
+    args = parser.parse_args()
+
+    if args.kernel_name is None:
+        km, kc = fake_lldb.start_kernel()
+    else:
+        from jupyter_client.manager import start_new_kernel
+        km, kc = start_new_kernel(kernel_name=args.kernel_name,
+                                  startup_timeout=600)
+    benchmark = Benchmark(kc, fake=args.kernel_name is None)
+    try:
+        benchmark.execute(benchmark.code(SETUP_CODE))
+        results = {
+            'cell_overhead': benchmark_cell_overhead(benchmark, args.repeat),
+            'stdout_throughput': benchmark_stdout_throughput(
+                    benchmark, lines=200000, width=80),
+            'stdout_latency': benchmark_stdout_latency(benchmark, 5),
+            'display_throughput': benchmark_display_throughput(
+                    benchmark, count=1000, size=10000),
+            'preprocess': benchmark_preprocess(
+                    benchmark, lines=1000, repeat=10),
+        }
+    finally:
+        kc.stop_channels()
+        km.shutdown_kernel(now=True)
+
+    output = json.dumps({
+        'commit': git_commit(),
+        'backend': args.kernel_name or 'fake_lldb',
+        'python': platform.python_version(),
+        'time': time.time(),
+        'results': results,
+    }, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,953 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An in-process stand-in for the `lldb` module, for tests and benchmarks.
+
+swift_kernel.py imports this instead of `lldb` when the environment variable
+`SWIFT_KERNEL_LLDB_MODULE` is `fake_lldb`. It implements the part of the LLDB
+API that the kernel uses:
+
+- SBDebugger: Create, SetAsync, SetScriptLanguage,
+  CreateTargetWithFileAndArch
+- SBTarget: GetExecutable, BreakpointCreateByName, LaunchSimple,
+  EvaluateExpression, CompleteCode
+- SBProcess: GetState, GetProcessID, GetThreadAtIndex, GetSTDOUT, GetSTDERR, ReadMemory,
+  WriteMemory, Kill, SendAsyncInterrupt, GetBroadcaster
+- SBListener and SBEvent, for stdout events
+- SBValue, SBError, SBExpressionOptions, SBLanguageRuntime
+
+There is no Swift compiler, of course. Instead, the fake REPL process
+emulates the kernel's own expressions (the KernelCommunicator bootstrap and
+the C entry points, backed by fake memory), and runs cells written in a tiny
+command language. Each top-level line of a cell that looks like
+`name(label: argument, ...)` runs the command `name`, if there is one:
+
+    print("text")                      Writes a line to stdout.
+    fakeStdout(lines: 1000, width: 80) Writes many lines to stdout.
+    fakeDisplay(count: 10, bytes: 1000)
+                                       Sends display messages. Needs
+                                       `IPythonDisplay.enable()` first.
+    fakeUpdateDisplay(count: 10)       Sends a display message, then updates
+                                       it to "0", "1", ... "9".
+    fakeDisplayLimit(bytes: 1000)      Sets the display socket's max_bytes.
+    fakeSleep(seconds: 1)              Sleeps, until interrupted.
+    fakeSpin(seconds: 1)               Uses the CPU, until interrupted.
+    fakeAllocate(megabytes: 100)       Allocates memory gradually, until
+                                       interrupted, and keeps it until the
+                                       process is killed.
+    fakeValue("text")                  Makes the cell evaluate to "text".
+    fakeArray(count: 1000)             Makes the cell evaluate to an array.
+    fakeError("message")               Fails to compile.
+    fakeCrash("message")               Crashes at runtime.
+    fakeAppendFile("path", "text")     Appends text to a file, so that tests
+                                       can see how often a cell ran.
+    fakeCrashIfExists("path")          Crashes at runtime if the file exists.
+    IPythonDisplay.enable()            Hooks up display messages, like
+                                       EnableIPythonDisplay.swift.
+
+Other lines are ignored, except that top-level `let`, `var` and `func`
+declarations and `import`ed module names are remembered for CompleteCode.
+The kernel's compiled cells (`let name: @convention(c) () -> () = { ... }`)
+become C entry points that run the closure's commands; they fail to compile
+if they use `fakeError`. Code that `%timeit` times runs its commands in the
+same way. Tests can add commands with `register_command`.
+"""
+
+import bisect
+import json
+import os
+import re
+import struct
+import threading
+import time
+
+
+eErrorTypeInvalid = 0
+eErrorTypeGeneric = 1
+eErrorTypeExpression = 4
+
+eStateStopped = 5
+eStateExited = 10
+
+eScriptLanguageNone = 0
+
+eLanguageTypeC = 0x0002
+eLanguageTypeSwift = 0x001e
+
+
+class SBError:
+    def __init__(self, type=eErrorTypeInvalid, description=None):
+        self.type = type
+        self.description = description
+
+    def Fail(self):
+        return self.description is not None
+
+    def Success(self):
+        return not self.Fail()
+
+    def SetErrorString(self, description):
+        self.type = eErrorTypeGeneric
+        self.description = description
+
+    def __str__(self):
+        return self.description or 'success'
+
+
+class SBEvent:
+    pass
+
+
+class SBExpressionOptions:
+    def __init__(self):
+        self.language = None
+
+    def SetLanguage(self, language):
+        self.language = language
+
+    def SetREPLMode(self, repl_mode):
+        pass
+
+    def SetUnwindOnError(self, unwind):
+        pass
+
+    def SetGenerateDebugInfo(self, generate):
+        pass
+
+    def SetTimeoutInMicroSeconds(self, timeout):
+        pass
+
+
+class SBLanguageRuntime:
+    @staticmethod
+    def GetLanguageTypeFromString(name):
+        return {'swift': eLanguageTypeSwift, 'c': eLanguageTypeC}[name]
+
+
+class SBValue:
+    """The result of an expression: a value with a description and children,
+    or an error."""
+
+    def __init__(self, description='', error=None, type_name='',
+                 name='', children=None):
+        self.description = description
+        self.error = error or SBError(eErrorTypeInvalid)
+        self.type_name = type_name
+        self.name = name
+        self.children = children or []
+
+    def GetNumChildren(self, max=None):
+        if max is None:
+            return len(self.children)
+        return min(max, len(self.children))
+
+    def GetChildAtIndex(self, index):
+        return self.children[index]
+
+    def GetName(self):
+        return self.name
+
+    def GetTypeName(self):
+        return self.type_name
+
+    def GetSummary(self):
+        return None
+
+    def GetValue(self):
+        if self.children:
+            return None
+        return self.description
+
+
+class _Frame:
+    class _LineEntry:
+        class _File:
+            def __init__(self, path):
+                self.fullpath = path
+
+            def __bool__(self):
+                return True
+
+        def __init__(self, path):
+            self.file = self._File(path)
+
+    def __init__(self, description, path):
+        self.description = description
+        self.line_entry = self._LineEntry(path)
+
+    def __str__(self):
+        return self.description
+
+
+class SBThread:
+    def __init__(self, process):
+        self.process = process
+
+    def __iter__(self):
+        return iter(self.process.frames)
+
+
+class SBListener:
+    def __init__(self, name):
+        self.name = name
+        self._condition = threading.Condition()
+        self._events = 0
+
+    def IsValid(self):
+        return True
+
+    def _post(self):
+        with self._condition:
+            self._events += 1
+            self._condition.notify_all()
+
+    def WaitForEvent(self, seconds, event):
+        with self._condition:
+            if self._events == 0:
+                self._condition.wait(seconds)
+            if self._events == 0:
+                return False
+            self._events -= 1
+            return True
+
+    def PeekAtNextEvent(self, event):
+        with self._condition:
+            return self._events > 0
+
+
+class SBBroadcaster:
+    def __init__(self, process):
+        self.process = process
+
+    def AddListener(self, listener, event_mask):
+        self.process.listeners.append(listener)
+        return event_mask
+
+
+class _Memory:
+    """A sparse address space of separately allocated blocks."""
+
+    def __init__(self):
+        self._bases = []
+        self._blocks = {}
+        self._next_address = 0x100000
+
+    def allocate(self, size):
+        address = self._next_address
+        self._next_address += (size + 0xfff) & ~0xfff or 0x1000
+        self._blocks[address] = bytearray(size)
+        bisect.insort(self._bases, address)
+        return address
+
+    def free(self, address):
+        del self._blocks[address]
+        self._bases.remove(address)
+
+    def _find(self, address, count):
+        index = bisect.bisect_right(self._bases, address) - 1
+        if index < 0:
+            return None, 0
+        base = self._bases[index]
+        block = self._blocks[base]
+        if address + count > base + len(block):
+            return None, 0
+        return block, address - base
+
+    def read(self, address, count):
+        block, offset = self._find(address, count)
+        if block is None:
+            return None
+        return bytes(block[offset:offset + count])
+
+    def write(self, address, data):
+        block, offset = self._find(address, len(data))
+        if block is None:
+            return False
+        block[offset:offset + len(data)] = data
+        return True
+
+
+class _Interrupted(Exception):
+    pass
+
+
+class _CompileError(Exception):
+    pass
+
+
+class _RuntimeError(Exception):
+    pass
+
+
+class _Communicator:
+    """Emulates KernelCommunicator.swift on top of the fake memory."""
+
+    STATE_FORMAT = '=8q'
+    PARENT_MESSAGE_BUFFER_CAPACITY = 64 * 1024
+
+    def __init__(self, process, session_code):
+        self.process = process
+        self.session = self._parse_session(session_code)
+        memory = process.memory
+        self.state_address = memory.allocate(
+            struct.calcsize(self.STATE_FORMAT))
+        self.parent_message_buffer = memory.allocate(
+            self.PARENT_MESSAGE_BUFFER_CAPACITY)
+        self.display_messages_buffer = None
+        self.parent_message_handlers = []
+        self.display_message_handlers = []
+        self._set_state(
+            parent_message_buffer_address=self.parent_message_buffer,
+            parent_message_buffer_capacity=
+                self.PARENT_MESSAGE_BUFFER_CAPACITY)
+
+    FIELDS = [
+        'parent_message_handler_count',
+        'unconditional_handler_count',
+        'display_messages_pending',
+        'parent_message_buffer_address',
+        'parent_message_buffer_capacity',
+        'parent_message_count',
+        'display_messages_address',
+        'display_messages_count',
+    ]
+
+    @staticmethod
+    def _parse_session(code):
+        match = re.search(
+                r'id: ("(?:[^"\\]|\\.)*"), key: ("(?:[^"\\]|\\.)*"), '
+                r'username: ("(?:[^"\\]|\\.)*")', code)
+        return {
+            'id': json.loads(match.group(1)),
+            'key': json.loads(match.group(2)),
+            'username': json.loads(match.group(3)),
+        }
+
+    def state(self):
+        return dict(zip(self.FIELDS, struct.unpack(
+                self.STATE_FORMAT,
+                self.process.memory.read(
+                        self.state_address,
+                        struct.calcsize(self.STATE_FORMAT)))))
+
+    def _set_state(self, **fields):
+        state = self.state()
+        state.update(fields)
+        self.process.memory.write(self.state_address, struct.pack(
+                self.STATE_FORMAT, *[state[field] for field in self.FIELDS]))
+
+    def handle_parent_message(self, handler):
+        self.parent_message_handlers.append(handler)
+        self._set_state(parent_message_handler_count=len(
+                self.parent_message_handlers))
+
+    def after_successful_execution(self, handler):
+        self.display_message_handlers.append(handler)
+
+    def set_pending(self):
+        self._set_state(display_messages_pending=1)
+
+    def update_parent_message(self):
+        count = self.state()['parent_message_count']
+        parent = json.loads(self.process.memory.read(
+                self.parent_message_buffer, count).decode('utf8'))
+        for handler in self.parent_message_handlers:
+            handler(parent)
+
+    def trigger_after_successful_execution(self):
+        self._set_state(display_messages_pending=0)
+        messages = []
+        for handler in self.display_message_handlers:
+            messages += handler()
+        buf = self.pack(messages)
+        self.release_display_messages()
+        self.display_messages_buffer = self.process.memory.allocate(len(buf))
+        self.process.memory.write(self.display_messages_buffer, buf)
+        self._set_state(display_messages_address=self.display_messages_buffer,
+                        display_messages_count=len(buf))
+
+    def release_display_messages(self):
+        if self.display_messages_buffer is not None:
+            self.process.memory.free(self.display_messages_buffer)
+            self.display_messages_buffer = None
+        self._set_state(display_messages_address=0, display_messages_count=0)
+
+    @staticmethod
+    def pack(messages):
+        """Lays out `messages` like `KernelCommunicator.pack`."""
+        header = [len(messages)]
+        offset = 8 * (1 + sum(1 + 2 * len(parts) for parts in messages))
+        for parts in messages:
+            header.append(len(parts))
+            for part in parts:
+                header += [offset, len(part)]
+                offset += len(part)
+        return b''.join([struct.pack('=%dq' % len(header), *header)] + [
+                part for parts in messages for part in parts])
+
+
+class _Display:
+    """Emulates EnableIPythonDisplay.swift, with a swift_shell
+    CapturingSocket."""
+
+    def __init__(self, process):
+        import swift_shell
+        from jupyter_client.session import Session
+
+        communicator = process.communicator
+        self.process = process
+        self.session = Session(
+                username=communicator.session['username'],
+                session=communicator.session['id'],
+                key=communicator.session['key'].encode('utf8'))
+        self.socket = swift_shell.CapturingSocket(
+                channel_path=process.environment.get(
+                        'SWIFT_KERNEL_DISPLAY_CHANNEL'),
+                session=self.session)
+        self.parent = {}
+        communicator.handle_parent_message(self._set_parent)
+        communicator.after_successful_execution(self.socket.take_messages)
+
+    def _set_parent(self, parent):
+        self.parent = parent
+
+    def display(self, data, msg_type='display_data', display_id=None):
+        transient = {}
+        if display_id is not None:
+            transient['display_id'] = display_id
+        self.session.send(self.socket, msg_type, {
+            'data': data,
+            'metadata': {},
+            'transient': transient,
+        }, parent=self.parent, ident=msg_type.encode('utf8'))
+        if self.socket.pending:
+            self.process.communicator.set_pending()
+
+
+_COMMANDS = {}
+
+
+def register_command(name, function):
+    """Adds a cell command. `function` is called with the fake process and
+    the command's arguments, and may return an SBValue for the cell's
+    result."""
+    _COMMANDS[name] = function
+
+
+def _print(process, text):
+    process.write_stdout(text + '\n')
+
+
+def _fake_stdout(process, lines, width):
+    line = 'x' * (width - 1) + '\n'
+    chunk_lines = max(1, 64 * 1024 // len(line))
+    for start in range(0, lines, chunk_lines):
+        process.check_interrupt()
+        process.write_stdout(line * min(chunk_lines, lines - start))
+
+
+def _display(process):
+    if process.display is None:
+        raise _CompileError('error: use of unresolved identifier '
+                            "'IPythonDisplay'")
+    return process.display
+
+
+def _fake_display(process, count, bytes):
+    display = _display(process)
+    text = 'x' * bytes
+    for _ in range(count):
+        process.check_interrupt()
+        display.display({'text/plain': text})
+
+
+def _fake_update_display(process, count):
+    display = _display(process)
+    display.display({'text/plain': ''}, display_id='fake')
+    for i in range(int(count)):
+        process.check_interrupt()
+        display.display({'text/plain': str(i)},
+                        msg_type='update_display_data', display_id='fake')
+
+
+def _fake_display_limit(process, bytes):
+    _display(process).socket.max_bytes = bytes
+
+
+def _fake_sleep(process, seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        process.check_interrupt()
+        time.sleep(min(0.01, max(0, deadline - time.time())))
+
+
+def _fake_spin(process, seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        process.check_interrupt()
+        sum(range(10000))
+
+
+def _fake_allocate(process, megabytes):
+    # The fake process is the kernel process, so this is the memory that
+    # the kernel measures.
+    for _ in range(int(megabytes) // 8):
+        process.check_interrupt()
+        process.allocations.append(b'x' * (8 * 1024 * 1024))
+        time.sleep(0.01)
+
+
+def _fake_value(process, text):
+    return SBValue(description=text, type_name='String')
+
+
+def _fake_array(process, count):
+    return SBValue(
+            description='[...]', type_name='[Int]',
+            children=[SBValue(description=str(i), type_name='Int',
+                              name='[%d]' % i)
+                      for i in range(count)])
+
+
+def _fake_error(process, message):
+    raise _CompileError('error: %s' % message)
+
+
+def _fake_crash(process, message):
+    process.write_stderr('Fatal error: %s\n' % message)
+    raise _RuntimeError('Execution was interrupted, reason: signal SIGILL')
+
+
+def _fake_append_file(process, path, text):
+    with open(path, 'a') as f:
+        f.write(text)
+
+
+def _fake_crash_if_exists(process, path):
+    if os.path.exists(path):
+        _fake_crash(process, '%s exists' % path)
+
+
+def _enable_display(process):
+    if process.display is None:
+        process.display = _Display(process)
+
+
+register_command('print', _print)
+register_command('fakeStdout', _fake_stdout)
+register_command('fakeDisplay', _fake_display)
+register_command('fakeUpdateDisplay', _fake_update_display)
+register_command('fakeDisplayLimit', _fake_display_limit)
+register_command('fakeSleep', _fake_sleep)
+register_command('fakeSpin', _fake_spin)
+register_command('fakeAllocate', _fake_allocate)
+register_command('fakeValue', _fake_value)
+register_command('fakeArray', _fake_array)
+register_command('fakeError', _fake_error)
+register_command('fakeCrash', _fake_crash)
+register_command('fakeAppendFile', _fake_append_file)
+register_command('fakeCrashIfExists', _fake_crash_if_exists)
+register_command('IPythonDisplay.enable', _enable_display)
+
+
+class SBProcess:
+    eBroadcastBitSTDOUT = 1 << 2
+    eBroadcastBitSTDERR = 1 << 3
+
+    SOURCE_LOCATION_RE = re.compile(
+            r'^\s*#sourceLocation\(file: "([^"]*)", line: (\d+)\)\s*$')
+    COMMAND_RE = re.compile(r'^\s*([A-Za-z_][\w.]*)\((.*)\)\s*;?\s*$')
+    ARGUMENT_RE = re.compile(
+            r'\s*(?:\w+:\s*)?("(?:[^"\\]|\\.)*"|[-+\d.e]+)\s*(?:,|$)')
+    DECLARATION_RE = re.compile(
+            r'^\s*(?:let|var|func|import)\s+([A-Za-z_]\w*)')
+    IGNORED_RE = re.compile(r'"(?:[^"\\]|\\.)*"|//.*$')
+    ENTRY_POINT_CALL_RE = re.compile(r'^\(\(void \(\*\)\(void\)\)(\d+)\)\(\)$')
+    CLOSURE_RE = re.compile(
+        r'^let (\w+): @convention\(c\) \(\) -> \(\) = \{\n(.*)\n\}\n'
+        r'"\\\(unsafeBitCast\(\1, to: Int\.self\)\)"\s*$',
+        re.MULTILINE | re.DOTALL)
+    TIMED_CLOSURE_RE = re.compile(
+        r'^let __swiftJupyterTimed = \{ \(\) -> \(\) in\n(.*)\n\}\s*$',
+        re.MULTILINE | re.DOTALL)
+    TIMED_RUN_RE = re.compile(
+        r'__swiftJupyterTimed\(\).*var number = (\d+).*'
+        r'while times\.count < (\d+)', re.DOTALL)
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.state = eStateStopped
+        self.memory = _Memory()
+        self.listeners = []
+        self.frames = []
+        self.communicator = None
+        self.display = None
+        self.declarations = set()
+        self.interrupted = threading.Event()
+        self.allocations = []
+        self._output_lock = threading.Lock()
+        self._output = {'stdout': [], 'stderr': []}
+        self._entry_points = {}
+        self._timed = None
+
+    def __bool__(self):
+        return True
+
+    def GetState(self):
+        return self.state
+
+    def GetThreadAtIndex(self, index):
+        return SBThread(self)
+
+    def GetBroadcaster(self):
+        return SBBroadcaster(self)
+
+    def GetProcessID(self):
+        return os.getpid()
+
+    def Kill(self):
+        self.state = eStateExited
+        self.interrupted.set()
+        self.allocations = []
+
+    def SendAsyncInterrupt(self):
+        self.interrupted.set()
+
+    def check_interrupt(self):
+        if self.interrupted.is_set():
+            self.interrupted.clear()
+            raise _Interrupted()
+
+    def _write(self, name, text):
+        with self._output_lock:
+            self._output[name].append(text)
+        for listener in self.listeners:
+            listener._post()
+
+    def write_stdout(self, text):
+        self._write('stdout', text)
+
+    def write_stderr(self, text):
+        self._write('stderr', text)
+
+    def _read(self, name, count):
+        with self._output_lock:
+            chunks = self._output[name]
+            if not chunks:
+                return ''
+            text = chunks[0]
+            if len(text) <= count:
+                chunks.pop(0)
+                return text
+            chunks[0] = text[count:]
+            return text[:count]
+
+    def GetSTDOUT(self, count):
+        return self._read('stdout', count)
+
+    def GetSTDERR(self, count):
+        return self._read('stderr', count)
+
+    def ReadMemory(self, address, count, error):
+        data = self.memory.read(address, count)
+        if data is None:
+            error.SetErrorString('memory read failed for 0x%x' % address)
+        return data
+
+    def WriteMemory(self, address, data, error):
+        if not self.memory.write(address, data):
+            error.SetErrorString('memory write failed for 0x%x' % address)
+            return 0
+        return len(data)
+
+    def _add_entry_point(self, function):
+        address = self.memory.allocate(16)
+        self._entry_points[address] = function
+        return address
+
+    def _bootstrap(self, code):
+        self.communicator = _Communicator(self, code)
+        communicator = self.communicator
+        functions = {
+            'updateParentMessage': communicator.update_parent_message,
+            'triggerAfterSuccessfulExecution':
+                communicator.trigger_after_successful_execution,
+            'releaseDisplayMessages': communicator.release_display_messages,
+        }
+        addresses = [
+            self._add_entry_point(functions[name])
+            for name in re.findall(r'static let (\w+)EntryPoint', code)]
+        return SBValue(description='"64 %d %s"' % (
+                communicator.state_address,
+                ' '.join(str(address) for address in addresses)))
+
+    def _adopt(self, code):
+        session = _Communicator._parse_session(code)
+        self.communicator.session = session
+        return SBValue(description=str(self.communicator.state_address))
+
+    @staticmethod
+    def _closure_error(body):
+        if re.search(r'^\s*fakeError\(', body, re.MULTILINE):
+            return SBValue(error=SBError(
+                    eErrorTypeExpression, 'error: closure failed to compile'))
+        return None
+
+    def _compile_closure(self, body):
+        error = self._closure_error(body)
+        if error is not None:
+            return error
+
+        def run():
+            self.interrupted.clear()
+            self._run_commands(body)
+
+        return SBValue(description='"%d"' % self._add_entry_point(run))
+
+    def _run_timed(self, number, repeat):
+        if self._timed is None:
+            raise _CompileError('error: use of unresolved identifier')
+        times = []
+        for _ in range(repeat):
+            start_time = time.time()
+            for _ in range(number or 1):
+                self._run_commands(self._timed)
+            times.append((time.time() - start_time) / (number or 1))
+        return SBValue(description='"%d %s"' % (
+                number or 1, ' '.join(repr(t) for t in times)))
+
+    def _run_commands(self, code):
+        """Runs the commands in the top-level lines of `code`."""
+        result = None
+        depth = 0
+        file_name = ''
+        line_number = 1
+        for line in code.split('\n'):
+            location_match = self.SOURCE_LOCATION_RE.match(line)
+            if location_match is not None:
+                file_name = location_match.group(1)
+                line_number = int(location_match.group(2))
+                continue
+            if depth == 0:
+                self.frames = [_Frame(
+                        'frame #0: main at %s:%d' % (file_name, line_number),
+                        file_name)]
+                declaration_match = self.DECLARATION_RE.match(line)
+                if declaration_match is not None:
+                    self.declarations.add(declaration_match.group(1))
+                command_match = self.COMMAND_RE.match(line)
+                if command_match is not None and \
+                        command_match.group(1) in _COMMANDS and \
+                        not self.ARGUMENT_RE.sub(
+                                '', command_match.group(2)).strip():
+                    arguments = [
+                        json.loads(argument)
+                        for argument in self.ARGUMENT_RE.findall(
+                                command_match.group(2))]
+                    value = _COMMANDS[command_match.group(1)](
+                            self, *arguments)
+                    if value is not None:
+                        result = value
+            code_only = self.IGNORED_RE.sub('', line)
+            depth = max(0, depth + code_only.count('{') -
+                           code_only.count('}'))
+            line_number += 1
+        return result
+
+    def evaluate(self, code, options):
+        if self.state != eStateStopped:
+            return SBValue(error=SBError(
+                    eErrorTypeExpression, 'error: process is not running'))
+
+        if options.language == eLanguageTypeC:
+            match = self.ENTRY_POINT_CALL_RE.match(code.strip())
+            function = match and self._entry_points.get(int(match.group(1)))
+            if function is None:
+                return SBValue(error=SBError(
+                        eErrorTypeExpression, 'error: invalid expression'))
+            try:
+                function()
+            except _Interrupted:
+                return SBValue(error=SBError(
+                        eErrorTypeExpression,
+                        'Execution was interrupted, reason: signal SIGINT.'))
+            except _RuntimeError as e:
+                return SBValue(error=SBError(eErrorTypeExpression, str(e)))
+            return SBValue(error=SBError(eErrorTypeGeneric))
+
+        if 'static var communicator = KernelCommunicator(' in code:
+            return self._bootstrap(code)
+        if 'JupyterKernel.communicator = KernelCommunicator(' in code:
+            return self._adopt(code)
+        closure_match = self.CLOSURE_RE.search(code)
+        if closure_match is not None:
+            return self._compile_closure(closure_match.group(2))
+        timed_match = self.TIMED_CLOSURE_RE.search(code)
+        if timed_match is not None:
+            error = self._closure_error(timed_match.group(1))
+            if error is not None:
+                return error
+            self._timed = timed_match.group(1)
+            return SBValue(error=SBError(eErrorTypeGeneric))
+        timed_match = self.TIMED_RUN_RE.search(code)
+
+        self.interrupted.clear()
+        try:
+            if timed_match is not None:
+                return self._run_timed(int(timed_match.group(1)),
+                                       int(timed_match.group(2)))
+            value = self._run_commands(code)
+        except _CompileError as e:
+            return SBValue(error=SBError(eErrorTypeExpression, str(e)))
+        except _Interrupted:
+            return SBValue(error=SBError(
+                    eErrorTypeExpression,
+                    'Execution was interrupted, reason: signal SIGINT.'))
+        except _RuntimeError as e:
+            return SBValue(error=SBError(eErrorTypeExpression, str(e)))
+        if value is None:
+            return SBValue(error=SBError(eErrorTypeGeneric))
+        return value
+
+
+class _CompletionMatch:
+    def __init__(self, insertable):
+        self.insertable = insertable
+
+    def GetInsertable(self):
+        return self.insertable
+
+
+class _CompletionResponse:
+    def __init__(self, prefix, matches):
+        self.prefix = prefix
+        self.matches = matches
+
+    def GetPrefix(self):
+        return self.prefix
+
+    def GetNumMatches(self):
+        return len(self.matches)
+
+    def GetMatchAtIndex(self, index):
+        return _CompletionMatch(self.matches[index][len(self.prefix):])
+
+
+class _FileSpec:
+    def __init__(self, path):
+        self.path = path
+
+    def GetFilename(self):
+        return os.path.basename(self.path)
+
+
+class SBTarget:
+    def __init__(self, path):
+        self.path = path
+        self.process = None
+
+    def __bool__(self):
+        return True
+
+    def GetExecutable(self):
+        return _FileSpec(self.path)
+
+    def BreakpointCreateByName(self, name, module):
+        return True
+
+    def LaunchSimple(self, argv, environment, working_directory):
+        self.process = SBProcess(dict(
+                entry.split('=', 1) for entry in environment))
+        return self.process
+
+    def EvaluateExpression(self, code, options):
+        return self.process.evaluate(code, options)
+
+    def CompleteCode(self, language, symbol_context, code):
+        prefix = re.search(r'[A-Za-z_0-9]*$', code).group(0)
+        return _CompletionResponse(prefix, sorted(
+                name for name in self.process.declarations
+                if name.startswith(prefix)))
+
+
+class SBDebugger:
+    @staticmethod
+    def Create():
+        return SBDebugger()
+
+    def __bool__(self):
+        return True
+
+    def SetAsync(self, asynchronous):
+        pass
+
+    def SetScriptLanguage(self, language):
+        pass
+
+    def CreateTargetWithFileAndArch(self, path, arch):
+        return SBTarget(path)
+
+
+def kernel_environment():
+    """Returns the environment for running the kernel with this module in
+    place of LLDB."""
+    test_dir = os.path.dirname(os.path.realpath(__file__))
+    environment = dict(os.environ)
+    environment.update({
+        'SWIFT_KERNEL_LLDB_MODULE': 'fake_lldb',
+        'REPL_SWIFT_PATH': 'repl_swift',
+        'PYTHONPATH': os.pathsep.join([test_dir, os.path.dirname(test_dir)]),
+    })
+    return environment
+
+
+def start_kernel(startup_timeout=60, environment=None):
+    """Starts swift_kernel.py with this module in place of LLDB, and with
+    the extra environment variables in `environment`.
+
+    Returns a `(KernelManager, BlockingKernelClient)` pair."""
+    import sys
+    import tempfile
+    from jupyter_client.kernelspec import KernelSpecManager
+    from jupyter_client.manager import KernelManager
+
+    # A kernelspec of our own, because newer versions of jupyter_client
+    # ignore `kernel_cmd`.
+    repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    kernels_dir = tempfile.mkdtemp(prefix='swift-kernel-test-')
+    os.mkdir(os.path.join(kernels_dir, 'swift-fake-lldb'))
+    with open(os.path.join(kernels_dir, 'swift-fake-lldb', 'kernel.json'),
+              'w') as f:
+        json.dump({
+            'argv': [sys.executable,
+                     os.path.join(repo_dir, 'swift_kernel.py'),
+                     '-f', '{connection_file}'],
+            'display_name': 'Swift (LLDB stand-in)',
+            'language': 'swift',
+        }, f)
+    km = KernelManager(
+            kernel_name='swift-fake-lldb',
+            kernel_spec_manager=KernelSpecManager(kernel_dirs=[kernels_dir]))
+    kernel_env = kernel_environment()
+    kernel_env.update(environment or {})
+    km.start_kernel(env=kernel_env)
+    kc = km.client()
+    kc.start_channels()
+    try:
+        kc.wait_for_ready(timeout=startup_timeout)
+    except RuntimeError:
+        kc.stop_channels()
+        km.shutdown_kernel()
+        raise
+    return km, kc
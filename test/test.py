@@ -1,8 +1,41 @@
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import threading
 import unittest
+import urllib.request
 import jupyter_kernel_test
 import sys
 import time
 
+import fake_lldb
+
+# Makes the kernel's own modules importable, to test their parts directly.
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import swift_kernel_pool
+import swift_shell
+
+
+def _import_swift_kernel():
+    """Imports swift_kernel with the LLDB stand-in in place of LLDB, without
+    changing the environment of the kernels that other tests start."""
+    lldb_module = os.environ.get('SWIFT_KERNEL_LLDB_MODULE')
+    os.environ['SWIFT_KERNEL_LLDB_MODULE'] = 'fake_lldb'
+    try:
+        import swift_kernel
+    finally:
+        if lldb_module is None:
+            del os.environ['SWIFT_KERNEL_LLDB_MODULE']
+        else:
+            os.environ['SWIFT_KERNEL_LLDB_MODULE'] = lldb_module
+    return swift_kernel
+
+
+swift_kernel = _import_swift_kernel()
+
 # This superclass defines tests but does not run them against kernels, so that
 # we can subclass this to run the same tests against different kernels.
 #
@@ -20,6 +53,11 @@ class SwiftKernelTests:
 
     code_generate_error = 'varThatIsntDefined'
 
+    def setUp(self):
+        # Other requests publish status messages too, so skip any that
+        # previous tests left behind.
+        self.flush_channels()
+
     def test_graphics_matplotlib(self):
         reply, output_msgs = self.execute_helper(code="""
             %include "EnableIPythonDisplay.swift"
@@ -41,6 +79,23 @@ class SwiftKernelTests:
         self.assertEqual(reply['content']['status'], 'ok')
         self.assertIn('image/png', output_msgs[0]['content']['data'])
 
+    def test_display_during_execution(self):
+        reply, output_msgs = self.execute_helper(code="""
+            %include "EnableIPythonDisplay.swift"
+        """)
+        self.assertEqual(reply['content']['status'], 'ok')
+
+        # The display message arrives even though the cell then fails.
+        reply, output_msgs = self.execute_helper(code="""
+            Python.import("IPython.display").display("displayed early")
+            let crash: [Int] = []
+            print(crash[0])
+        """)
+        self.assertEqual(reply['content']['status'], 'error')
+        self.assertIn('displayed early', [
+            msg['content']['data']['text/plain'] for msg in output_msgs
+            if msg['msg_type'] == 'display_data'][0])
+
     def test_extensions(self):
         reply, output_msgs = self.execute_helper(code="""
            struct Foo{}
@@ -127,6 +182,95 @@ class SwiftKernelTests:
         self.assertIn('b() at <Cell %d>:4:24' % b_cell, traceback[2])
         self.assertIn('main at <Cell %d>:2:13' % call_cell, traceback[3])
 
+    def test_timing_metadata(self):
+        reply, output_msgs = self.execute_helper(code="""
+            print("timed")
+        """)
+        self.assertEqual(reply['content']['status'], 'ok')
+        timing = reply['metadata']['swift_timing']
+        self.assertIn('execute', timing['phases'])
+        self.assertEqual(timing['stdout_bytes'], len('timed\n'))
+
+        reply, output_msgs = self.execute_helper(code="""
+            %timing
+        """)
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertIn('set_parent_message', output_msgs[0]['content']['text'])
+
+    def test_timeit(self):
+        reply, output_msgs = self.execute_helper(code="""
+            %timeit -n 10 -r 3 _ = (0..<100).reduce(0, +)
+        """)
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertIn('3 runs, 10 loops each', output_msgs[0]['content']['text'])
+
+        reply, output_msgs = self.execute_helper(code="""%%time
+            var total = 0
+            for i in 0..<1000 { total += i }
+        """)
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertIn('Wall time:', output_msgs[0]['content']['text'])
+
+        # The timed cell's declarations are visible to later cells and lines.
+        reply, output_msgs = self.execute_helper(code="""
+            %timeit -n 1 -r 1 total += 1
+            print(total)
+        """)
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertIn('499501', output_msgs[-1]['content']['text'])
+
+    def test_large_result(self):
+        reply, output_msgs = self.execute_helper(code="""
+            Array(0..<1_000_000)
+        """)
+        self.assertEqual(reply['content']['status'], 'ok')
+        text = output_msgs[0]['content']['data']['text/plain']
+        self.assertIn('1000000 children', text)
+        self.assertLess(len(text), 20000)
+        execution_count = reply['content']['execution_count']
+
+        reply, output_msgs = self.execute_helper(
+            code='%%more %d 999990' % execution_count)
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertIn('999999', output_msgs[0]['content']['text'])
+
+    def test_inspect(self):
+        reply, output_msgs = self.execute_helper(code="""
+            func inspectMe(_ x: Int) -> Int {
+                return x + 1
+            }
+        """)
+        self.assertEqual(reply['content']['status'], 'ok')
+
+        self.kc.inspect('inspectMe(2)', 3)
+        reply = self.kc.get_shell_msg(timeout=5)
+        self.assertTrue(reply['content']['found'])
+        text = reply['content']['data']['text/plain']
+        self.assertIn('func inspectMe(_ x: Int) -> Int', text)
+        self.assertIn('line 2', text)
+
+    def test_kernel_info_during_execution(self):
+        msg_id = self.kc.execute(code="""while true {}""")
+        time.sleep(1)
+
+        # The kernel answers other requests while the cell executes.
+        self.kc.kernel_info()
+        reply = self.kc.get_shell_msg(timeout=5)
+        self.assertEqual(reply['msg_type'], 'kernel_info_reply')
+
+        self.km.interrupt_kernel()
+        reply = self.kc.get_shell_msg(timeout=5)
+        self.assertEqual(reply['parent_header']['msg_id'], msg_id)
+        self.assertEqual(reply['content']['status'], 'error')
+
+        # Skip the messages from the interrupted cell.
+        while True:
+            msg = self.kc.iopub_channel.get_msg(timeout=5)
+            if msg['parent_header'].get('msg_id') == msg_id and \
+                    msg['msg_type'] == 'status' and \
+                    msg['content']['execution_state'] == 'idle':
+                break
+
     def test_interrupt_execution(self):
         msg_id = self.kc.execute(code="""while true {}""")
 
@@ -198,5 +342,793 @@ class SwiftKernelTestsPython36(SwiftKernelTests,
     kernel_name = 'swift'
 
 
+# Runs the kernel against the LLDB stand-in, so that the kernel's own
+# behavior can be tested without a Swift toolchain.
+class SwiftKernelTestsFakeLLDB(jupyter_kernel_test.KernelTests):
+    language_name = 'swift'
+
+    code_hello_world = 'print("hello, world!")'
+
+    code_execute_result = [
+        {'code': 'fakeValue("2")', 'result': '2'}
+    ]
+
+    code_generate_error = 'fakeError("varThatIsntDefined")'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.km, cls.kc = fake_lldb.start_kernel(environment={
+            'SWIFT_KERNEL_METRICS_PORT': '19100-19199',
+        })
+
+    def setUp(self):
+        self.flush_channels()
+
+    def test_display_during_execution(self):
+        reply, output_msgs = self.execute_helper(code="""
+            IPythonDisplay.enable()
+        """)
+        self.assertEqual(reply['content']['status'], 'ok')
+
+        reply, output_msgs = self.execute_helper(code="""
+            fakeDisplay(count: 3, bytes: 10)
+            fakeCrash("oops")
+        """)
+        self.assertEqual(reply['content']['status'], 'error')
+        self.assertEqual(3, len([msg for msg in output_msgs
+                                 if msg['msg_type'] == 'display_data']))
+
+    def execute_interactive(self, code):
+        """Returns the reply and the iopub messages other than status.
+        (Unlike `execute_helper`, this does not validate them, and so
+        accepts display updates.)"""
+        msgs = []
+
+        def output_hook(msg):
+            if msg['msg_type'] != 'status':
+                msgs.append(msg)
+
+        reply = self.kc.execute_interactive(code, timeout=60,
+                                            output_hook=output_hook)
+        return reply, msgs
+
+    def test_display_channel_limits(self):
+        reply, _ = self.execute_helper(code='IPythonDisplay.enable()')
+        self.assertEqual(reply['content']['status'], 'ok')
+
+        # Updates that pile up in the channel replace each other.
+        reply, msgs = self.execute_interactive('fakeUpdateDisplay(count: 5000)')
+        self.assertEqual(reply['content']['status'], 'ok')
+        updates = [msg['content']['data']['text/plain'] for msg in msgs
+                   if msg['msg_type'] == 'update_display_data']
+        self.assertEqual('4999', updates[-1])
+        self.assertLess(len(updates), 5000)
+
+        reply, msgs = self.execute_interactive("""
+            fakeDisplayLimit(bytes: 20000)
+            fakeDisplay(count: 100, bytes: 1000)
+        """)
+        self.execute_interactive('fakeDisplayLimit(bytes: 67108864)')
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertGreater(20, len([msg for msg in msgs
+                                    if msg['msg_type'] == 'display_data']))
+        self.assertEqual('stderr', msgs[-1]['content']['name'])
+        self.assertIn('were not shown', msgs[-1]['content']['text'])
+
+    def test_large_result(self):
+        reply, output_msgs = self.execute_helper(code="""
+            fakeArray(count: 1000000)
+        """)
+        self.assertEqual(reply['content']['status'], 'ok')
+        text = output_msgs[0]['content']['data']['text/plain']
+        self.assertIn('1000000 children', text)
+        self.assertLess(len(text), 20000)
+
+    def test_metrics(self):
+        reply, output_msgs = self.execute_helper(code='fakeError("oops")')
+        self.assertEqual(reply['content']['status'], 'error')
+        reply, output_msgs = self.execute_helper(code='print("hello")')
+        self.assertEqual(reply['content']['status'], 'ok')
+
+        self.kc.kernel_info()
+        port = self.kc.get_shell_msg(timeout=5)['content']['metrics_port']
+        metrics = urllib.request.urlopen(
+            'http://127.0.0.1:%d/metrics' % port).read().decode('utf8')
+        self.assertIn('swift_kernel_cells_total{outcome="compile_error"}',
+                      metrics)
+        self.assertIn('swift_kernel_cell_phase_seconds_bucket{'
+                      'le="0.0001",phase="execute"}', metrics)
+        self.assertIn('swift_kernel_inferior_rss_bytes', metrics)
+
+    def test_stdout_throughput(self):
+        reply, output_msgs = self.execute_helper(code="""
+            fakeStdout(lines: 10000, width: 80)
+        """)
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertEqual(10000 * 80, sum(
+            len(msg['content']['text']) for msg in output_msgs
+            if msg['msg_type'] == 'stream'))
+
+    def test_compiled_cell_cache(self):
+        code = 'print("cached")'
+        caches = []
+        for _ in range(3):
+            reply, output_msgs = self.execute_helper(code=code)
+            self.assertEqual(reply['content']['status'], 'ok')
+            self.assertEqual('cached\n', output_msgs[0]['content']['text'])
+            caches.append(reply['metadata']['swift_timing']['cell_cache'])
+        self.assertEqual([None, 'compiled', 'hit'], caches)
+
+        # Local declarations do not count, so a loop with a local `let` is
+        # cached and leaves the other cached cells alone.
+        loop = 'for batch in data {\n    let loss = batch\n}\nprint("loop")'
+        caches = []
+        for _ in range(3):
+            reply, output_msgs = self.execute_helper(code=loop)
+            self.assertEqual(reply['content']['status'], 'ok')
+            self.assertEqual('loop\n', output_msgs[0]['content']['text'])
+            caches.append(reply['metadata']['swift_timing']['cell_cache'])
+        self.assertEqual([None, 'compiled', 'hit'], caches)
+        reply, output_msgs = self.execute_helper(code=code)
+        self.assertEqual('hit',
+                         reply['metadata']['swift_timing']['cell_cache'])
+
+        # A top-level `guard let` binds names, so it is never cached.
+        guard = 'guard let value = Int("1") else { fatalError() }'
+        for _ in range(3):
+            reply, output_msgs = self.execute_helper(code=guard)
+            self.assertEqual(reply['content']['status'], 'ok')
+            self.assertIsNone(
+                    reply['metadata']['swift_timing']['cell_cache'])
+
+        # Top-level declarations invalidate the cache.
+        reply, output_msgs = self.execute_helper(code='let cacheBuster = 1')
+        self.assertEqual(reply['content']['status'], 'ok')
+        reply, output_msgs = self.execute_helper(code=code)
+        self.assertIsNone(reply['metadata']['swift_timing']['cell_cache'])
+
+    def complete(self, code):
+        self.kc.complete(code)
+        reply = self.kc.get_shell_msg(timeout=5)
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.flush_channels()
+        return reply['content']['matches']
+
+    def test_complete_after_import(self):
+        reply, _ = self.execute_helper(code='%enableCompletion')
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertNotIn('FakeModule', self.complete('Fak'))
+        reply, _ = self.execute_helper(code='import FakeModule')
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertIn('FakeModule', self.complete('Fak'))
+
+    def test_include_pragma_once(self):
+        directory = tempfile.mkdtemp()
+        ran = os.path.join(directory, 'ran')
+        include = os.path.join(directory, 'once.swift')
+        with open(include, 'w') as f:
+            f.write('%%pragma once\nfakeAppendFile("%s", "a")\n' % ran)
+        for _ in range(2):
+            reply, _ = self.execute_helper(code='%%include "%s"' % include)
+            self.assertEqual(reply['content']['status'], 'ok')
+        with open(ran) as f:
+            self.assertEqual('a', f.read())
+
+        # A file that changed is included again.
+        with open(include, 'w') as f:
+            f.write('%%pragma once\nfakeAppendFile("%s", "bb")\n' % ran)
+        os.utime(include, (time.time() + 10, time.time() + 10))
+        reply, _ = self.execute_helper(code='%%include "%s"' % include)
+        self.assertEqual(reply['content']['status'], 'ok')
+        with open(ran) as f:
+            self.assertEqual('abb', f.read())
+
+    def test_timeit_source_order(self):
+        ran = os.path.join(tempfile.mkdtemp(), 'ran')
+        reply, output_msgs = self.execute_helper(code="""
+            fakeAppendFile("%s", "a")
+            %%timeit -n 2 -r 3 fakeAppendFile("%s", "b")
+            fakeAppendFile("%s", "c")
+        """ % (ran, ran, ran))
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertIn('3 runs, 2 loops each',
+                      output_msgs[0]['content']['text'])
+        with open(ran) as f:
+            self.assertEqual('abbbbbbc', f.read())
+
+        reply, _ = self.execute_helper(code="""
+            func f() {
+              %timeit print("nested")
+            }
+        """)
+        self.assertEqual(reply['content']['status'], 'error')
+
+    def test_time_cell(self):
+        reply, output_msgs = self.execute_helper(code="""%%time
+            print("timed")
+            let timedValue = 1
+        """)
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertEqual('timed\n', output_msgs[0]['content']['text'])
+        self.assertIn('Wall time:', output_msgs[1]['content']['text'])
+        self.assertIn('timedValue', self.complete('timedV'))
+
+    def test_interrupt_execution(self):
+        msg_id = self.kc.execute(code="""fakeSleep(seconds: 60)""")
+        time.sleep(1)
+
+        self.kc.kernel_info()
+        reply = self.kc.get_shell_msg(timeout=5)
+        self.assertEqual(reply['msg_type'], 'kernel_info_reply')
+
+        self.km.interrupt_kernel()
+        reply = self.kc.get_shell_msg(timeout=5)
+        self.assertEqual(reply['parent_header']['msg_id'], msg_id)
+        self.assertEqual(reply['content']['status'], 'error')
+        while True:
+            msg = self.kc.iopub_channel.get_msg(timeout=5)
+            if msg['parent_header'].get('msg_id') == msg_id and \
+                    msg['msg_type'] == 'status' and \
+                    msg['content']['execution_state'] == 'idle':
+                break
+
+        reply, output_msgs = self.execute_helper(code="""print("again")""")
+        self.assertEqual(reply['content']['status'], 'ok')
+
+
+# Runs against the LLDB stand-in, whose memory and CPU time are the kernel's
+# own, so it needs a kernel of its own.
+class SwiftKernelLimitTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.km, cls.kc = fake_lldb.start_kernel(environment={
+            'SWIFT_KERNEL_MEMORY_LIMIT': '512M',
+        })
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.kc.stop_channels()
+        cls.km.shutdown_kernel()
+
+    def execute(self, code):
+        """Returns the reply and the error message, if any."""
+        errors = []
+
+        def output_hook(msg):
+            if msg['msg_type'] == 'error':
+                errors.append(msg)
+
+        # The cells do not depend on each other. (The kernel aborts requests
+        # that arrive while it is still replying to an error.)
+        reply = self.kc.execute_interactive(code, timeout=60,
+                                            stop_on_error=False,
+                                            output_hook=output_hook)
+        return reply, errors[0] if errors else None
+
+    def test_memory_limit(self):
+        reply, _ = self.execute('fakeAllocate(megabytes: 100)')
+        self.assertEqual(reply['content']['status'], 'ok')
+        timing = reply['metadata']['swift_timing']
+        self.assertGreater(timing['memory_delta_bytes'], 50 * 1024 * 1024)
+        self.assertGreater(timing['memory_peak_bytes'], 100 * 1024 * 1024)
+
+        reply, error = self.execute('fakeAllocate(megabytes: 4096)')
+        self.assertEqual(reply['content']['status'], 'error')
+        self.assertIn('Memory limit exceeded',
+                      error['content']['traceback'][0])
+
+        reply, _ = self.execute('%restart')
+        self.assertEqual(reply['content']['status'], 'ok')
+
+    def test_time_limits(self):
+        reply, error = self.execute('%%limit time 0.5\nfakeSleep(seconds: 60)')
+        self.assertEqual(reply['content']['status'], 'error')
+        self.assertIn('Time limit exceeded',
+                      error['content']['traceback'][0])
+
+        reply, error = self.execute('%limit cpu 0.5')
+        self.assertEqual(reply['content']['status'], 'ok')
+        reply, error = self.execute('fakeSpin(seconds: 60)')
+        self.assertEqual(reply['content']['status'], 'error')
+        self.assertIn('CPU time limit exceeded',
+                      error['content']['traceback'][0])
+        self.assertGreater(reply['metadata']['swift_timing']['cpu_seconds'],
+                           0.5)
+
+        reply, error = self.execute('%limit cpu none')
+        reply, error = self.execute('fakeSpin(seconds: 1)')
+        self.assertEqual(reply['content']['status'], 'ok')
+
+
+class SwiftKernelReplayTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.km, cls.kc = fake_lldb.start_kernel()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.kc.stop_channels()
+        cls.km.shutdown_kernel()
+
+    def execute(self, code):
+        """Returns the reply and all iopub messages up to the cell's idle
+        status, including ones that are not tagged with the cell."""
+        msg_id = self.kc.execute(code)
+        messages = []
+        while True:
+            msg = self.kc.get_iopub_msg(timeout=60)
+            if msg['msg_type'] == 'status':
+                if msg['parent_header'].get('msg_id') == msg_id and \
+                        msg['content']['execution_state'] == 'idle':
+                    break
+                continue
+            if msg['msg_type'] != 'execute_input':
+                messages.append(msg)
+        reply = self.kc.get_shell_msg(timeout=60)
+        self.assertEqual(reply['parent_header']['msg_id'], msg_id)
+        return reply, messages
+
+    def test_replay_display(self):
+        self.execute('%restart')
+        reply, _ = self.execute('IPythonDisplay.enable()')
+        self.assertEqual(reply['content']['status'], 'ok')
+        reply, messages = self.execute(
+                'print("epoch 1")\nfakeDisplay(count: 2, bytes: 10)')
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertEqual(['stream', 'display_data', 'display_data'],
+                         [msg['msg_type'] for msg in messages])
+
+        # Replayed cells' output, including display messages, is suppressed.
+        reply, messages = self.execute('%replay')
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertEqual(['stream'], [msg['msg_type'] for msg in messages])
+        self.assertIn('Replayed', messages[0]['content']['text'])
+
+    def test_replay(self):
+        self.execute('%restart')
+        directory = tempfile.mkdtemp()
+        ran = os.path.join(directory, 'ran')
+        crash = os.path.join(directory, 'crash')
+        for code in ['let x = 1',
+                     'fakeAppendFile("%s", "a")' % ran,
+                     'fakeError("oops")',
+                     'fakeCrashIfExists("%s")' % crash,
+                     'let x = 3']:
+            self.execute(code)
+
+        # `x` is declared twice, so the cells run in two expressions.
+        reply, messages = self.execute('%replay')
+        self.assertEqual(reply['content']['status'], 'ok')
+        self.assertIn('in 2 expressions', messages[0]['content']['text'])
+        with open(ran) as f:
+            self.assertEqual('aa', f.read())
+
+        # A runtime error stops the replay without running the cells before
+        # it again.
+        open(crash, 'w').close()
+        reply, messages = self.execute('%replay')
+        self.assertEqual(reply['content']['status'], 'error')
+        with open(ran) as f:
+            self.assertEqual('aaa', f.read())
+
+
+class SwiftNotebookRunnerTests(unittest.TestCase):
+    def _write_notebook(self, path, sources):
+        with open(path, 'w') as f:
+            json.dump({
+                'cells': [
+                    {'cell_type': 'code', 'source': source, 'metadata': {},
+                     'outputs': [], 'execution_count': None}
+                    for source in sources],
+                'metadata': {},
+                'nbformat': 4,
+                'nbformat_minor': 2,
+            }, f)
+
+    def test_run_notebooks(self):
+        directory = tempfile.mkdtemp()
+        passing = os.path.join(directory, 'passing.ipynb')
+        failing = os.path.join(directory, 'failing.ipynb')
+        self._write_notebook(passing, [
+            'print("hello")', 'fakeValue("2")'])
+        self._write_notebook(failing, [
+            'print("before")', 'fakeError("oops")', 'print("after")'])
+
+        runner = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.realpath(__file__))), 'swift_notebook_runner.py')
+        report = os.path.join(directory, 'report.json')
+        returncode = subprocess.call(
+            [sys.executable, runner, '--jobs', '2', '--report', report,
+             passing, failing],
+            env=fake_lldb.kernel_environment())
+        self.assertEqual(returncode, 1)
+
+        with open(passing) as f:
+            cells = json.load(f)['cells']
+        # nbformat may split strings into lists of lines.
+        self.assertEqual(''.join(cells[0]['outputs'][0]['text']), 'hello\n')
+        self.assertEqual(
+            ''.join(cells[1]['outputs'][0]['data']['text/plain']), '2')
+        self.assertIn('swift_timing', cells[1]['metadata'])
+
+        # The failing notebook stops at its first error.
+        with open(failing) as f:
+            cells = json.load(f)['cells']
+        self.assertEqual(cells[1]['outputs'][0]['output_type'], 'error')
+        self.assertEqual(cells[2]['outputs'], [])
+        with open(report) as f:
+            summaries = json.load(f)['notebooks']
+        self.assertEqual(['ok', 'error'], [
+            summary['status'] for summary in summaries])
+        self.assertEqual(summaries[1]['error']['index'], 1)
+
+    def test_magics_do_not_leak_between_notebooks(self):
+        directory = tempfile.mkdtemp()
+        limiting = os.path.join(directory, 'limiting.ipynb')
+        sleeping = os.path.join(directory, 'sleeping.ipynb')
+        self._write_notebook(limiting, ['%limit time 0.5'])
+        self._write_notebook(sleeping, ['fakeSleep(seconds: 1)'])
+
+        # With one worker, both notebooks run on the same kernel.
+        runner = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.realpath(__file__))), 'swift_notebook_runner.py')
+        returncode = subprocess.call(
+            [sys.executable, runner, '--jobs', '1', limiting, sleeping],
+            env=fake_lldb.kernel_environment())
+        self.assertEqual(returncode, 0)
+
+
+class CapturingSocketTests(unittest.TestCase):
+    def setUp(self):
+        from jupyter_client.session import Session, new_id_bytes
+        self.session = Session(key=new_id_bytes())
+        self.socket = swift_shell.CapturingSocket(session=self.session)
+
+    def send(self, msg_type, content):
+        self.session.send(self.socket, msg_type, content,
+                          ident=msg_type.encode('utf8'))
+
+    def display(self, text, msg_type='display_data', display_id=None):
+        content = {'data': {'text/plain': text}, 'metadata': {}}
+        if display_id is not None:
+            content['transient'] = {'display_id': display_id}
+        self.send(msg_type, content)
+
+    def taken(self, serialized=None):
+        """Returns the (type, content) of each message taken, or of each
+        message in `serialized`."""
+        if serialized is None:
+            serialized = self.socket.take_messages()
+        messages = []
+        for msg in serialized:
+            _, msg = self.session.feed_identities(msg)
+            msg = self.session.deserialize(msg)
+            messages.append((msg['msg_type'], msg['content']))
+        return messages
+
+    def test_clear_output(self):
+        self.display('before')
+        self.send('stream', {'name': 'stdout', 'text': 'before'})
+        self.send('clear_output', {'wait': False})
+        self.send('clear_output', {'wait': True})
+        self.display('after')
+        self.assertEqual(
+            ['clear_output', 'display_data'],
+            [msg_type for msg_type, _ in self.taken()])
+
+    def test_update_display_data(self):
+        self.display('a0', display_id='a')
+        self.display('b0', display_id='b')
+        for text in ['a1', 'b1', 'a2']:
+            self.display(text, 'update_display_data', text[0])
+        self.assertEqual(
+            [('display_data', 'a0'), ('display_data', 'b0'),
+             ('update_display_data', 'b1'), ('update_display_data', 'a2')],
+            [(msg_type, content['data']['text/plain'])
+             for msg_type, content in self.taken()])
+
+    def test_max_bytes(self):
+        self.display('x' * 3000)
+        size = self.socket._size
+        self.socket.max_bytes = size * 3 + size // 2
+        for _ in range(9):
+            self.display('x' * 3000)
+        messages = self.taken()
+        self.assertEqual(['display_data'] * 3 + ['stream'],
+                         [msg_type for msg_type, _ in messages])
+        self.assertEqual('stderr', messages[-1][1]['name'])
+        self.assertIn('7 display messages', messages[-1][1]['text'])
+
+        # The budget starts over after the messages are taken.
+        self.display('x' * 3000)
+        self.assertEqual(1, len(self.taken()))
+
+    def test_display_channel_coalescing(self):
+        sent = []
+        self.socket.send_multipart = lambda msg, **kwargs: sent.append(msg)
+        self.display('a0', display_id='a')
+        self.send('clear_output', {'wait': True})
+        self.display('b0', display_id='b')
+        for text in ['a1', 'b1', 'a2']:
+            self.display(text, 'update_display_data', text[0])
+        self.assertEqual(
+            [('clear_output', None), ('display_data', 'b0'),
+             ('update_display_data', 'b1'), ('update_display_data', 'a2')],
+            [(msg_type, content.get('data', {}).get('text/plain'))
+             for msg_type, content in self.taken(
+                     swift_kernel.DisplayChannel._coalesce(sent))])
+
+
+class IncludeResolverTests(unittest.TestCase):
+    def write(self, path, code):
+        with open(path, 'w') as f:
+            f.write(code)
+
+    def test_first_path_wins(self):
+        first = tempfile.mkdtemp()
+        second = tempfile.mkdtemp()
+        self.write(os.path.join(first, 'a.swift'), 'first')
+        self.write(os.path.join(second, 'a.swift'), 'second')
+        self.write(os.path.join(second, 'b.swift'), 'b')
+        resolver = swift_kernel.IncludeResolver([first, second])
+        self.assertEqual(os.path.join(first, 'a.swift'),
+                         resolver.resolve('a.swift'))
+        self.assertEqual(os.path.join(second, 'b.swift'),
+                         resolver.resolve('b.swift'))
+        self.assertIsNone(resolver.resolve('c.swift'))
+
+        # A remembered path that disappears is looked up again.
+        os.unlink(os.path.join(first, 'a.swift'))
+        self.assertEqual(os.path.join(second, 'a.swift'),
+                         resolver.resolve('a.swift'))
+
+    def test_read(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'a.swift')
+        self.write(path, 'let x = 1\n')
+        resolver = swift_kernel.IncludeResolver([directory])
+        key, code, once = resolver.read(path)
+        self.assertEqual('let x = 1\n', code)
+        self.assertFalse(once)
+        self.assertEqual(key, resolver.read(path)[0])
+
+        # Changing the file changes its key, and `%pragma once` lines are
+        # removed.
+        self.write(path, '  %pragma once\nlet x = 2\n')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        new_key, code, once = resolver.read(path)
+        self.assertNotEqual(key, new_key)
+        self.assertEqual('\nlet x = 2\n', code)
+        self.assertTrue(once)
+
+
+class CodeCompleterTests(unittest.TestCase):
+    MEMBERS = ['append', 'apply', 'bytes', 'count']
+    NAMES = ['precondition', 'print', 'zip']
+
+    # Stands in for the kernel and its target.
+    def CompleteCode(self, language, symbol_context, code):
+        self.calls.append(code)
+        self.release.wait()
+        prefix = re.search(r'[A-Za-z_0-9]*$', code).group(0)
+        names = self.MEMBERS if code[:len(code) - len(prefix)].endswith('.') \
+                else self.NAMES
+        return fake_lldb._CompletionResponse(prefix, [
+                name for name in names if name.startswith(prefix)])
+
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+        self.target = self
+        self.swift_language = None
+        self.log = logging.getLogger('CodeCompleterTests')
+        self.completer = swift_kernel.CodeCompleter(self)
+
+    def test_member_narrowing(self):
+        self.assertEqual(('a', ['append', 'apply']),
+                         self.completer.complete('x.a'))
+        self.assertEqual(('app', ['append', 'apply']),
+                         self.completer.complete('x.app'))
+        self.assertEqual(('b', ['bytes']), self.completer.complete('x.b'))
+        self.assertEqual(['x.'], self.calls)
+
+        self.assertEqual(('', self.MEMBERS), self.completer.complete('y.'))
+        self.assertEqual(['x.', 'y.'], self.calls)
+
+    def test_identifier_narrowing(self):
+        self.assertEqual(('pr', ['precondition', 'print']),
+                         self.completer.complete('let y = pr'))
+        self.assertEqual(('pri', ['print']),
+                         self.completer.complete('foo(pri'))
+        self.assertEqual(['p'], self.calls)
+        self.assertEqual(('', []), self.completer.complete('foo('))
+        self.assertEqual(['p'], self.calls)
+
+    def test_deadline(self):
+        self.completer.deadline = 0.05
+        self.release.clear()
+        self.assertEqual(('pr', []), self.completer.complete('pr'))
+
+        # The results are cached when they arrive. (`pause` waits for them.)
+        self.release.set()
+        self.completer.pause()
+        self.assertEqual(('pr', ['precondition', 'print']),
+                         self.completer.complete('pr'))
+        self.assertEqual(['p'], self.calls)
+
+    def test_pause(self):
+        self.completer.complete('x.')
+        self.completer.complete('p')
+        self.completer.pause()
+        self.assertEqual(('c', None), self.completer.complete('c'))
+        self.assertEqual(('p', ['precondition', 'print']),
+                         self.completer.complete('p'))
+        self.assertEqual(('', self.MEMBERS), self.completer.complete('x.'))
+        self.assertEqual(['x.', 'p'], self.calls)
+
+        # Resuming forgets members, which cells may have changed, but not
+        # identifiers.
+        self.completer.resume()
+        self.completer.complete('x.')
+        self.completer.complete('p')
+        self.assertEqual(['x.', 'p', 'x.'], self.calls)
+
+    def test_forget_identifiers(self):
+        self.assertEqual(('fo', []), self.completer.complete('fo'))
+        self.NAMES = self.NAMES + ['fooBar']
+        self.completer.forget_identifiers()
+        self.assertEqual(('fo', ['fooBar']), self.completer.complete('fo'))
+
+
+class SessionJournalTests(unittest.TestCase):
+    def batches(self, codes):
+        journal = swift_kernel.SessionJournal()
+        for execution_count, code in enumerate(codes):
+            journal.append(execution_count + 1, code, set())
+        return [[entry[0] for entry in batch] for batch in journal.batches()]
+
+    def test_batches(self):
+        self.assertEqual([], self.batches([]))
+        self.assertEqual([[1, 2, 3]], self.batches([
+            'let x = 1', 'print(x)', 'func f() {}']))
+
+        # A batch ends before a cell that declares a name again.
+        self.assertEqual([[1, 2], [3, 4]], self.batches([
+            'let x = 1', 'var y = 2', 'let x = 3', 'print(x)']))
+        self.assertEqual([[1], [2]], self.batches([
+            'struct S {}', 'struct S { let x: Int }']))
+
+        # Extensions of a type do not conflict with the type, but do
+        # conflict with each other.
+        self.assertEqual([[1, 2], [3]], self.batches([
+            'struct S {}', 'extension S {}', 'extension S {}']))
+
+
+class TimeitOptionsTests(unittest.TestCase):
+    def test_parse_timeit_options(self):
+        parse = swift_kernel.SwiftKernel._parse_timeit_options
+        self.assertEqual((0, 7, 'foo()'), parse(' foo()'))
+        self.assertEqual((10, 3, 'foo()'), parse(' -n 10 -r 3 foo()'))
+        self.assertEqual((10, 3, 'foo()'), parse(' -r 3 -n 10 foo()'))
+        self.assertEqual((10, 7, 'foo(-r 3)'), parse('-n10 foo(-r 3)'))
+        self.assertEqual((0, 2, ''), parse(' -r 2'))
+
+
+class ResultRendererTests(unittest.TestCase):
+    def setUp(self):
+        self.renderer = swift_kernel.ResultRenderer()
+        self.max_chars = swift_kernel.ResultRenderer.MAX_CHARS
+
+    def test_long_description_without_children(self):
+        value = fake_lldb.SBValue(description='x' * 100000,
+                                  type_name='String')
+        text, truncated = self.renderer.render(value, 1)
+        self.assertFalse(truncated)
+        self.assertTrue(text.startswith('x' * self.max_chars))
+        self.assertIn('showing %d of 100000 characters' % self.max_chars,
+                      text)
+
+    def test_long_children(self):
+        value = fake_lldb.SBValue(
+                description='[...]', type_name='[String]',
+                children=[fake_lldb.SBValue(description='x' * 50000,
+                                            type_name='String',
+                                            name='[%d]' % i)
+                          for i in range(300)])
+        text, truncated = self.renderer.render(value, 1)
+        self.assertTrue(truncated)
+        self.assertLess(len(text), self.max_chars + 200)
+        self.assertIn('`%more 1 1`', text)
+
+
+class SwiftKernelPoolTests(unittest.TestCase):
+    def test_kernel_env_hash(self):
+        python3 = {'PYTHON_VERSION': '3.6', 'JPY_PARENT_PID': '1'}
+        python2 = {'PYTHON_VERSION': '2.7', 'JPY_PARENT_PID': '1'}
+        self.assertNotEqual(swift_kernel_pool.kernel_env_hash(python3),
+                            swift_kernel_pool.kernel_env_hash(python2))
+        self.assertNotEqual(
+            swift_kernel_pool.kernel_env_hash(python3),
+            swift_kernel_pool.kernel_env_hash(
+                dict(python3, SWIFT_KERNEL_MEMORY_LIMIT='1G')))
+
+        # Variables that differ between launches of the same kernelspec do
+        # not matter.
+        self.assertEqual(
+            swift_kernel_pool.kernel_env_hash(python3),
+            swift_kernel_pool.kernel_env_hash(
+                dict(python3, JPY_PARENT_PID='2',
+                     SWIFT_KERNEL_POOL_SOCKET='/tmp/socket')))
+
+    def adopt(self, socket_path, connection_file, client_pid):
+        """Asks the pool for a kernel until one is ready, and returns its
+        pid."""
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            sock = swift_kernel_pool._connect(socket_path)
+            if sock is not None:
+                swift_kernel_pool._send_message(sock, {
+                    'connection_file': connection_file,
+                    'cwd': os.path.dirname(connection_file),
+                    'pid': client_pid,
+                })
+                reply = swift_kernel_pool._receive_message(sock)
+                sock.close()
+                if 'pid' in reply:
+                    return reply['pid']
+            time.sleep(0.5)
+        self.fail('No kernel became ready')
+
+    def test_idle_pool_keeps_adopted_kernels(self):
+        from jupyter_client import BlockingKernelClient, write_connection_file
+        repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        directory = tempfile.mkdtemp()
+        socket_path = os.path.join(directory, 'pool.sock')
+        connection_file = os.path.join(directory, 'kernel.json')
+        write_connection_file(connection_file)
+
+        # Jupyter sets JPY_PARENT_PID, which makes ipykernel exit with its
+        # parent.
+        environment = fake_lldb.kernel_environment()
+        environment['JPY_PARENT_PID'] = str(os.getpid())
+        manager = subprocess.Popen(
+            [sys.executable, os.path.join(repo_dir, 'swift_kernel_pool.py'),
+             '--socket', socket_path, '--size', '1', '--idle-timeout', '2',
+             '--kernel-script', os.path.join(repo_dir, 'swift_kernel.py')],
+            env=environment)
+        # Stands in for the client process that Jupyter starts.
+        client = subprocess.Popen(
+            [sys.executable, '-c', 'import time; time.sleep(600)'])
+        kc = BlockingKernelClient(connection_file=connection_file)
+        try:
+            worker_pid = self.adopt(socket_path, connection_file, client.pid)
+            kc.load_connection_file()
+            kc.start_channels()
+            kc.wait_for_ready(timeout=60)
+
+            # The pool shuts down, but the kernel keeps running.
+            time.sleep(4)
+            self.assertFalse(os.path.exists(socket_path))
+            reply = kc.execute_interactive('print("still running")',
+                                           timeout=30,
+                                           output_hook=lambda msg: None)
+            self.assertEqual(reply['content']['status'], 'ok')
+
+            # When the client is killed, the kernel exits, and then so does
+            # the manager.
+            client.kill()
+            client.wait()
+            manager.wait(timeout=30)
+            self.assertFalse(swift_kernel_pool._pid_exists(worker_pid))
+        finally:
+            kc.stop_channels()
+            client.kill()
+            client.wait()
+            if manager.poll() is None:
+                manager.kill()
+                manager.wait()
+
+
 if __name__ == '__main__':
     unittest.main()